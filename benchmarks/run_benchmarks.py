@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Throughput benchmarks for igtdetect.
+
+Runs feature extraction, classification and evaluation over the sample
+documents and synthetically scaled copies of them, and writes the
+lines/sec for each stage, the peak RSS of the run and the startup time out as
+JSON, so that results can be compared across commits:
+
+    python benchmarks/run_benchmarks.py -o before.json
+    ... make changes ...
+    python benchmarks/run_benchmarks.py -o after.json --compare before.json
+
+With --compare, the script exits with status 1 if any stage's
+throughput dropped by more than --tolerance.
+"""
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SAMPLE_DIR = os.path.join(REPO_DIR, 'sample')
+SAMPLE_TRAIN = os.path.join(SAMPLE_DIR, 'sample_train.txt')
+SAMPLE_TEST = os.path.join(SAMPLE_DIR, 'sample_test.txt')
+SAMPLE_CONFIG = os.path.join(REPO_DIR, 'defaults.ini.sample')
+
+# The config is read when igtdetect is imported.
+os.environ.setdefault('IGTDETECT_CONFIG', SAMPLE_CONFIG)
+sys.path.insert(0, REPO_DIR)
+
+import igtdetect.igtdetect as igt
+
+
+# =============================================================================
+# Synthetic documents
+# =============================================================================
+def scale_document(text, copies):
+    """
+    Concatenate a freki document with itself the given
+    number of times, renumbering the lines, pages, blocks
+    and spans of each copy so that the result is a single
+    valid document.
+    """
+    text = text.lstrip('﻿')
+    max_line = max([int(n) for n in re.findall(r'^line=(\d+)', text, flags=re.M)] or [0])
+    max_page = max([int(n) for n in re.findall(r'\bpage=(\d+)', text)] or [0])
+
+    def renumber(copy):
+        line_off = copy * max_line
+        page_off = copy * max_page
+
+        def block_header(m):
+            page = int(m.group(2)) + page_off
+            start, stop = int(m.group(5)), int(m.group(6))
+            if stop:
+                start, stop = start + line_off, stop + line_off
+            return '{}page={} block_id={}-{} {} {} {}'.format(m.group(1), page, page, m.group(3), m.group(4), start, stop)
+
+        copy_text = re.sub(r'^(doc_id=\S+ )page=(\d+) block_id=\d+-(\S+) (bbox=\S+) (\d+) (\d+)',
+                           block_header, text, flags=re.M)
+        copy_text = re.sub(r'^line=(\d+)', lambda m: 'line={}'.format(int(m.group(1)) + line_off),
+                           copy_text, flags=re.M)
+        copy_text = re.sub(r'span_id=(\S+)', r'span_id=\1c{}'.format(copy), copy_text)
+        return copy_text.rstrip('\n') + '\n\n'
+
+    return ''.join(renumber(copy) for copy in range(copies))
+
+
+def build_corpus(corpus_dir, scale):
+    """
+    Write out the benchmark corpus: the sample test document,
+    scale renamed copies of it, and one document made of scale
+    concatenated copies.
+
+    :rtype: list[str]
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    with open(SAMPLE_TEST, 'r', encoding='utf-8') as f:
+        test_text = f.read()
+
+    paths = []
+
+    def write(name, text):
+        path = os.path.join(corpus_dir, name + '.freki')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        paths.append(path)
+
+    for i in range(scale):
+        write('copy{:04}'.format(i), test_text)
+    write('scaled', scale_document(test_text, scale))
+    return paths
+
+
+# =============================================================================
+# Measurement
+# =============================================================================
+def peak_rss_kb():
+    """
+    The peak RSS of the whole run so far. This only ever
+    grows, so it is reported once for the run rather than
+    for each stage, which would mostly repeat the peak of
+    whichever stage came before.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports it in bytes rather than kilobytes.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def result(lines, seconds):
+    return {'lines': lines,
+            'seconds': round(seconds, 4),
+            'lines_per_sec': round(lines / seconds, 1) if seconds else None}
+
+
+def timed(func, repeat):
+    """
+    Call func repeat times, returning the number of lines
+    it reports processing and the fastest time taken.
+    """
+    best = None
+    lines = 0
+    for i in range(repeat):
+        start = time.perf_counter()
+        lines = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result(lines, best)
+
+
+def startup_seconds(repeat):
+    """
+    Time a fresh interpreter importing igtdetect, which
+    includes reading the config and importing its dependencies.
+    """
+    cmd = [sys.executable, '-c', 'import igtdetect.igtdetect']
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call(cmd, env=env, cwd=REPO_DIR)
+        times.append(time.perf_counter() - start)
+    return round(min(times), 4)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# =============================================================================
+# Benchmarks
+# =============================================================================
+def make_args(work_dir):
+    """
+    Build the argument dict the way the command line
+    does, from the config file, with outputs directed
+    into the working directory.
+    """
+    argdict = {}
+    for sec in igt.conf.sections():
+        argdict.update(igt.conf[sec])
+
+    argdict.update({'feat_dir': os.path.join(work_dir, 'feats'),
+                    'classified_dir': os.path.join(work_dir, 'classified'),
+                    'detected_dir': os.path.join(work_dir, 'detected'),
+                    'debug_dir': os.path.join(work_dir, 'debug'),
+                    'gold_dir': os.path.join(work_dir, 'corpus'),
+                    'classifier_path': os.path.join(work_dir, 'bench.model'),
+                    'debug_on': False,
+                    'gzip': True})
+    igt.load_resources(argdict)
+    argdict['settings'] = igt.Settings.compile(argdict, igt.conf)
+
+    # Paths to feature files and outputs are looked
+    # up from the global args.
+    igt.args = Namespace(**argdict)
+    return argdict
+
+
+def run_benchmarks(work_dir, scale=10, repeat=3):
+    argdict = make_args(work_dir)
+    corpus = build_corpus(os.path.join(work_dir, 'corpus'), scale)
+    results = {}
+
+    # -------------------------------------------
+    # Parsing and feature extraction
+    # -------------------------------------------
+    def parse():
+        return sum(len(list(igt.FrekiDoc.read(p).lines())) for p in corpus)
+
+    def write_instances():
+        lines = 0
+        for path in corpus:
+            fd = igt.FrekiDoc.read(path)
+            lines += len(igt.write_instances(fd, igt.get_feat_path(path), **argdict))
+        return lines
+
+    def load_feats():
+        return sum(len(igt.load_feats(igt.get_feat_path(p), **argdict)) for p in corpus)
+
+    results['parse'] = timed(parse, repeat)
+    results['write_instances'] = timed(write_instances, repeat)
+    results['load_feats'] = timed(load_feats, repeat)
+
+    # -------------------------------------------
+    # Training, on the sample training document.
+    # -------------------------------------------
+    def train():
+        train_args = dict(argdict, overwrite=True, overwrite_model=True)
+        igt.train(train_args, [SAMPLE_TRAIN])
+        return len(list(igt.FrekiDoc.read(SAMPLE_TRAIN).lines()))
+
+    results['train'] = timed(train, 1)
+
+    # -------------------------------------------
+    # Classification
+    # -------------------------------------------
+    cw = igt.load_classifier(argdict['classifier_path'])
+    docs = list(igt.extract_feats(corpus, overwrite=False, **argdict))
+
+    def get_classifications():
+        return sum(len(list(dists)) for dd, dists in igt.get_classifications(docs, cw, **argdict))
+
+    def classify_docs():
+        igt.classify_docs(igt.extract_feats(corpus, overwrite=True, **argdict), **argdict)
+        return sum(len(dd.data) for dd in docs)
+
+    results['get_classifications'] = timed(get_classifications, repeat)
+    results['classify_docs'] = timed(classify_docs, repeat)
+
+    # -------------------------------------------
+    # Evaluation, using the corpus documents
+    # as their own gold standard.
+    # -------------------------------------------
+    classified = [igt.get_classified_path(p, argdict['classified_dir']) for p in corpus]
+
+    def eval_files():
+        igt.eval_files(classified, out_path=os.devnull, **argdict)
+        return sum(len(dd.data) for dd in docs)
+
+    results['eval_files'] = timed(eval_files, repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of the stages whose throughput dropped
+    by more than tolerance relative to the baseline.
+    """
+    regressions = []
+    for stage, base in baseline.get('stages', {}).items():
+        new = results['stages'].get(stage)
+        if not new or not base.get('lines_per_sec') or not new.get('lines_per_sec'):
+            continue
+        change = new['lines_per_sec'] / base['lines_per_sec'] - 1
+        if change < -tolerance:
+            regressions.append((stage, base['lines_per_sec'], new['lines_per_sec'], change))
+    return regressions
+
+
+def main():
+    p = ArgumentParser(description='Benchmark igtdetect throughput.')
+    p.add_argument('-o', '--output', help='Path to write the JSON results to. [Default: stdout]')
+    p.add_argument('--scale', type=int, default=10,
+                   help='Number of copies of the sample document to add to the corpus.')
+    p.add_argument('--repeat', type=int, default=3, help='Repetitions of each stage; the fastest is kept.')
+    p.add_argument('--work-dir', help='Directory for the corpus and outputs. [Default: a temporary directory]')
+    p.add_argument('--compare', help='Previous results to check for regressions against.')
+    p.add_argument('--tolerance', type=float, default=0.1,
+                   help='Fractional drop in lines/sec that counts as a regression.')
+    bench_args = p.parse_args()
+
+    work_dir = bench_args.work_dir or tempfile.mkdtemp(prefix='igtdetect-bench-')
+    try:
+        stages = run_benchmarks(work_dir, scale=bench_args.scale, repeat=bench_args.repeat)
+    finally:
+        if not bench_args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {'commit': git_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'scale': bench_args.scale,
+               'startup_seconds': startup_seconds(bench_args.repeat),
+               'peak_rss_kb': peak_rss_kb(),
+               'stages': stages}
+
+    out = json.dumps(results, indent=2)
+    if bench_args.output:
+        with open(bench_args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+    if bench_args.compare:
+        with open(bench_args.compare) as f:
+            regressions = compare(results, json.load(f), bench_args.tolerance)
+        for stage, old, new, change in regressions:
+            sys.stderr.write('REGRESSION: {} {:.1f} -> {:.1f} lines/sec ({:+.0%})\n'.format(stage, old, new, change))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
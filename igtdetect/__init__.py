@@ -1 +1 @@
-all = ['env', 'igtdetect']
\ No newline at end of file
+all = ['compact', 'context', 'env', 'filelist', 'igtdetect', 'journal', 'labels', 'layout', 'metrics', 'models', 'pipeline', 'plan', 'prefilter', 'registry', 'settings', 'shard', 'stream', 'tokens', 'transfer', 'vectorize', 'watch']
\ No newline at end of file
@@ -0,0 +1,241 @@
+import json
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from .models import SparseClassifierWrapper
+from .vectorize import FeatureIndex, HashingFeatureIndex
+
+# =============================================================================
+# Compact model format
+#
+# A compact model is a directory containing:
+#
+#    meta.json         -- the class labels, how features are indexed and the context window
+#    weights.npy       -- float32 weights, one row per feature
+#    intercept.npy     -- float32 intercepts, one per weight column
+#    vocab.bin         -- the feature names, sorted, as concatenated utf-8
+#    vocab_offsets.npy -- the start of each name in vocab.bin
+#
+# or, for hashed features, buckets.npy in place of the vocab files.
+#
+# Every array is memory-mapped on load rather than read, so a model loads
+# in a few milliseconds, and processes classifying with the same model
+# share its pages.
+# =============================================================================
+
+COMPACT_FORMAT = 'igtdetect-compact'
+COMPACT_VERSION = 1
+
+META_FILE = 'meta.json'
+WEIGHTS_FILE = 'weights.npy'
+INTERCEPT_FILE = 'intercept.npy'
+VOCAB_FILE = 'vocab.bin'
+VOCAB_OFFSETS_FILE = 'vocab_offsets.npy'
+BUCKETS_FILE = 'buckets.npy'
+
+
+class StringTable(object):
+    """
+    A sorted table of strings stored as one buffer of
+    utf-8 bytes and an array of offsets into it, which
+    is searched in place rather than loaded into a dict.
+    """
+    def __init__(self, data, offsets):
+        """
+        :type data: np.ndarray
+        :type offsets: np.ndarray
+        """
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """:rtype: bytes"""
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def find(self, s):
+        """
+        Return the position of s in the table, or None.
+
+        :type s: str
+        """
+        key = s.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self[lo] == key:
+            return lo
+        return None
+
+    @classmethod
+    def write(cls, strings, data_path, offsets_path):
+        """
+        Write out the given strings, which must already be
+        sorted by their utf-8 encoding.
+        """
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        with open(data_path, 'wb') as f:
+            f.write(b''.join(encoded))
+        np.save(offsets_path, offsets)
+
+    @classmethod
+    def load(cls, data_path, offsets_path):
+        if os.path.getsize(data_path):
+            data = np.memmap(data_path, dtype=np.uint8, mode='r')
+        else:
+            data = np.zeros(0, dtype=np.uint8)
+        return cls(data, np.load(offsets_path, mmap_mode='r'))
+
+
+class CompactFeatureIndex(object):
+    """
+    Read-only feature index over a StringTable. Lookups
+    of frequent features are cached.
+    """
+    def __init__(self, table, cache_size=2 ** 16):
+        """:type table: StringTable"""
+        self.table = table
+        self._find = lru_cache(maxsize=cache_size)(table.find)
+
+    def intern(self, name):
+        return self._find(name)
+
+    def get(self, name, default=None):
+        i = self._find(name)
+        return default if i is None else i
+
+    def ids(self, feats, grow=False):
+        """:rtype: list[int]"""
+        find = self._find
+        return [i for i in (find(f) for f, v in feats.items() if v) if i is not None]
+
+    def name(self, feat_id):
+        return self.table[feat_id].decode('utf-8')
+
+    def names(self):
+        return [self.name(i) for i in range(len(self))]
+
+    def subset(self, selected):
+        return FeatureIndex([self.name(i) for i in selected])
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __len__(self):
+        return len(self.table)
+
+
+class CompactClassifier(SparseClassifierWrapper):
+    """
+    A read-only model loaded from the compact format, which
+    classifies the same way as the model it was exported from.
+    """
+    def __init__(self, feat_index, classes, weights, intercept, path=None):
+        super().__init__()
+        self.feat_index = feat_index
+        self.classes_ = np.array(classes, dtype=object)
+        self.weights_ = weights
+        self.intercept_ = intercept
+        self.path = path
+
+    # Pass compact models between processes by path, so
+    # that they are memory-mapped again rather than copied.
+    def __reduce__(self):
+        return (self.__class__.load, (self.path,))
+
+    def coef(self):
+        return self.weights_.T
+
+    def fit(self, X, y):
+        raise TypeError('Compact models are read-only.')
+
+    def save(self, path):
+        export_compact(self, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, META_FILE), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('format') != COMPACT_FORMAT:
+            raise ValueError('"{}" is not a compact igtdetect model.'.format(path))
+
+        if meta.get('hash_bits'):
+            feat_index = HashingFeatureIndex(meta['hash_bits'],
+                                             buckets=np.load(os.path.join(path, BUCKETS_FILE)))
+        else:
+            feat_index = CompactFeatureIndex(StringTable.load(os.path.join(path, VOCAB_FILE),
+                                                              os.path.join(path, VOCAB_OFFSETS_FILE)))
+
+        cw = cls(feat_index, meta['classes'],
+                 np.load(os.path.join(path, WEIGHTS_FILE), mmap_mode='r'),
+                 np.load(os.path.join(path, INTERCEPT_FILE), mmap_mode='r'),
+                 path=path)
+        cw.context_window = meta.get('context_window')
+        return cw
+
+
+# -------------------------------------------
+# Exporting
+# -------------------------------------------
+def riples_weights(cw):
+    """
+    Get the feature names, classes, coefficients and intercepts
+    out of a riples_classifier LogisticRegressionWrapper.
+    """
+    names = np.array(cw.dv.feature_names_, dtype=object)
+    if getattr(cw, 'feat_selector', None) is not None:
+        names = names[cw.feat_selector.get_support()]
+    return list(names), cw.learner.classes_, cw.learner.coef_, cw.learner.intercept_
+
+
+def export_compact(cw, path):
+    """
+    Write the model out in the compact format, to the
+    directory at path.
+
+    :type cw: SparseClassifierWrapper
+    """
+    if isinstance(cw, SparseClassifierWrapper):
+        classes, coef, intercept = cw.classes(), cw.coef(), cw.intercept()
+        feat_index = cw.feat_index
+    else:
+        names, classes, coef, intercept = riples_weights(cw)
+        feat_index = FeatureIndex(names)
+
+    os.makedirs(path, exist_ok=True)
+    weights = np.asarray(coef, dtype=np.float32).T
+    meta = {'format': COMPACT_FORMAT,
+            'version': COMPACT_VERSION,
+            'classes': [str(c) for c in classes],
+            'num_feats': len(feat_index)}
+    if getattr(cw, 'context_window', None) is not None:
+        meta['context_window'] = cw.context_window
+
+    if isinstance(feat_index, HashingFeatureIndex):
+        buckets = feat_index.buckets if feat_index.buckets is not None else np.arange(len(feat_index))
+        np.save(os.path.join(path, BUCKETS_FILE), buckets)
+        meta['hash_bits'] = feat_index.hash_bits
+    else:
+        # Sort the vocabulary so it can be binary searched,
+        # and put the weight rows in the same order.
+        names = [feat_index.name(i) for i in range(len(feat_index))]
+        order = sorted(range(len(names)), key=lambda i: names[i].encode('utf-8'))
+        StringTable.write([names[i] for i in order],
+                          os.path.join(path, VOCAB_FILE),
+                          os.path.join(path, VOCAB_OFFSETS_FILE))
+        weights = weights[order]
+
+    np.save(os.path.join(path, WEIGHTS_FILE), np.ascontiguousarray(weights))
+    np.save(os.path.join(path, INTERCEPT_FILE), np.asarray(intercept, dtype=np.float32))
+    with open(os.path.join(path, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
@@ -0,0 +1,368 @@
+import re
+from collections.abc import Mapping
+from itertools import chain
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .env import USE_PREV_LINE, USE_PREV_PREV_LINE, USE_NEXT_LINE
+from .vectorize import FeatureIndex
+
+# =============================================================================
+# Context windows
+#
+# Each line is classified using its own features, plus copies of the
+# features of the lines around it, prefixed with "prev_" or "next_" once
+# for each line of distance. The features of each line are stored once,
+# and the windowed rows are only built when they are needed: either as
+# named features, for writing out and for the riples_classifier models,
+# or directly as integer feature ids with a ContextExpander.
+# =============================================================================
+
+PREV_PREFIX = 'prev_'
+NEXT_PREFIX = 'next_'
+
+
+def context_prefix(offset):
+    """
+    Return the prefix for features of the line at offset
+    from the current one, e.g. "prev_prev_" for -2.
+
+    :type offset: int
+    :rtype: str
+    """
+    return (PREV_PREFIX if offset < 0 else NEXT_PREFIX) * abs(offset)
+
+
+class ContextWindow(object):
+    """
+    The offsets of the neighbouring lines whose features
+    are added to each line.
+    """
+    def __init__(self, offsets=()):
+        self.offsets = sorted(set(int(o) for o in offsets if o))
+        self.prefixes = [context_prefix(o) for o in self.offsets]
+
+    def expand(self, line_feats, i):
+        """
+        Return the features of line i, with the prefixed
+        features of its neighbours.
+
+        :type line_feats: list[dict]
+        :rtype: dict
+        """
+        feats = dict(line_feats[i])
+        for offset, prefix in zip(self.offsets, self.prefixes):
+            j = i + offset
+            if 0 <= j < len(line_feats):
+                for feat, value in line_feats[j].items():
+                    feats[prefix + feat] = value
+        return feats
+
+    @property
+    def reach(self):
+        """
+        The farthest any neighbouring line
+        in the window is from the current one.
+
+        :rtype: int
+        """
+        return max([abs(o) for o in self.offsets], default=0)
+
+    @property
+    def spec(self):
+        """
+        The window in the form used by the context_window
+        setting, e.g. "-2..+1".
+
+        :rtype: str
+        """
+        if not self.offsets:
+            return '0..0'
+        lo, hi = min(self.offsets[0], 0), max(self.offsets[-1], 0)
+        if self.offsets == [o for o in range(lo, hi + 1) if o]:
+            return '{:d}..{:+d}'.format(lo, hi)
+        return ','.join('{:+d}'.format(o) for o in self.offsets)
+
+    def __eq__(self, other):
+        return isinstance(other, ContextWindow) and self.offsets == other.offsets
+
+    def __hash__(self):
+        return hash(tuple(self.offsets))
+
+    def __repr__(self):
+        return 'ContextWindow({})'.format(self.offsets)
+
+
+def parse_context_window(spec):
+    """
+    Parse a window given as a range of offsets, like "-2..+1",
+    or as a comma-separated list of them, like "-2,-1,+1".
+
+    An empty spec gives None, leaving the window
+    to the use_*_line settings.
+
+    :type spec: str
+    :rtype: ContextWindow
+    """
+    if isinstance(spec, ContextWindow):
+        return spec
+    spec = spec.strip()
+    if not spec:
+        return None
+    range_m = re.match(r'^([+-]?\d+)\s*\.\.\s*([+-]?\d+)$', spec)
+    if range_m:
+        lo, hi = int(range_m.group(1)), int(range_m.group(2))
+        if lo > 0 or hi < 0:
+            raise ValueError('Context window "{}" must include the current line.'.format(spec))
+        return ContextWindow(range(lo, hi + 1))
+    try:
+        return ContextWindow(int(o) for o in spec.split(',') if o.strip())
+    except ValueError:
+        raise ValueError('Invalid context window "{}"; expected e.g. "-2..+1".'.format(spec))
+
+
+def context_window(kwargs):
+    """
+    Return the context window set by the context_window
+    setting, or if that is not set, by the use_prev_prev_line,
+    use_prev_line and use_next_line settings.
+
+    :rtype: ContextWindow
+    """
+    spec = kwargs.get('context_window')
+    if spec:
+        return parse_context_window(spec)
+
+    offsets = []
+    if USE_PREV_PREV_LINE(kwargs):
+        offsets.append(-2)
+    if USE_PREV_LINE(kwargs):
+        offsets.append(-1)
+    if USE_NEXT_LINE(kwargs):
+        offsets.append(1)
+    return ContextWindow(offsets)
+
+
+class DocFeatures(object):
+    """
+    The features of every line in a document, each stored
+    once, along with the window used to expand them.
+
+    Features in local_feats (like the previous tag) belong
+    to their line only, and are not copied to its neighbours.
+    """
+    def __init__(self, line_feats, window, local_feats=None):
+        """
+        :type line_feats: list[dict]
+        :type window: ContextWindow
+        :type local_feats: list[dict]
+        """
+        self.line_feats = line_feats
+        self.window = window
+        self.local_feats = local_feats if local_feats is not None else [{} for f in line_feats]
+
+    def __len__(self):
+        return len(self.line_feats)
+
+    def expand(self, i):
+        """:rtype: dict"""
+        feats = self.window.expand(self.line_feats, i)
+        feats.update(self.local_feats[i])
+        return feats
+
+    def feats(self, i):
+        """:rtype: LineFeats"""
+        return LineFeats(self, i)
+
+
+class LineFeats(Mapping):
+    """
+    Read-only view of the windowed features of a single line,
+    which are only expanded into a dict when accessed.
+    Iterate over items() rather than looking up keys one
+    at a time, since every access expands the window again.
+    """
+    __slots__ = ['doc', 'i']
+
+    def __init__(self, doc, i):
+        """:type doc: DocFeatures"""
+        self.doc = doc
+        self.i = i
+
+    def _dict(self):
+        return self.doc.expand(self.i)
+
+    def __getitem__(self, feat):
+        return self._dict()[feat]
+
+    def __iter__(self):
+        return iter(self._dict())
+
+    def __len__(self):
+        return len(self._dict())
+
+    def items(self):
+        return self._dict().items()
+
+    def keys(self):
+        return self._dict().keys()
+
+    def values(self):
+        return self._dict().values()
+
+    def copy(self):
+        return self._dict()
+
+
+class ContextExpander(object):
+    """
+    Build the windowed rows of a document as feature ids in
+    the given index.
+
+    Each distinct line feature is interned once into a base
+    index, and for each offset in the window, an array maps
+    base ids to the ids of the prefixed features. A document's
+    rows are then assembled by indexing and concatenating arrays,
+    rather than building prefixed strings for every line.
+
+    An expander that does not grow its index only interns the
+    line features that have a column in the index at some
+    offset, and starts its base index afresh once it holds
+    more than max_base features, so that one kept for the life
+    of a process does not grow with everything it has read.
+    """
+    def __init__(self, index, window, grow=True, max_base=1 << 20):
+        """
+        :param index: The index to map the windowed features into.
+        :type window: ContextWindow
+        :param grow: Whether to add unseen features to the index, or drop them.
+        :param max_base: When not growing, the most base features to keep.
+        """
+        self.index = index
+        self.window = window
+        self.grow = grow
+        self.max_base = max_base
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the base features and the maps
+        from them to the ids in the index.
+        """
+        self.base = FeatureIndex()
+        self._maps = {}
+        self._filled = {}
+        for offset in [0] + self.window.offsets:
+            self._maps[offset] = np.zeros(0, dtype=np.int64)
+            self._filled[offset] = 0
+
+    def _lookup(self, name):
+        feat_id = self.index.intern(name) if self.grow else self.index.get(name)
+        return -1 if feat_id is None else feat_id
+
+    def _map(self, offset):
+        """
+        Return the array mapping base ids to ids of the features
+        prefixed for offset, extending it to cover new base ids.
+        """
+        filled = self._filled[offset]
+        num_base = len(self.base)
+        if filled < num_base:
+            id_map = self._maps[offset]
+            if len(id_map) < num_base:
+                id_map = np.resize(id_map, max(num_base, 2 * len(id_map)))
+                self._maps[offset] = id_map
+            prefix = context_prefix(offset) if offset else ''
+            names = self.base.names()
+            id_map[filled:num_base] = [self._lookup(prefix + names[j]) for j in range(filled, num_base)]
+            self._filled[offset] = num_base
+        return self._maps[offset]
+
+    def _known(self, name):
+        """Whether the feature has a column in the index at any offset."""
+        return any(self.index.get(context_prefix(offset) + name if offset else name) is not None
+                   for offset in [0] + self.window.offsets)
+
+    def _base_ids(self, feats, unknown):
+        """
+        Return the base ids of a line's features. When not
+        growing, features with no column at any offset are
+        left out of the base index, and added to unknown so
+        they are only looked up once per document.
+
+        :type unknown: set
+        :rtype: list[int]
+        """
+        if self.grow:
+            return self.base.ids(feats)
+        ids = []
+        for f, v in feats.items():
+            if not v or f in unknown:
+                continue
+            feat_id = self.base.get(f)
+            if feat_id is None:
+                if not self._known(f):
+                    unknown.add(f)
+                    continue
+                feat_id = self.base.intern(f)
+            ids.append(feat_id)
+        return ids
+
+    def rows(self, doc, local=True):
+        """
+        Return the windowed rows of the document, as the
+        indptr and indices arrays of a CSR matrix. Ids may
+        repeat within a row.
+
+        :type doc: DocFeatures
+        :param local: Whether to include the line-local features.
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        num_lines = len(doc)
+        if not self.grow and len(self.base) > self.max_base:
+            self.reset()
+        unknown = set()
+        line_ids = [self._base_ids(feats, unknown) for feats in doc.line_feats]
+        lengths = np.fromiter((len(ids) for ids in line_ids), dtype=np.int64, count=num_lines)
+        base_ids = np.fromiter(chain.from_iterable(line_ids), dtype=np.int64, count=int(lengths.sum()))
+        line_nums = np.repeat(np.arange(num_lines), lengths)
+
+        # The features of line j appear, with the prefix
+        # for offset, on row j - offset.
+        rows = [line_nums]
+        cols = [self._map(0)[base_ids]]
+        for offset in self.window.offsets:
+            target = line_nums - offset
+            valid = (target >= 0) & (target < num_lines)
+            rows.append(target[valid])
+            cols.append(self._map(offset)[base_ids[valid]])
+
+        if local:
+            for i, feats in enumerate(doc.local_feats):
+                if feats:
+                    ids = [self._lookup(f) for f, v in feats.items() if v]
+                    rows.append(np.full(len(ids), i, dtype=np.int64))
+                    cols.append(np.array(ids, dtype=np.int64))
+
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        known = cols >= 0
+        rows, cols = rows[known], cols[known]
+
+        order = np.argsort(rows, kind='stable')
+        indptr = np.zeros(num_lines + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_lines), out=indptr[1:])
+        return indptr, cols[order]
+
+    def matrix(self, doc, local=True):
+        """
+        :type doc: DocFeatures
+        :rtype: csr_matrix
+        """
+        indptr, indices = self.rows(doc, local=local)
+        X = csr_matrix((np.ones(len(indices)), indices.astype(np.int32), indptr),
+                       shape=(len(doc), len(self.index)))
+        X.sum_duplicates()
+        X.data[:] = 1
+        return X
@@ -12,7 +12,7 @@ def absdir(path):
 # options from the default config
 # -------------------------------------------
 def setpaths(conf, path):
-    secs = ['paths', 'files']
+    secs = ['paths', 'files', 'models']
     for sec in secs:
         if sec in conf.sections():
             for opt in conf[sec]:
@@ -88,19 +88,36 @@ MET_WORDLIST = 'met_wordlist'
 # List of language names
 LNG_NAMES = 'lng_names'
 
-thresh_dict = {}
-def get_thresh(config, var):
-    global thresh_dict
-    if var not in thresh_dict:
-        thresh_dict[var] = config.getfloat('thresholds', var)
-    return thresh_dict.get(var)
+def get_thresh(config, var, fallback=None, kwargs=None):
+    """
+    Read a threshold from the options, where a model's
+    [model.NAME] section can set it, or else from the
+    [thresholds] section of the config. A threshold with
+    no default that is not set is left as None, and is only
+    an error if a feature that uses it is enabled.
+    """
+    value = kwargs.get(var) if kwargs else None
+    if value is None or value == '':
+        if not config.has_option('thresholds', var):
+            return fallback
+        value = config.get('thresholds', var)
+    return float(value)
+
+def HIGH_OOV_THRESH(config, kwargs=None): return get_thresh(config, 'high_oov', kwargs=kwargs)
+def MED_OOV_THRESH(config, kwargs=None): return get_thresh(config, 'med_oov', kwargs=kwargs)
 
-def HIGH_OOV_THRESH(config): return get_thresh(config, 'high_oov')
-def MED_OOV_THRESH(config): return get_thresh(config, 'med_oov')
+def HIGH_ISCORE_THRESH(config, kwargs=None): return get_thresh(config, 'high_iscore', kwargs=kwargs)
+def MED_ISCORE_THRESH(config, kwargs=None): return get_thresh(config, 'med_iscore', kwargs=kwargs)
+def LOW_ISCORE_THRESH(config, kwargs=None): return get_thresh(config, 'low_iscore', kwargs=kwargs)
 
-def HIGH_ISCORE_THRESH(config): return get_thresh(config, 'high_iscore')
-def MED_ISCORE_THRESH(config): return get_thresh(config, 'med_iscore')
-def LOW_ISCORE_THRESH(config): return get_thresh(config, 'low_iscore')
+# Width, in points, of the indentation buckets.
+def INDENT_STEP(config, kwargs=None): return get_thresh(config, 'indent_step', 12.0, kwargs=kwargs)
+# Gap before a line, in multiples of the document's usual line height,
+# that counts as large.
+def LARGE_VGAP_THRESH(config, kwargs=None): return get_thresh(config, 'large_vgap_ratio', 1.5, kwargs=kwargs)
+# Number of standard deviations from the document's mean font
+# size for a line's font size to count as high or low.
+def FONT_ZSCORE_THRESH(config, kwargs=None): return get_thresh(config, 'font_zscore', 1.0, kwargs=kwargs)
 
 
 # -------------------------------------------
@@ -192,8 +209,17 @@ F_HIGH_ISCORE = 'f_high_iscore'
 F_MED_ISCORE  = 'f_med_iscore'
 F_LOW_ISCORE  = 'f_low_iscore'
 
+# Layout features from the block bounding boxes.
+F_INDENT_BUCKET = 'indent_bucket'
+F_LARGE_VGAP = 'large_vgap'
+F_RIGHT_COLUMN = 'right_column'
+F_MULTI_COLUMN_PAGE = 'multi_column_page'
+F_HIGH_FONT_ZSCORE = 'high_font_zscore'
+F_LOW_FONT_ZSCORE = 'low_font_zscore'
+
 # List of all the above
-F_LIST = [F_IS_INDENTED, F_IS_FIRST_PAGE, F_PREV_LINE_SAME_BLOCK, F_NEXT_LINE_SAME_BLOCK, F_HAS_NONSTANDARD_FONT, F_HAS_SMALLER_FONT, F_HAS_LARGER_FONT, F_HIGH_ISCORE, F_MED_ISCORE, F_LOW_ISCORE]
+F_LIST = [F_IS_INDENTED, F_IS_FIRST_PAGE, F_PREV_LINE_SAME_BLOCK, F_NEXT_LINE_SAME_BLOCK, F_HAS_NONSTANDARD_FONT, F_HAS_SMALLER_FONT, F_HAS_LARGER_FONT, F_HIGH_ISCORE, F_MED_ISCORE, F_LOW_ISCORE,
+          F_INDENT_BUCKET, F_LARGE_VGAP, F_RIGHT_COLUMN, F_MULTI_COLUMN_PAGE, F_HIGH_FONT_ZSCORE, F_LOW_FONT_ZSCORE]
 
 T_PREV_TAG = 'prev_tag'
 T_BASIC = 'words'
@@ -236,30 +262,31 @@ T_LIST = [T_BASIC, T_HAS_LANGNAME, T_HAS_GRAMS, T_HAS_PARENTHETICAL, T_HAS_CITAT
 # contained on.
 # -------------------------------------------
 
-def enabled_feats(config: ConfigParser, section, featlist):
+def enabled_feats(config: ConfigParser, section, featlist, kwargs=None):
+    """
+    The features of featlist that are turned on, in the options
+    if they set them (as a model's [model.NAME] section can), or
+    else in the given section of the config.
+    """
     enabled = set([])
     for feat in featlist:
-        if config.has_option(section, feat):
+        if kwargs is not None and feat in kwargs:
+            if getbool(kwargs, feat):
+                enabled.add(feat)
+        elif config.has_option(section, feat):
             b = config.getboolean(section, feat)
             if b:
                 enabled.add(feat)
     return enabled
 
-_enabled_freki_feats = None
-_enabled_text_feats = None
-
-def ENABLED_FREKI_FEATS(config: ConfigParser):
-    global _enabled_freki_feats
-    if _enabled_freki_feats is None:
-        _enabled_freki_feats = enabled_feats(config, 'freki_features', F_LIST)
-    return _enabled_freki_feats
+# These are read from the config each time they are
+# called; the compiled Settings hold them for a run.
+def ENABLED_FREKI_FEATS(config: ConfigParser, kwargs=None):
+    return enabled_feats(config, 'freki_features', F_LIST, kwargs=kwargs)
 
 
-def ENABLED_TEXT_FEATS(config: ConfigParser):
-    global _enabled_text_feats
-    if _enabled_text_feats is None:
-        _enabled_text_feats = enabled_feats(config, 'text_features', T_LIST)
-    return _enabled_text_feats
+def ENABLED_TEXT_FEATS(config: ConfigParser, kwargs=None):
+    return enabled_feats(config, 'text_features', T_LIST, kwargs=kwargs)
 
 
 # =============================================================================
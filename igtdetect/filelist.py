@@ -0,0 +1,198 @@
+import glob
+import gzip
+import heapq
+import os
+from argparse import ArgumentTypeError
+from itertools import islice
+
+# =============================================================================
+# Input file lists
+#
+# A corpus can have millions of files, so the list of input files is never
+# built up front. A FileList holds the glob patterns and manifest files it
+# was given, and only finds the files they name as it is iterated over:
+# globs with glob.iglob, directories recursively with os.scandir, and
+# manifests (one path per line, optionally gzipped) a line at a time. The
+# first document can be processed as soon as it is found, and a FileList
+# can be iterated over again, for another epoch or pass.
+# =============================================================================
+
+
+def walk_files(dirname):
+    """
+    Yield every file under the directory, in
+    name order within each directory.
+
+    :rtype: Iterable[str]
+    """
+    stack = [dirname]
+    while stack:
+        cur_dir = stack.pop()
+        with os.scandir(cur_dir) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+def iter_pattern(pattern):
+    """
+    Yield the files matching a glob pattern, and
+    the files under any directories it matches.
+
+    :rtype: Iterable[str]
+    """
+    for path in glob.iglob(pattern):
+        if os.path.isdir(path):
+            yield from walk_files(path)
+        else:
+            yield path
+
+
+def iter_manifest(manifest_path):
+    """
+    Yield the paths listed in a manifest file, one per line.
+    Blank lines and lines starting with "#" are skipped, and
+    relative paths are taken to be relative to the manifest.
+
+    :rtype: Iterable[str]
+    """
+    base_dir = os.path.dirname(manifest_path)
+    opener = gzip.open if manifest_path.endswith('.gz') else open
+    with opener(manifest_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            path = line.strip()
+            if path and not path.startswith('#'):
+                yield os.path.join(base_dir, path)
+
+
+class FileList(object):
+    """
+    The input files named by glob patterns and manifests,
+    found lazily each time the list is iterated over.
+    """
+    def __init__(self, patterns=(), manifests=(), predicate=None):
+        """
+        :type patterns: list[str]
+        :type manifests: list[str]
+        :param predicate: Function a path must pass to be kept.
+        """
+        self.patterns = list(patterns)
+        self.manifests = list(manifests)
+        self.predicate = predicate
+
+    def __iter__(self):
+        for pattern in self.patterns:
+            yield from self._kept(iter_pattern(pattern))
+        for manifest in self.manifests:
+            yield from self._kept(iter_manifest(manifest))
+
+    def _kept(self, paths):
+        return paths if self.predicate is None else filter(self.predicate, paths)
+
+    def filter(self, predicate):
+        """
+        A FileList of only the files that also pass the predicate.
+
+        :rtype: FileList
+        """
+        if self.predicate is not None:
+            outer = self.predicate
+            combined = lambda path: outer(path) and predicate(path)
+        else:
+            combined = predicate
+        return FileList(self.patterns, self.manifests, combined)
+
+    def is_empty(self):
+        """:rtype: bool"""
+        return next(iter(self), None) is None
+
+    def __repr__(self):
+        return 'FileList(patterns={}, manifests={})'.format(self.patterns, self.manifests)
+
+
+def file_list(pattern=None, manifest=None):
+    """
+    Build the FileList for a glob pattern or a
+    manifest, checking that it names at least one
+    file, and that the manifest exists.
+
+    :rtype: FileList
+    """
+    if manifest:
+        if not os.path.isfile(manifest):
+            raise ArgumentTypeError('File list "{}" does not exist.'.format(manifest))
+        fl = FileList(manifests=[manifest])
+    else:
+        fl = FileList(patterns=[pattern] if pattern else [])
+    if fl.is_empty():
+        raise ArgumentTypeError(
+            'No files found matching pattern "{}".\nCheck that the path is valid and that containing directories exist.'.format(
+                manifest or pattern))
+    return fl
+
+
+# -------------------------------------------
+# Shuffling
+# -------------------------------------------
+def shuffled(paths, rng):
+    """
+    Return the paths in a random order, by shuffling an
+    array of their indices rather than the list itself.
+
+    :type rng: np.random.RandomState
+    :rtype: list[str]
+    """
+    paths = list(paths)
+    return [paths[i] for i in rng.permutation(len(paths))]
+
+
+def reservoir_sample(paths, k, rng):
+    """
+    Choose k of the paths at random, in a single pass
+    that only ever holds k of them, and return them in
+    a random order.
+
+    :type rng: np.random.RandomState
+    :rtype: list[str]
+    """
+    paths = iter(paths)
+    reservoir = list(islice(paths, k))
+    for i, path in enumerate(paths, start=k):
+        j = rng.randint(0, i + 1)
+        if j < k:
+            reservoir[j] = path
+    return shuffled(reservoir, rng)
+
+
+# -------------------------------------------
+# Ordering by size
+# -------------------------------------------
+def file_size(path):
+    """:rtype: int"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def largest_first(paths, lookahead=1000):
+    """
+    Yield the paths roughly largest first: each time, the
+    largest of the next lookahead of them. Only that many
+    are listed and stat'ed ahead of the one handed out, so
+    the first arrives without going through the whole list.
+
+    :rtype: Iterable[str]
+    """
+    heap = []
+    for i, path in enumerate(paths):
+        heapq.heappush(heap, (-file_size(path), i, path))
+        if len(heap) >= lookahead:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
@@ -2,23 +2,51 @@
 # coding=utf-8
 import logging
 import statistics
-import glob
 import sys
+import signal
 import sqlite3
 import time
 from argparse import ArgumentParser, ArgumentTypeError
 from collections import OrderedDict, Iterable, Counter
-from copy import copy
 from gzip import GzipFile
 from io import TextIOBase
+import io
 import os
 from multiprocessing.pool import Pool
-from random import Random
+from itertools import islice
+
+import numpy as np
+from scipy.sparse import vstack as sparse_vstack
 
 # -------------------------------------------
 # Import scikit-learn modules
 # -------------------------------------------
 from .env import *
+from .filelist import FileList, file_list, shuffled, reservoir_sample, largest_first
+from .compact import export_compact
+from .layout import DocLayout
+from .context import ContextExpander, DocFeatures, LineFeats, parse_context_window, \
+    PREV_PREFIX, NEXT_PREFIX
+from .metrics import METRICS, STAGE_PARSE, STAGE_PREFILTER, STAGE_TEXT_FEATS, STAGE_FREKI_FEATS, STAGE_CONTEXT, \
+    STAGE_LOAD_FEATS, STAGE_PREDICT, STAGE_TRAIN, STAGE_WRITE, COUNT_DOCS, COUNT_LINES, \
+    COUNT_SKIPPED_LINES
+from .models import Distribution, SparseClassifierWrapper, SparseLogisticRegressionWrapper, \
+    SGDLogisticRegressionWrapper, load_classifier, model_weights, show_weights
+from .journal import AtomicFile, RunJournal, JOURNAL_NAME
+from .labels import LABEL_CODES, LabelTable, eval_label
+from .pipeline import Pipeline, Stage
+from .plan import ExtractionPlan, wants
+from .prefilter import Prefilter, kept_runs
+from .registry import RESOURCES, DEFAULT_MODEL, MODELS_SECTION, HostedModel, ModelRegistry, is_model_section, \
+    model_section, parse_model_names, parse_model_spec
+from .settings import Settings
+from .shard import parse_shard, shard_str, shard_of, write_manifest, read_manifest, manifest_path, \
+    write_eval_state, read_eval_state, eval_state_path, missing_shards
+from .tokens import TOK_LANGNAME, has_bits, token_cache
+from .stream import OUT_FREKI, OUT_SPANS, STREAM_FORMATS, read_freki_stream, stream_doc_path, span_record
+from .watch import SpoolWatcher
+from .transfer import SharedRows, join_keep, make_scratch_dir, remove_scratch_dir
+from .vectorize import FeatureCounter, FeatureIndex, SparseMatrixBuilder, make_feature_index, SELECT_CHI2, SELECTION_METHODS
 import re
 
 # -------------------------------------------
@@ -56,6 +84,19 @@ if pythonpath:
 TYPE_FREKI = 'freki'
 TYPE_TEXT = 'text'
 
+
+def get_settings(kwargs):
+    """
+    Return the Settings compiled for the run, or if
+    kwargs has none (e.g. when called from outside the
+    command line), compile them from kwargs and the
+    default config.
+
+    :rtype: Settings
+    """
+    settings = kwargs.get('settings')
+    return settings if settings is not None else Settings.compile(kwargs, conf)
+
 # =============================================================================
 # FrekiReader
 #
@@ -77,9 +118,9 @@ def safe_mode(iterable):
     :param iterable:
     :return:
     """
-    items = sorted(Counter(iterable).items(),
-                   reverse=True,
-                   key=lambda x: x[1])
+    # most_common() breaks ties in favor of the
+    # item seen first, without sorting every item.
+    items = Counter(iterable).most_common(1)
     return items[0][0] if items else None
 
 class FrekiInfo(object):
@@ -88,13 +129,25 @@ class FrekiInfo(object):
     FrekiDocs, so that they don't need to be
     recalculated each time.
     """
-    def __init__(self, fonts=None, llxs=None):
+    def __init__(self, fonts=None, llxs=None, lines=None):
         """
         :type font: FrekiFont
         :type llx: float
+        :param lines: The document's lines, to build the layout index from.
         """
         self.def_font = safe_mode(fonts)
         self.llx = safe_mode(llxs)
+        self.layout = DocLayout(lines, self.def_font) if lines is not None else None
+
+    @classmethod
+    def from_doc(cls, fd, lines=None):
+        """
+        :type fd: FrekiDoc
+        :rtype: FrekiInfo
+        """
+        if lines is None:
+            lines = list(fd.lines())
+        return cls(fonts=fd.fonts(), llxs=fd.llxs(), lines=lines)
 
 class DocData(object):
     """
@@ -102,14 +155,42 @@ class DocData(object):
     full document in an object to output
     from the feature extraction code.
     """
-    def __init__(self, data, doc, path):
+    def __init__(self, data, doc, path, keep=None, matrix=None, matrices=None):
         """
         :type data: Iterable[DataInstance]
+        :param doc: The document, or None to parse it from the path when it is needed.
         :type doc: FrekiDoc
+        :param keep: Which lines the pre-filter kept for classification, or None for all of them.
+        :type keep: np.ndarray
+        :param matrix: The windowed rows, already built over the classifier's columns, in place of data.
+        :type matrix: csr_matrix
+        :param matrices: For a group of sparse models, the rows built over each one's columns, by model name.
+        :type matrices: dict[str,csr_matrix]
         """
-        self.doc = doc
+        self._doc = doc
         self.data = list(data)
         self.path = path
+        self.keep = keep
+        self.matrices = matrices
+        if matrix is None and matrices:
+            matrix = next(iter(matrices.values()))
+        self.matrix = matrix
+
+    @property
+    def doc(self):
+        """:rtype: FrekiDoc"""
+        if self._doc is None:
+            with METRICS.stage(STAGE_PARSE):
+                self._doc = FrekiDoc.read(self.path)
+        return self._doc
+
+    @property
+    def num_lines(self):
+        return self.matrix.shape[0] if self.matrix is not None else len(self.data)
+
+    @property
+    def num_skipped(self):
+        return int((~self.keep).sum()) if self.keep is not None else 0
 
     def feats(self):
         for di in self.data:
@@ -119,28 +200,176 @@ class DocData(object):
         for di in self.data:
             yield di.label
 
+    @property
+    def features(self):
+        """
+        The DocFeatures the lines' features are views of,
+        or None if they were loaded already expanded.
+
+        :rtype: DocFeatures
+        """
+        if self.data and isinstance(self.data[0].feats, LineFeats):
+            return self.data[0].feats.doc
+        return None
+
     @classmethod
-    def load(cls, path, gzip=True, overwrite=True, **kwargs):
-        """:param path: Path to the freki document"""
-        fd = FrekiDoc.read(path)
-        feat_path = get_feat_path(path, gzip=gzip)
-        if overwrite or not os.path.exists(feat_path):
-            feats = write_instances(fd, feat_path, gzip=gzip, **kwargs)
+    def load(cls, path, gzip=True, overwrite=True, prefilter=None, save_feats=True, **kwargs):
+        """
+        :param path: Path to the freki document
+        :param prefilter: Pre-filter to choose the lines to classify with.
+        :type prefilter: Prefilter
+        :param save_feats: Whether to load and save the features in the feat_dir.
+        """
+        with METRICS.stage(STAGE_PARSE):
+            fd = FrekiDoc.read(path)
+
+        keep = None
+        if prefilter is not None:
+            with METRICS.stage(STAGE_PREFILTER):
+                keep = prefilter.keep_mask(list(fd.lines()))
+
+        feat_path = get_feat_path(path, gzip=gzip) if save_feats else None
+        if feat_path is None:
+            feats = write_instances(fd, None, keep=keep, gzip=gzip, **kwargs)
+        elif os.path.exists(feat_path) and not overwrite:
+            with METRICS.stage(STAGE_LOAD_FEATS):
+                feats = load_feats(feat_path, **kwargs)
+        elif kwargs.get('plan') is not None or (keep is not None and not keep.all()):
+            # Don't write out the features of a pre-filtered
+            # document, or one extracted for a single model,
+            # which are missing some of the features, where
+            # they could be used for training.
+            feats = write_instances(fd, None, keep=keep, gzip=gzip, **kwargs)
         else:
-            feats = load_feats(feat_path, **kwargs)
+            feats = write_instances(fd, feat_path, gzip=gzip, **kwargs)
+
+        return cls(feats, fd, path, keep=keep)
+
+
+def chunk_bounds(num_lines, index, count):
+    """
+    The (start, stop) lines of the index-th
+    of count equal chunks of a document.
+    """
+    return num_lines * index // count, num_lines * (index + 1) // count
+
+
+class DocChunk(object):
+    """
+    The features of one range of lines of a large
+    document, extracted apart from the rest of it, so
+    that the document can be spread over several
+    workers. The first chunk carries the document.
+    """
+    def __init__(self, path, index, count, line_feats, local_feats, labels, doc=None, keep=None,
+                 context=None):
+        """
+        :param keep: The pre-filter's mask over the chunk's own lines, if there is one.
+        :type keep: np.ndarray
+        :param context: The features of the chunk's lines and the lines around them, and the
+                        position of the chunk's first line among them. These stay in the worker.
+        :type context: tuple[DocFeatures,int]
+        """
+        self.path = path
+        self.index = index
+        self.count = count
+        self.line_feats = line_feats
+        self.local_feats = local_feats
+        self.labels = labels
+        self.doc = doc
+        self.keep = keep
+        self.context = context
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['context'] = None
+        return state
+
+    def matrix(self, expander):
+        """
+        Build the windowed rows of the chunk's lines,
+        in the worker.
+
+        :type expander: ContextExpander
+        :rtype: csr_matrix
+        """
+        doc_feats, offset = self.context
+        X = expander.matrix(doc_feats, local=False)
+        return X[offset:offset + len(self.line_feats)]
 
-        return cls(feats, fd, path)
+    @classmethod
+    def load(cls, path, index, count, prefilter=None, **kwargs):
+        """
+        Extract the features of the chunk's lines, and of
+        enough lines either side of it that the context
+        window and overlap features come out the same as
+        for the whole document.
+
+        :type prefilter: Prefilter
+        """
+        with METRICS.stage(STAGE_PARSE):
+            fd = FrekiDoc.read(path)
+        lines = list(fd.lines())
+
+        keep = None
+        if prefilter is not None:
+            with METRICS.stage(STAGE_PREFILTER):
+                keep = prefilter.keep_mask(lines)
+
+        window = get_settings(kwargs).window
+        start, stop = chunk_bounds(len(lines), index, count)
+        margin = window.reach + 1
+        mask = np.zeros(len(lines), dtype=bool)
+        mask[max(0, start - margin):stop + margin] = True
+        if keep is not None:
+            mask &= keep
+
+        data = write_instances(fd, None, keep=mask, **kwargs)
+        doc_feats = data[0].feats.doc if data else DocFeatures([], window)
+        lo, hi = max(0, start - margin), min(len(lines), stop + margin)
+        context = DocFeatures(doc_feats.line_feats[lo:hi], window, doc_feats.local_feats[lo:hi])
+        return cls(path, index, count,
+                   doc_feats.line_feats[start:stop], doc_feats.local_feats[start:stop],
+                   [di.label for di in data[start:stop]],
+                   doc=fd if index == 0 else None, keep=keep[start:stop] if keep is not None else None,
+                   context=(context, start - lo))
+
+    @staticmethod
+    def assemble(chunks, window):
+        """
+        Join all the chunks of a document back together.
+
+        :type chunks: list[DocChunk]
+        :type window: ContextWindow
+        :rtype: DocData
+        """
+        chunks = sorted(chunks, key=lambda c: c.index)
+        doc_feats = DocFeatures([f for c in chunks for f in c.line_feats], window,
+                                [f for c in chunks for f in c.local_feats])
+        labels = [l for c in chunks for l in c.labels]
+        data = [DataInstance(label, doc_feats.feats(i)) for i, label in enumerate(labels)]
+        return DocData(data, chunks[0].doc, chunks[0].path, keep=join_keep([c.keep for c in chunks]))
 
 
 
-def get_textfeats(line, word_list, **kwargs):
+def get_textfeats(line, word_list, tokens=None, plan=None, settings=None, **kwargs):
     """
     Given a line as input, return the text-based features
     available for that line.
 
     :type line: FrekiLine
+    :param tokens: The line's tokens, from the token cache.
+    :type tokens: list[TokenInfo]
+    :param plan: If given, only the features the model can use are computed.
+    :type plan: ExtractionPlan
+    :type settings: Settings
     :rtype: dict
     """
+    if settings is None:
+        settings = get_settings(kwargs)
+    if tokens is None:
+        tokens = token_cache(kwargs).line_tokens(line)
+    enabled = settings.text_feats
 
     # Quick local function to check if a
     # feature is enabled in the config
@@ -148,20 +377,28 @@ def get_textfeats(line, word_list, **kwargs):
     feats = {}
 
     def checkfeat_line(name, func, *args, target=line):
-        if name in ENABLED_TEXT_FEATS(conf):
-            feats[name] = func(target, *args)
+        if name in enabled and wants(plan, name):
+            if METRICS.time_features:
+                start = time.perf_counter()
+                feats[name] = func(target, *args)
+                METRICS.add_feature_time(name, time.perf_counter() - start)
+            else:
+                feats[name] = func(target, *args)
 
     # Quick function to add featuers for words
     # in the line.
     def basic_words():
-        for word in word_list:
-            if word:
-                feats['word_{}'.format(word)] = True
+        for token in tokens:
+            if token.word and wants(plan, token.feat):
+                feats[token.feat] = True
 
-    if T_BASIC in ENABLED_TEXT_FEATS(conf):
+    if T_BASIC in enabled:
+        start = time.perf_counter()
         basic_words()
+        if METRICS.time_features:
+            METRICS.add_feature_time(T_BASIC, time.perf_counter() - start)
 
-    checkfeat_line(T_HAS_LANGNAME, has_langname, kwargs.get(LNG_NAMES), target=word_list)
+    checkfeat_line(T_HAS_LANGNAME, has_bits, TOK_LANGNAME, target=tokens)
     checkfeat_line(T_HAS_GRAMS, has_grams, kwargs.get('gram_list'), kwargs.get('gram_list_cased'))
     checkfeat_line(T_HAS_PARENTHETICAL, has_parenthetical)
     checkfeat_line(T_HAS_CITATION, has_citation)
@@ -171,8 +408,8 @@ def get_textfeats(line, word_list, **kwargs):
     checkfeat_line(T_HAS_QUOTATION, has_quotation)
     checkfeat_line(T_HAS_NUMBERING, has_numbering)
     checkfeat_line(T_HAS_LEADING_WHITESPACE, has_leading_whitespace)
-    checkfeat_line(T_HIGH_OOV_RATE, high_en_oov_rate, target=word_list)
-    checkfeat_line(T_MED_OOV_RATE, med_en_oov_rate, target=word_list)
+    checkfeat_line(T_HIGH_OOV_RATE, high_en_oov_rate, settings, target=word_list)
+    checkfeat_line(T_MED_OOV_RATE, med_en_oov_rate, settings, target=word_list)
     checkfeat_line(T_HAS_JPN, has_japanese)
     checkfeat_line(T_HAS_GRK, has_greek)
     checkfeat_line(T_HAS_KOR, has_korean)
@@ -181,86 +418,102 @@ def get_textfeats(line, word_list, **kwargs):
     checkfeat_line(T_HAS_DIA, has_diacritic)
     checkfeat_line(T_HAS_UNI, has_unicode)
     checkfeat_line(T_HAS_YEAR, has_year)
-    checkfeat_line(T_HIGH_GLS_OOV_RATE, high_gls_oov_rate, target=word_list)
-    checkfeat_line(T_HIGH_MET_OOV_RATE, high_met_oov_rate, target=word_list)
+    checkfeat_line(T_HIGH_GLS_OOV_RATE, high_gls_oov_rate, settings, target=word_list)
+    checkfeat_line(T_HIGH_MET_OOV_RATE, high_met_oov_rate, settings, target=word_list)
 
     return feats
 
-def get_frekifeats(line, fi, **kwargs):
+def get_doc_frekifeats(fi, plan=None, settings=None, **kwargs):
     """
-    :type line: FrekiLine
+    Compute the enabled freki features for every line
+    of a document at once, over the layout index in fi.
+
     :type fi: FrekiInfo
-    :rtype: dict
+    :param plan: If given, only the features the model can use are computed.
+    :type plan: ExtractionPlan
+    :type settings: Settings
+    :rtype: list[dict]
     """
-    feats = {}
+    if settings is None:
+        settings = get_settings(kwargs)
+    enabled = settings.freki_feats
+    layout = fi.layout
+    columns = OrderedDict()
 
     # Use this function to check the
     # feature constant name against the
-    # list of enabled features, and trigger
-    # the appropriate function if it's enabled.
-    def checkfeat(name, func):
-        if name in ENABLED_FREKI_FEATS(conf):
-            feats[name] = func(line, fi)
+    # list of enabled features, and compute
+    # the feature for every line if it's enabled.
+    def checkfeat(name, func, *args):
+        if name in enabled and wants(plan, name):
+            start = time.perf_counter()
+            columns[name] = func(*args).tolist()
+            if METRICS.time_features:
+                METRICS.add_feature_time(name, time.perf_counter() - start, calls=len(layout))
+
+    # The same, for a feature that produces a
+    # column for each of several values, named
+    # "<name>_<value>".
+    def checkfeats(name, func, *args):
+        if name in enabled and (plan is None or plan.has_prefix(name + '_')):
+            start = time.perf_counter()
+            for value, column in func(*args).items():
+                col_name = '{}_{}'.format(name, value)
+                if wants(plan, col_name):
+                    columns[col_name] = column.tolist()
+            if METRICS.time_features:
+                METRICS.add_feature_time(name, time.perf_counter() - start, calls=len(layout))
 
     # Apply each feature if it is enabled
-    checkfeat(F_IS_INDENTED, isindented)
-    checkfeat(F_IS_FIRST_PAGE, is_first_page)
-    checkfeat(F_PREV_LINE_SAME_BLOCK, prev_line_same_block)
-    checkfeat(F_NEXT_LINE_SAME_BLOCK, next_line_same_block)
-    checkfeat(F_HAS_NONSTANDARD_FONT, has_nondefault_font)
-    checkfeat(F_HAS_SMALLER_FONT, has_smaller_font)
-    checkfeat(F_HAS_LARGER_FONT, has_larger_font)
-
-    def check_iscore(feat_name, feat_thresh, gt):
-        if feat_name in ENABLED_FREKI_FEATS(conf):
-            feats[feat_name] = iscore(line, feat_thresh(conf), gt=gt)
-
-    check_iscore(F_LOW_ISCORE, LOW_ISCORE_THRESH, False)
-    check_iscore(F_MED_ISCORE, MED_ISCORE_THRESH, True)
-    check_iscore(F_HIGH_ISCORE, HIGH_ISCORE_THRESH, True)
+    checkfeat(F_IS_INDENTED, layout.is_indented, fi.llx)
+    checkfeat(F_IS_FIRST_PAGE, layout.is_first_page)
+    checkfeat(F_PREV_LINE_SAME_BLOCK, layout.prev_line_same_block)
+    checkfeat(F_NEXT_LINE_SAME_BLOCK, layout.next_line_same_block)
+    checkfeat(F_HAS_NONSTANDARD_FONT, layout.has_nondefault_font)
+    checkfeat(F_HAS_SMALLER_FONT, layout.has_smaller_font)
+    checkfeat(F_HAS_LARGER_FONT, layout.has_larger_font)
+
+    checkfeat(F_LOW_ISCORE, layout.iscore, settings.low_iscore, False)
+    checkfeat(F_MED_ISCORE, layout.iscore, settings.med_iscore, True)
+    checkfeat(F_HIGH_ISCORE, layout.iscore, settings.high_iscore, True)
+
+    checkfeats(F_INDENT_BUCKET, layout.indent_buckets, fi.llx, settings.indent_step)
+    checkfeat(F_LARGE_VGAP, layout.large_vgap, settings.large_vgap_ratio)
+    checkfeat(F_RIGHT_COLUMN, layout.right_column)
+    checkfeat(F_MULTI_COLUMN_PAGE, layout.multi_column_page)
+    if any(f in enabled and wants(plan, f) for f in [F_HIGH_FONT_ZSCORE, F_LOW_FONT_ZSCORE]):
+        zscores = layout.font_zscores()
+        checkfeat(F_HIGH_FONT_ZSCORE, np.greater, zscores, settings.font_zscore)
+        checkfeat(F_LOW_FONT_ZSCORE, np.less, zscores, -settings.font_zscore)
+
+    names = list(columns.keys())
+    return [dict(zip(names, values)) for values in zip(*columns.values())] if names else \
+        [{} for i in range(len(layout))]
 
-    return feats
 
+def _path_rename(path, ext):
+    # result = os.path.splitext(os.path.basename(path))[0] + ext
+    result = re.search('(^.*?)\.', os.path.basename(path)).group(1) + ext
+    return result
 
-def get_all_line_feats(featdict, lineno, **kwargs):
-    """
-    Given a dictionary mapping lines to features, get
-    a new feature dict that includes features for the
-    current line, as well as n-1 and n-2 lines, and n+1.
 
-    :rtype: dict
+def doc_id(path):
     """
-
-    # Always include the features for the current line.
-    cur_feats = featdict[lineno]
-    all_feats = copy(cur_feats)
-
-    # Use the features for the line before the previous one (n-2)
-
-    if USE_PREV_PREV_LINE(kwargs):
-        prev_prev_feats = featdict.get(lineno - 2, {})
-        for prev_key in prev_prev_feats.keys():
-            all_feats['prev_prev_' + prev_key] = prev_prev_feats[prev_key]
-
-    # Use the features for the previous line (n-1)
-    if USE_PREV_LINE(kwargs):
-        prev_feats = featdict.get(lineno - 1, {})
-        for prev_key in prev_feats.keys():
-            all_feats['prev_' + prev_key] = prev_feats[prev_key]
-
-    # Use the features for the next line (n+1)
-    if USE_NEXT_LINE(kwargs):
-        next_feats = featdict.get(lineno + 1, {})
-        for next_key in next_feats.keys():
-            all_feats['next_' + next_key] = next_feats[next_key]
-
-    return all_feats
+    The id of a document, as recorded in the run
+    journal: its file name, without extensions.
+    """
+    return _path_rename(path, '')
 
 
-def _path_rename(path, ext):
-    # result = os.path.splitext(os.path.basename(path))[0] + ext
-    result = re.search('(^.*?)\.', os.path.basename(path)).group(1) + ext
-    return result
+def shard_key(path):
+    """
+    The id a document is sharded by, which is the same
+    for its input file and its classified output.
+    """
+    name = doc_id(path)
+    if name.endswith('_classified'):
+        name = name[:-len('_classified')]
+    return name
 
 
 def get_feat_path(path, gzip=True):
@@ -294,59 +547,16 @@ def get_gold_for_classified(path):
 def get_weight_path(path):
     return os.path.join(DEBUG_DIR(args), _path_rename(path, '_weights.txt'))
 
+# The labels with everything but the basic
+# label stripped off.
+_basic_labels = LabelTable((True, True, False, False))
+
 def basic_label(label):
-    return handle_label(label,
-                        **{STRIP_FLAGS:True,
-                           USE_MULTI_LABELS:False,
-                           USE_BI_LABELS:False,
-                           'skip_noisy':True})
+    return _basic_labels.normalize(label)
 
 def prev_label_feat(label):
     return 'prev_tag_{}'.format(basic_label(label))
 
-def handle_label(label, **kwargs):
-    """
-    Given a label, return a label without the multiple
-    flags/etc
-
-    :param label:
-    :param kwargs:
-    :return:
-    """
-
-    # --1) Start by handling the asterisk-indicated noisy labels.
-    new_label = label
-    if new_label.startswith('*'):
-        if getbool(kwargs, 'skip_noisy'):
-            new_label = 'O'
-        else:
-            new_label = new_label[1:]
-
-    # --2) Next, strip the '+' elements
-    #      off any label if we are not attempting
-    #      to learn flags.
-    if getbool(kwargs, STRIP_FLAGS) and '+' in new_label:
-        new_label = new_label.split('+')[0]
-
-    # --2) Now, if we AREN'T using B/I labels for beginning/inside
-    #      distinctions...
-    if not getbool(kwargs, USE_BI_LABELS) and new_label[0:2] in ['B-', 'I-']:
-        new_label = new_label[2:]
-
-    # --3) Finally, are we using multiple hyphenated labels?
-    if not getbool(kwargs, USE_MULTI_LABELS):
-
-        # ...Don't strip off 'B-', 'I-' tags.
-        if new_label[0:2] in ['B-', 'I-']:
-            new_label = new_label[0:2]+new_label[2:].split('-')[0]
-        else:
-            new_label = new_label.split('-')[0]
-
-    return new_label
-
-
-
-
 
 # -------------------------------------------
 # Perform feature extraction.
@@ -367,18 +577,46 @@ def extract_feats(filelist, overwrite=False, gzip=True, **kwargs):
     LOG.log(NORM_LEVEL, "Extracting features for training.")
     lines = 0
     docs = 0
+    skipped = 0
     for path in filelist:
         dd = DocData.load(path, gzip=gzip, overwrite=overwrite, **kwargs)
         lines += len(dd.data)
         docs += 1
+        skipped += dd.num_skipped
+        METRICS.count(COUNT_DOCS)
+        METRICS.count(COUNT_LINES, len(dd.data))
+        if dd.keep is not None:
+            METRICS.count(COUNT_SKIPPED_LINES, dd.num_skipped)
+        METRICS.progress(LOG, NORM_LEVEL)
         yield dd
 
-def load_feats(path, **kwargs):
+    LOG.info('Extracted features for {} lines in {} documents.'.format(lines, docs))
+    METRICS.set_cache_stats('tokens', *token_cache(kwargs).stats())
+    if kwargs.get('prefilter') is not None:
+        LOG.log(NORM_LEVEL, 'Pre-filter skipped {} of {} lines ({:.1%}).'.format(
+            skipped, lines, skipped / lines if lines else 0))
+
+LINE_FEATS_HEADER = '#line_feats'
+LOCAL_FEATS_SEP = '|'
+
+
+def load_feats(path, settings=None, **kwargs):
     """
-    Load features from a saved svm-lite like file
+    Load features from a saved svm-lite like file.
+
+    Files starting with LINE_FEATS_HEADER hold only each
+    line's own features, followed by its local features after
+    LOCAL_FEATS_SEP, and are expanded with the current context
+    window. Older files hold the already expanded features.
+
     :rtype: list[DataInstance]
     """
+    if settings is None:
+        settings = get_settings(kwargs)
     data_instances = []
+    line_feats = None
+    local_feats = []
+    labels = settings.label_table()
 
     # Load gzipped feat paths too.
     if path.endswith('.gz'):
@@ -388,25 +626,42 @@ def load_feats(path, **kwargs):
     try:
         for line in feat_f:
             line_str = line.decode(encoding='utf-8')
-            line_feats = {}
+            if line_str.startswith(LINE_FEATS_HEADER):
+                line_feats = []
+                continue
+
+            feats = {}
+            local = {}
             data = line_str.split()
             label = data[0]
 
-            for feat, value in [pair.split(':') for pair in data[1:]]:
-                line_feats[feat] = bool(value)
-
+            target = feats
+            for pair in data[1:]:
+                if pair == LOCAL_FEATS_SEP:
+                    target = local
+                    continue
+                feat, value = pair.rsplit(':', 1)
+                target[feat] = bool(value)
 
-            di = DataInstance(handle_label(label, **kwargs), line_feats)
-            data_instances.append(di)
+            if line_feats is not None:
+                line_feats.append(feats)
+                local_feats.append(local)
+            data_instances.append(DataInstance(labels.normalize(label), feats))
     except OSError:
         print('corrupt file')
         print(path)
 
     feat_f.close()
+
+    # Turn the lines' own features into
+    # views of their windowed features.
+    if line_feats is not None:
+        doc_feats = DocFeatures(line_feats, settings.window, local_feats)
+        data_instances = [DataInstance(di.label, doc_feats.feats(i)) for i, di in enumerate(data_instances)]
     return data_instances
 
 
-def write_instances(fd, feat_path, **kwargs):
+def write_instances(fd, feat_path, keep=None, settings=None, **kwargs):
     """
         Perform feature extraction for a single file.
 
@@ -414,46 +669,91 @@ def write_instances(fd, feat_path, **kwargs):
 
             LABEL   feature_1:value_1   feature_2:value_2 ...etc
 
+        with only each line's own features, followed by its
+        local features (the previous tag) after a "|". The
+        features of the neighbouring lines are added when
+        the file is loaded.
+
         The "skip_noisy" parameter is intended for training data that
         was created automatically, and for which the labels were mapped,
         but seem unlikely to be correct. Such noisy labels are preceded by
         an asterisk.
 
+        Lines not set in keep, the mask from the pre-filter,
+        get no text features, and if feat_path is None, no
+        feature file is written.
+
+        :type settings: Settings
         :rtype: list[DataInstance]
         """
+    if settings is None:
+        settings = get_settings(kwargs)
 
-    os.makedirs(os.path.dirname(feat_path), exist_ok=True)
+    if feat_path is None:
+        return extract_instances(fd, None, keep=keep, settings=settings, **kwargs)
 
-    if kwargs.get('gzip'):
-        train_f = GzipFile(feat_path, 'w')
-    else:
-        train_f = open(feat_path, 'wb')
+    # The feature file is only moved into place once
+    # it is complete, and is removed if anything fails.
+    os.makedirs(os.path.dirname(feat_path), exist_ok=True)
+    with AtomicFile(feat_path, 'wb') as feat_f:
+        if kwargs.get('gzip'):
+            with GzipFile(fileobj=feat_f.f, mode='wb') as train_f:
+                return extract_instances(fd, train_f, keep=keep, settings=settings, **kwargs)
+        return extract_instances(fd, feat_f.f, keep=keep, settings=settings, **kwargs)
 
-    fi = FrekiInfo(fonts=fd.fonts(),
-                   llxs=fd.llxs())
+def extract_instances(fd, train_f, keep=None, settings=None, **kwargs):
+    """
+    Extract the features of each line of a document, for
+    write_instances(), writing them to train_f if it is
+    not None.
 
+    :type settings: Settings
+    :rtype: list[DataInstance]
+    """
     # 1) Start by getting the features for this
     #    particular line...
     feat_dict = {}
     data_instances = []
     lines = list(fd.lines())
+    labels = settings.label_table()
 
     prev_words = None
+    if train_f is not None:
+        train_f.write('{}\n'.format(LINE_FEATS_HEADER).encode(encoding='utf-8'))
+
+    # Time spent in each stage, summed over the lines.
+    text_time = 0.
+    write_time = 0.
+
+    tokens = token_cache(kwargs)
+    plan = kwargs.get('plan')
+    use_overlap = settings.word_overlap and \
+        any(wants(plan, f) for f in ['high_overlap', 'med_overlap', 'no_overlap'])
+
+    # The freki features are computed for the
+    # whole document at once.
+    freki_feats = None
+    if settings.freki_feats_enabled:
+        with METRICS.stage(STAGE_FREKI_FEATS):
+            freki_feats = get_doc_frekifeats(FrekiInfo.from_doc(fd, lines), settings=settings, **kwargs)
+
+    for line_no, line in enumerate(lines):
+        if keep is not None and not keep[line_no]:
+            prev_words = None
+            continue
 
-    for line in lines:
-        if getbool(kwargs, 'text_feats_enabled'):
-            cur_words = list(split_words(line))
+        start = time.perf_counter()
+        if settings.text_feats_enabled:
+            line_tokens = tokens.line_tokens(line)
+            cur_words = [token.word for token in line_tokens]
             cur_line_length = len(cur_words)
 
-            feat_dict[line.lineno] = get_textfeats(line, cur_words, **kwargs)
+            feat_dict[line.lineno] = get_textfeats(line, cur_words, tokens=line_tokens, settings=settings, **kwargs)
 
             # Check overlap with previous line.
             # if the number of overlapping words is above a threshold,
             # fire this feature.
-            if kwargs.get('word_overlap') and prev_words is not None and cur_line_length > 0:
-                high_overlap = float(kwargs.get('high_overlap', 0.25))
-                med_overlap = float(kwargs.get('med_overlap', 0.1))
-
+            if use_overlap and prev_words is not None and cur_line_length > 0:
                 # Calculate the overlap
                 overlapping_words = 0
                 for cur_word in cur_words:
@@ -462,20 +762,26 @@ def write_instances(fd, feat_path, **kwargs):
 
                 overlapping_ratio = overlapping_words / cur_line_length
 
-                if overlapping_ratio > high_overlap:
+                if overlapping_ratio > settings.high_overlap:
                     feat_dict[line.lineno]['high_overlap'] = True
-                if overlapping_ratio > med_overlap:
+                if overlapping_ratio > settings.med_overlap:
                     feat_dict[line.lineno]['med_overlap'] = True
                 if overlapping_ratio == 0:
                     feat_dict[line.lineno]['no_overlap'] = True
 
             prev_words = set(cur_words)
 
+        text_time += time.perf_counter() - start
+
+        if freki_feats is not None:
+            feat_dict.setdefault(line.lineno, {}).update(freki_feats[line_no])
 
-        if getbool(kwargs, 'freki_feats_enabled'):
-            feat_dict[line.lineno].update(get_frekifeats(line, fi, **kwargs))
+    # 2) Now, add the prev/next line data as necessary. Each
+    #    line's own features are kept once, and the windowed
+    #    features of each line are views onto them.
+    doc_feats = DocFeatures([feat_dict.get(line.lineno, {}) for line in lines],
+                            settings.window)
 
-    # 2) Now, add the prev/next line data as necessary
     for line_no, line in enumerate(lines):
         # Skip noisy (preceded with '*') tagged lines
         label = line.tag
@@ -503,33 +809,37 @@ def write_instances(fd, feat_path, **kwargs):
 
             line.tag = label
 
-        all_feats = get_all_line_feats(feat_dict, line.lineno, **kwargs)
-
-        # Add the previous line's tag, if enabled.
-        if getbool(kwargs, T_PREV_TAG):
+        # Add the previous line's tag, if enabled. It
+        # is not copied to the neighbouring lines.
+        if settings.prev_tag:
             prev_tag = 'O'
             if line_no > 0:
                 prev_tag = lines[line_no-1].tag
 
-            all_feats[prev_label_feat(prev_tag)] = True
+            doc_feats.local_feats[line_no][prev_label_feat(prev_tag)] = True
 
         # Write out the training vector with the full label
-        li = DataInstance(label, all_feats)
-        write_training_vector(li, train_f)
+        if train_f is not None:
+            start = time.perf_counter()
+            li = DataInstance(label, doc_feats.line_feats[line_no])
+            write_training_vector(li, train_f, local_feats=doc_feats.local_feats[line_no])
+            write_time += time.perf_counter() - start
 
         # Return the instance with the rewritten label, according
         # to the settings.
-        li = DataInstance(handle_label(label, **kwargs), all_feats)
+        li = DataInstance(labels.normalize(label), doc_feats.feats(line_no))
         data_instances.append(li)
 
-    train_f.close()
+    METRICS.add_time(STAGE_TEXT_FEATS, text_time)
+    METRICS.add_time(STAGE_WRITE, write_time)
     return data_instances
 
 
-def write_training_vector(li, out=sys.stdout):
+def write_training_vector(li, out=sys.stdout, local_feats=None):
     """
     :type li: StringInstance
     :type out: TextIOBase
+    :param local_feats: Features to write after LOCAL_FEATS_SEP.
     """
     out.write('{:s}'.format(li.label).encode(encoding='utf-8'))
     for feat in sorted(li.feats.keys()):
@@ -537,65 +847,17 @@ def write_training_vector(li, out=sys.stdout):
         val_str = 1 if val else 0
         if val_str:
             out.write('\t{}:{}'.format(feat, val_str).encode(encoding='utf-8'))
+    if local_feats:
+        out.write('\t{}'.format(LOCAL_FEATS_SEP).encode(encoding='utf-8'))
+        for feat in sorted(local_feats.keys()):
+            if local_feats[feat]:
+                out.write('\t{}:1'.format(feat).encode(encoding='utf-8'))
     out.write('\n'.encode(encoding='utf-8'))
 
 
 # =============================================================================
 # FEATURES
 # =============================================================================
-def isindented(line, fi):
-    """
-    :type line: FrekiLine
-    :type fi: FrekiInfo
-    :rtype: bool
-    """
-    # Is the line's indenting greater than that
-    # for the overall document.
-    return line.block.llx > fi.llx
-
-def has_smaller_font(line, fi):
-    """
-    :type line: FrekiLine
-    :type fi: FrekiInfo
-    :rtype: bool
-    """
-    for font in line.fonts:
-        if font.f_size < fi.def_font.f_size:
-            return True
-    return False
-
-def has_larger_font(line, fi):
-    """
-    :type line: FrekiLine
-    :type fi: FrekiInfo
-    :rtype: bool
-    """
-    for font in line.fonts:
-        if font.f_size > fi.def_font.f_size:
-            return True
-    return False
-
-# ISCORE
-def iscore(line, thresh, gt=True):
-    """
-    :type line: FrekiLine
-    """
-    line_iscore = float(line.attrs.get('iscore', 0.0))
-
-    is_greater = line_iscore >= thresh
-
-    return is_greater if gt else not is_greater
-
-def has_nondefault_font(line, fi):
-    """
-    :type line: FrekiLine
-    :type fi: FrekiInfo
-    :rtype: bool
-    """
-    # Get the "default" font
-    return bool(set(line.fonts) - set([fi.def_font]))
-
-
 def has_grams(line, gram_list, gram_list_cased):
     """
     :type line: str
@@ -753,24 +1015,32 @@ def clean_word(s):
 # constitutes being too dissimilar.
 # -------------------------------------------
 
-def med_en_oov_rate(words, en_wl=None, **kwargs):
-    """:type words: FrekiLine"""
-    return HIGH_OOV_THRESH(conf) > oov_rate(en_wl, words) > MED_OOV_THRESH(conf)
+def med_en_oov_rate(words, settings, en_wl=None, **kwargs):
+    """:type words: FrekiLine
+    :type settings: Settings
+    """
+    return settings.high_oov > oov_rate(en_wl, words) > settings.med_oov
 
 
-def high_en_oov_rate(words, en_wl=None, **kwargs):
-    """:type words: FrekiLine"""
-    return oov_rate(en_wl, words) >= HIGH_OOV_THRESH(conf)
+def high_en_oov_rate(words, settings, en_wl=None, **kwargs):
+    """:type words: FrekiLine
+    :type settings: Settings
+    """
+    return oov_rate(en_wl, words) >= settings.high_oov
 
 
-def high_gls_oov_rate(words, gls_wl=None, **kwargs):
-    """:type words: FrekiLine"""
-    return oov_rate(gls_wl, words) > HIGH_OOV_THRESH(conf)
+def high_gls_oov_rate(words, settings, gls_wl=None, **kwargs):
+    """:type words: FrekiLine
+    :type settings: Settings
+    """
+    return oov_rate(gls_wl, words) > settings.high_oov
 
 
-def high_met_oov_rate(words, gls_wl=None, **kwargs):
-    """:type words: FrekiLine"""
-    return oov_rate(gls_wl, words) > HIGH_OOV_THRESH(conf)
+def high_met_oov_rate(words, settings, gls_wl=None, **kwargs):
+    """:type words: FrekiLine
+    :type settings: Settings
+    """
+    return oov_rate(gls_wl, words) > settings.high_oov
 
 
 def oov_rate(wl, words):
@@ -796,9 +1066,16 @@ def oov_rate(wl, words):
 # -------------------------------------------
 
 def parse_langnames(**kwargs):
+    return read_langnames(kwargs.get(LNG_NAMES))
+
+
+def read_langnames(lang_path):
+    """
+    Read the language names from the file at lang_path.
 
+    :rtype: set[str]
+    """
     langs = set([])
-    lang_path = kwargs.get(LNG_NAMES)
     if lang_path and not os.path.exists(lang_path):
         LOG.critical('Language name file "{}" could not be found.'.format(lang_path))
         sys.exit(2)
@@ -834,26 +1111,6 @@ def has_quotation(line):
     return bool(line.search('[\'\"‘`“]\S+\s+.+[\'\"’”]'))
 
 
-def is_first_page(line, *args):
-    """:type line: FrekiLine"""
-    return line.block.page == 1
-
-def same_block(cur_line, other_line):
-    if other_line is None:
-        return False
-    else:
-        return cur_line.block.block_id == other_line.block.block_id
-
-def prev_line_same_block(line, *args):
-    """:type line: FrekiLine"""
-    prev_line = line.doc.get_line(line.lineno-1)
-    return same_block(line, prev_line)
-
-def next_line_same_block(line, *args):
-    """:type line: FrekiLine"""
-    next_line = line.doc.get_line(line.lineno+1)
-    return same_block(line, next_line)
-
 # -------------------------------------------
 # TRAIN THE CLASSIFIER
 # -------------------------------------------
@@ -873,13 +1130,15 @@ def label_sort(l):
 # Train the classifier given a list of files
 # =============================================================================
 def train_classifier(cw, data, classifier_path=None, debug_on=False,
-                     max_features=None, **kwargs):
+                     max_features=None, feature_selection=SELECT_CHI2, **kwargs):
     """
-    Train the classifier based on the input files in filelist.
+    Train the classifier on the feature rows accumulated
+    during feature extraction.
 
-    :type cw: ClassifierWrapper
-    :type data: list[DataInstance]
+    :type cw: SparseLogisticRegressionWrapper
+    :type data: SparseMatrixBuilder
     :type max_features: int
+    :param feature_selection: How to pick the max_features features, either by chi2 or document frequency.
     """
 
 
@@ -892,14 +1151,18 @@ def train_classifier(cw, data, classifier_path=None, debug_on=False,
 
     start_time = time.time()
 
-    LOG.log(NORM_LEVEL, "Beginning classifier training")
-    cw.train(data, num_feats=max_features)
+    LOG.log(NORM_LEVEL, "Beginning classifier training on {} lines with {} features".format(len(data), len(data.index)))
+    with METRICS.stage(STAGE_TRAIN):
+        cw.train_matrix(data.matrix(), data.labels, data.index,
+                        num_feats=max_features, selection=feature_selection or SELECT_CHI2)
     stop_time = time.time()
     LOG.log(NORM_LEVEL,
             'Training finished in "{:.2g}" seconds.'.format(
                 stop_time - start_time))
 
-    # Save the classifier.
+    # Save the classifier, along with the
+    # context window it was trained with.
+    cw.context_window = get_settings(kwargs).window.spec
     LOG.log(NORM_LEVEL, 'Writing classifier out to "{}"'.format(classifier_path))
     cw.save(classifier_path)
 
@@ -978,9 +1241,9 @@ def partial_matches(eval_spans, gold_spans, mode):
 
 
 class Evaluator(object):
-    def __init__(self):
+    def __init__(self, codes=LABEL_CODES):
         self.se = SpanEvaluator()
-        self.le = LabelEvaluator()
+        self.le = LabelEvaluator(codes)
 
 class SpanEvaluator(object):
     def __init__(self):
@@ -1013,6 +1276,22 @@ class SpanEvaluator(object):
     def partial_fmeasure(self): return f_measure(self.partial_precision(), self.partial_recall())
     def partial_prf(self): return self.partial_precision(), self.partial_recall(), self.partial_fmeasure()
 
+    _state_keys = ['exact_matches', 'partial_precision_matches', 'partial_recall_matches',
+                   'gold_spans', 'system_spans']
+
+    def state(self):
+        """
+        The counts, to be merged with those
+        of other shards.
+
+        :rtype: dict
+        """
+        return {k: getattr(self, k) for k in self._state_keys}
+
+    def add_state(self, state):
+        for k in self._state_keys:
+            setattr(self, k, getattr(self, k) + state[k])
+
 
 class LabelEvaluator(object):
     """
@@ -1022,47 +1301,75 @@ class LabelEvaluator(object):
     some ways less helpful.
     """
 
-    def __init__(self):
-        self._matrix = defaultdict(partial(defaultdict, int))
+    def __init__(self, codes=LABEL_CODES):
+        """
+        :param codes: The codes of the labels to be counted.
+        :type codes: LabelCodes
+        """
+        self.codes = codes
+
+        # The confusion matrix, indexed by
+        # the gold and guessed label codes.
+        self._counts = np.zeros((0, 0), dtype=np.int64)
 
     def add_eval_pair(self, gold, guess):
         """
         For a given line number, catalog it.
         """
-        self._matrix[gold][guess] += 1
+        self.add_eval_codes([self.codes.code(gold)], [self.codes.code(guess)])
 
         self.last_guess = guess
         self.last_gold = gold
 
+    def add_eval_codes(self, gold_codes, guess_codes, counts=1):
+        """
+        Catalog a whole array of gold and guessed label codes,
+        each pair seen once, or the given number of times.
+        """
+        num_codes = len(self.codes)
+        if num_codes > len(self._counts):
+            new_counts = np.zeros((num_codes, num_codes), dtype=np.int64)
+            new_counts[:len(self._counts), :len(self._counts)] = self._counts
+            self._counts = new_counts
+        np.add.at(self._counts, (np.asarray(gold_codes, dtype=np.int64),
+                                 np.asarray(guess_codes, dtype=np.int64)), counts)
+
+    def state(self):
+        """
+        The counts, as [gold, guess, count] triples, to
+        be merged with those of other shards.
+
+        :rtype: list[list]
+        """
+        return [[self.codes.label(gold), self.codes.label(guess), int(self._counts[gold, guess])]
+                for gold, guess in zip(*np.nonzero(self._counts))]
+
+    def add_state(self, state):
+        if state:
+            gold, guess, counts = zip(*state)
+            self.add_eval_codes([self.codes.code(l) for l in gold], [self.codes.code(l) for l in guess],
+                                np.asarray(counts, dtype=np.int64))
+
+    def _count(self, gold, guess):
+        return int(self._counts[self.codes.code(gold), self.codes.code(guess)])
+
     def _matches(self, exclude=list()):
-        return [self._matrix[gold][gold] for gold in self._labels() if gold not in exclude]
+        return [self._count(gold, gold) for gold in self._labels() if gold not in exclude]
 
     def _gold_sums(self, exclude=list()):
-        gold_totals = defaultdict(int)
-        for gold in self._matrix.keys():
-            if gold in exclude:
-                continue
-            for guess in self._matrix[gold]:
-                gold_totals[gold] += self._matrix[gold][guess]
-        return [gold_totals[l] for l in self._labels()]
+        gold_totals = self._counts.sum(axis=1)
+        return [0 if l in exclude else int(gold_totals[self.codes.code(l)]) for l in self._labels()]
 
     def _guess_sums(self, exclude=list()):
-        guess_totals = defaultdict(int)
-        for gold in self._matrix.keys():
-            for guess in self._matrix[gold]:
-                if guess in exclude:
-                    continue
-                guess_totals[guess] += self._matrix[gold][guess]
-
-        return [guess_totals[l] for l in self._labels()]
+        guess_totals = self._counts.sum(axis=0)
+        return [0 if l in exclude else int(guess_totals[self.codes.code(l)]) for l in self._labels()]
 
     def _recalls(self):
         return [matches / sums if sums > 0 else 0 for matches, sums in zip(self._matches(), self._gold_sums())]
 
     def _labels(self):
-        return sorted(set(self._matrix.keys()) | set(
-            [inner_key for outer_key in self._matrix.keys() for inner_key in self._matrix[outer_key].keys()]),
-                      key=label_sort)
+        seen = (self._counts.sum(axis=0) > 0) | (self._counts.sum(axis=1) > 0)
+        return sorted([self.codes.label(c) for c in np.flatnonzero(seen)], key=label_sort)
 
     # -------------------------------------------
     # Functions for calculate per-label
@@ -1094,7 +1401,7 @@ class LabelEvaluator(object):
             return 2 * (self.precision(exclude) * self.recall(exclude)) / denom
 
     def _vals(self):
-        return [[self._matrix[gold][label] for gold in self._labels()] for label in self._labels()]
+        return [[self._count(gold, label) for gold in self._labels()] for label in self._labels()]
 
     def matrix(self, csv=False):
         # Switch the delimiter from tab to comma
@@ -1106,8 +1413,8 @@ class LabelEvaluator(object):
         ret_str = '{} COLS: Gold --- ROWS: Predicted\n'.format(delimiter)
         ret_str += delimiter.join([''] + ['{:4}'.format(l) for l in self._labels()]) + '\n'
         for label in self._labels():
-            vals = [self._matrix[gold][label] for gold in self._labels()]
-            matches = self._matrix[label][label]
+            vals = [self._count(gold, label) for gold in self._labels()]
+            matches = self._count(label, label)
             compares = sum(vals)
             precision = matches / compares if compares > 0 else 0
             ret_str += delimiter.join([label] + ['{:4}'.format(v) for v in vals] + ['{:.2f}'.format(precision)]) + '\n'
@@ -1120,41 +1427,96 @@ class LabelEvaluator(object):
 # Testing (Apply Classifier to new Documents)
 # =============================================================================
 
-def get_classifications(docdata_list, cw, **kwargs):
+def get_classifications(docdata_list, cw, expander=None, **kwargs):
     """
     Given a list of files, return an iterator for the classifications.
 
     :type docdata_list: list[DocData]
+    :param expander: For a sparse model, the expander to build its rows with, if already built.
+    :type expander: ContextExpander
     :rtype: Iterable[tuple[DocData,list[Distribution]]]
     """
 
+    # The sparse models can have the windowed rows built
+    # directly as feature ids.
+    settings = get_settings(kwargs)
+    if expander is None and isinstance(cw, SparseClassifierWrapper):
+        expander = ContextExpander(cw.feat_index, settings.window, grow=False)
+
     for dd in docdata_list:
-        # If the file had no features, skip it...
-        if not dd.data:
-            LOG.error('No features found for file "{}"'.format(dd.path))
+        # A document with no lines still gets its (empty)
+        # output, so that it is written and journaled. If
+        # the file had no features otherwise, skip it...
+        if not dd.num_lines:
+            if next(iter(dd.doc.lines()), None) is None:
+                yield dd, []
+            else:
+                LOG.error('No features found for file "{}"'.format(dd.path))
             continue
 
         # If we are using the previous tag feature, pass the
         # function that returns 'prev_tag_L:1' etc. to the test
         # code.
-        prev_label_func = prev_label_feat if getbool(kwargs, T_PREV_TAG) else None
+        prev_label_func = prev_label_feat if settings.prev_tag else None
 
         # Block any of the "prev_tag" feats from being used from the loaded document; these should
         # be generated by the prev_label_func.
         feat_filter = lambda feat: not feat.startswith('prev_tag')
 
-        line_classifications = cw.test(dd.data, prev_label_func=prev_label_func, feat_filter=feat_filter)
+        # The sparse models time their vectorize and predict
+        # stages themselves. The previous tags are left out of
+        # the rows built by the expander.
+        if expander is not None and (dd.matrix is not None or dd.features is not None):
+            X = dd.matrix
+            if X is None:
+                with METRICS.stage(STAGE_CONTEXT):
+                    X = expander.matrix(dd.features, local=False)
+            classify = lambda start, stop: cw.test_matrix(X[start:stop], prev_label_func=prev_label_func)
+        elif isinstance(cw, SparseClassifierWrapper):
+            classify = lambda start, stop: cw.test(dd.data[start:stop], prev_label_func=prev_label_func,
+                                                   feat_filter=feat_filter)
+        else:
+            def classify(start, stop):
+                with METRICS.stage(STAGE_PREDICT):
+                    return cw.test(dd.data[start:stop], prev_label_func=prev_label_func, feat_filter=feat_filter)
+
+        if dd.keep is None:
+            line_classifications = classify(0, dd.num_lines)
+        else:
+            line_classifications = classify_kept(classify, dd.keep)
 
         yield dd, line_classifications
 
 
-def selfeval_docs(docdata_list, classifier_path=None, **kwargs):
+def classify_kept(classify, keep):
+    """
+    Classify each run of lines kept by the pre-filter
+    separately, as if the skipped lines between them had
+    been classified as "O", and label the skipped lines "O".
+
+    :param classify: Function classifying the lines in range(start, stop).
+    :type keep: np.ndarray
+    :rtype: list[Distribution]
+    """
+    dists = []
+    for start, stop in kept_runs(keep):
+        dists.extend(Distribution(O=1.0) for i in range(len(dists), start))
+        dists.extend(classify(start, stop))
+    dists.extend(Distribution(O=1.0) for i in range(len(dists), len(keep)))
+    return dists
+
+
+def selfeval_docs(docdata_list, classifier_path=None, cw=None, **kwargs):
     """
     Given a list of documents, run classification on each, and evaluate
     according to the original labels/spans given in the document itself.
+
+    :param cw: The classifier to use, if already loaded, rather than the one at classifier_path.
     """
 
-    cw = ClassifierWrapper.load(classifier_path)
+    if cw is None:
+        cw = load_classifier(classifier_path)
+    check_window(cw, get_settings(kwargs).window, name=classifier_path)
     results = get_classifications(docdata_list, cw, **kwargs)
 
     # We will now evaluate the classifications
@@ -1163,23 +1525,19 @@ def selfeval_docs(docdata_list, classifier_path=None, **kwargs):
     se = SpanEvaluator()
 
 
+    labels = get_settings(kwargs).label_table()
+
     for result in results:
         dd, dists = result
         dists = list(dists)
         line_data = dd.data
 
-        test_labels = []
-        gold_labels = []
-
         assert len(line_data) == len(dists)
-        for line_datum, dist in zip(line_data, dists):
-            gold_label = handle_label(line_datum.label, **kwargs).replace('*', '') # In case noisy label
-            test_label = handle_label(dist.best_class, **kwargs)
-
-            test_labels.append(test_label)
-            gold_labels.append(gold_label)
+        gold_codes = labels.encode(di.label for di in line_data)
+        test_codes = labels.encode(dist.best_class for dist in dists)
+        test_labels = labels.decode(test_codes)
 
-            le.add_eval_pair(gold_label, test_label)
+        le.add_eval_codes(gold_codes, test_codes)
 
         old_spans = dd.doc.spans().copy()
         assign_spans(dd.doc, test_labels)
@@ -1198,31 +1556,103 @@ def selfeval_docs(docdata_list, classifier_path=None, **kwargs):
 
 
 def classify_docs(docdata_list, classifier_path=None, debug_on=False,
-                  classified_dir=None, detected_dir=None, **kwargs):
+                  classified_dir=None, detected_dir=None, cw=None, journal=None, **kwargs):
     """
     :type docdata_list: list[DocData]
+    :param cw: The classifier to use, if already loaded, rather than the one at classifier_path.
+    :type journal: RunJournal
     """
 
-    cw = ClassifierWrapper.load(classifier_path)
+    if cw is None:
+        cw = load_classifier(classifier_path)
     classes = sorted(cw.classes(), key=label_sort)
 
     results = get_classifications(docdata_list, cw, **kwargs)
 
     for dd, dists in results:
-        assert isinstance(dd, DocData)
+        write_classified(dd, dists, classes, debug_on=debug_on,
+                         classified_dir=classified_dir, detected_dir=detected_dir, journal=journal)
 
-        # -------------------------------------------
-        # Get ready to write the classified IGT instances out.
-        # The "classified_dir" is for the full files, with "O"
-        # lines, the "detected_dir" is only for contiguous, non-O lines.
-        # -------------------------------------------
+
+def model_doc(dd, model):
+    """
+    The document as a model sees it. The lines of a
+    document extracted for several models are windowed
+    with the widest of their windows, so for a model
+    with another window, they are windowed again with
+    its own. The sparse models window the lines' own
+    features themselves.
+
+    :type dd: DocData
+    :type model: HostedModel
+    :rtype: DocData
+    """
+    # The rows the workers built for each model of
+    # the group are swapped in as its turn comes, so
+    # that the document is still only parsed once.
+    if dd.matrices is not None:
+        dd.matrix = dd.matrices[model.name]
+        return dd
+
+    features = dd.features
+    window = model.settings.window
+    if model.expander is not None or features is None or features.window.offsets == window.offsets:
+        return dd
+    doc_feats = DocFeatures(features.line_feats, window, features.local_feats)
+    data = [DataInstance(di.label, doc_feats.feats(i)) for i, di in enumerate(dd.data)]
+    return DocData(data, dd.doc, dd.path, keep=dd.keep)
+
+
+def classify_group(docdata_list, group, journal=None):
+    """
+    Classify each document with every model in the
+    group, off the one set of features extracted for
+    them all, and write out each model's output to its
+    own directories. A document is only added to the
+    journal once every model's output for it is written.
+
+    :type docdata_list: Iterable[DocData]
+    :type group: ModelGroup
+    :type journal: RunJournal
+    """
+    for dd in docdata_list:
+        for model in group:
+            for model_dd, dists in get_classifications([model_doc(dd, model)], model.cw,
+                                                       expander=model.expander, **model.kwargs):
+                write_classified(model_dd, dists, model.classes, debug_on=model.kwargs.get('debug_on'),
+                                 classified_dir=model.classified_dir, detected_dir=model.detected_dir,
+                                 journal=journal if group.is_last(model) else None)
+
+
+def write_classified(dd, dists, classes, debug_on=False, classified_dir=None, detected_dir=None,
+                     journal=None):
+    """
+    Write out the classifications of a document. The
+    output files only appear once they are complete,
+    after which the document is added to the journal.
+
+    :type dd: DocData
+    :type dists: list[Distribution]
+    :param classes: The classifier's classes, in the order to write them to the debug file.
+    :type journal: RunJournal
+    """
+    assert isinstance(dd, DocData)
+    write_start = time.perf_counter()
+
+    # -------------------------------------------
+    # Get ready to write the classified IGT instances out.
+    # The "classified_dir" is for the full files, with "O"
+    # lines, the "detected_dir" is only for contiguous, non-O lines.
+    # -------------------------------------------
+    classified_f = detected_f = None
+    try:
         if classified_dir:
             os.makedirs(classified_dir, exist_ok=True)
-            classified_f = open(get_classified_path(dd.path, classified_dir), 'w', encoding='utf-8')
+            classified_f = AtomicFile(get_classified_path(dd.path, classified_dir), encoding='utf-8')
 
         if detected_dir:
             os.makedirs(detected_dir, exist_ok=True)
-            detected_f = open(get_detected_path(dd.path, detected_dir), 'w', encoding='utf-8')
+            detected_f = AtomicFile(get_detected_path(dd.path, detected_dir), encoding='utf-8')
 
         # -------------------------------------------
 
@@ -1246,7 +1676,6 @@ def classify_docs(docdata_list, classifier_path=None, debug_on=False,
         new_tags = []
 
         for line, dist in zip(old_lines, dists):
-            assert isinstance(dist, Distribution)
 
             # Write the line number and classification probabilities to the debug file.
             if debug_on:
@@ -1279,31 +1708,42 @@ def classify_docs(docdata_list, classifier_path=None, debug_on=False,
         if classified_dir:
             assign_spans(dd.doc, new_tags)
             classified_f.write(str(dd.doc))
-            classified_f.close()
+            classified_f.commit()
 
         if detected_dir:
-            detected_f.close()
             if total_detected == 0:
-                os.unlink(get_detected_path(dd.path, detected_dir))
+                detected_f.discard()
+                if os.path.exists(detected_f.path):
+                    os.unlink(detected_f.path)
+            else:
+                detected_f.commit()
 
         if debug_on:
             raw_classification_f.close()
+    except BaseException:
+        # Leave no temporary files behind.
+        for f in [classified_f, detected_f]:
+            if f is not None:
+                f.discard()
+        raise
+
+    if journal is not None:
+        journal.record(doc_id(dd.path))
+
+    METRICS.add_time(STAGE_WRITE, time.perf_counter() - write_start)
 
 
-def eval_files(filelist, out_path=None, csv=False, gold_dir=None, **kwargs):
+def eval_files(filelist, out_path=None, csv=False, gold_dir=None, shard=None, state_out=None, **kwargs):
     """
     Given a list of target files, evaluate them against
     the files given in the gold dir.
 
     If the gold dir does not exist, or does not contain
     the specified file, make sure to log an error.
-    """
-    # Set up the output stream
-    if out_path is None:
-        out_f = sys.stdout
-    else:
-        out_f = open(out_path, 'w')
 
+    For a shard, the counts are also written out to
+    state_out, for the merge subcommand to combine.
+    """
     if not os.path.exists(gold_dir):
         LOG.critical('The gold file directory "{}" is missing or is unavailable.'.format(GOLD_DIR(conf)))
         sys.exit(2)
@@ -1323,6 +1763,29 @@ def eval_files(filelist, out_path=None, csv=False, gold_dir=None, **kwargs):
         else:
             eval_file(eval_path, gold_path, ev=ev, old_se=old_se, **kwargs)
 
+    if shard is not None:
+        state_out = state_out or eval_state_path(shard, out_path)
+        LOG.log(NORM_LEVEL, 'Writing the evaluation state of shard {} to "{}"'.format(shard_str(shard), state_out))
+        write_eval_state(state_out, shard, {'labels': ev.le.state(),
+                                            'spans': ev.se.state(),
+                                            'auto_spans': old_se.state()})
+
+    write_eval_report(ev, old_se, out_path=out_path, csv=csv)
+
+
+def write_eval_report(ev, old_se, out_path=None, csv=False):
+    """
+    Write out the label and span scores.
+
+    :type ev: Evaluator
+    :type old_se: SpanEvaluator
+    """
+    # Set up the output stream
+    if out_path is None:
+        out_f = sys.stdout
+    else:
+        out_f = open(out_path, 'w')
+
     # Now, write out the sc results.
     delimiter = '\t'
     if csv:
@@ -1343,8 +1806,60 @@ def eval_files(filelist, out_path=None, csv=False, gold_dir=None, **kwargs):
     out_f.write(
         'Partial-span P/R/F: {}\n'.format(delimiter.join(['{:.2f}'.format(x) for x in old_se.partial_prf()])))
 
+    if out_f is not sys.stdout:
+        out_f.close()
+    else:
+        out_f.flush()
+
+
+def merge_shards(args):
+    """
+    Combine the manifests and evaluation states
+    written by the shards of a run.
+    """
+    manifests = []
+    states = []
+    for path in args.get('shard_files'):
+        try:
+            if path.endswith('.json'):
+                states.append(read_eval_state(path))
+            else:
+                manifests.append(read_manifest(path))
+        except (ValueError, KeyError, OSError) as e:
+            LOG.critical('Could not read shard file "{}": {}'.format(path, e))
+            sys.exit(2)
 
-    out_f.close()
+    for kind, results in [('manifests', manifests), ('evaluation states', states)]:
+        if not results:
+            continue
+        shards = [shard for shard, result in results]
+        if len(set(n for k, n in shards)) > 1:
+            LOG.critical('The {} are from runs split into different numbers of shards.'.format(kind))
+            sys.exit(2)
+        missing, repeated = missing_shards(shards)
+        if repeated:
+            LOG.critical('Shards {} are given more than once in the {}.'.format(repeated, kind))
+            sys.exit(2)
+        if missing:
+            LOG.warning('Shards {} are missing from the {}; the result is incomplete.'.format(missing, kind))
+
+    if manifests:
+        out_paths = sorted(set(p for shard, paths in manifests for p in paths))
+        manifest_out = args.get('manifest_out') or 'manifest.txt'
+        LOG.log(NORM_LEVEL, 'Writing the {} outputs of {} shards to "{}"'.format(
+            len(out_paths), len(manifests), manifest_out))
+        with AtomicFile(manifest_out, encoding='utf-8') as f:
+            for p in out_paths:
+                f.write(p + '\n')
+
+    if states:
+        ev = Evaluator()
+        old_se = SpanEvaluator()
+        for shard, state in states:
+            ev.le.add_state(state['labels'])
+            ev.se.add_state(state['spans'])
+            old_se.add_state(state['auto_spans'])
+        write_eval_report(ev, old_se, out_path=args.get('out_path'), csv=args.get('csv'))
 
 
 
@@ -1369,10 +1884,11 @@ def eval_file(eval_path, gold_path, ev=None, old_se=None, outstream=sys.stdout,
         # -------------------------------------------
         # Compare the labels across lines.
         # -------------------------------------------
-        for line in eval_fd.lines():
-            eval_label = handle_label(eval_fd.get_line(line.lineno).tag, **kwargs).replace('TB','O').replace('V','O')
-            gold_label = handle_label(gold_fd.get_line(line.lineno).tag, **kwargs)
-            ev.le.add_eval_pair(gold_label, eval_label)
+        eval_lines = list(eval_fd.lines())
+        settings = get_settings(kwargs)
+        eval_codes = settings.label_table(transform=eval_label).encode(line.tag for line in eval_lines)
+        gold_codes = settings.label_table().encode(gold_fd.get_line(line.lineno).tag for line in eval_lines)
+        ev.le.add_eval_codes(gold_codes, eval_codes)
 
         # -------------------------------------------
         # Compare spans
@@ -1409,21 +1925,15 @@ def flatten(seq):
 # -------------------------------------------
 # ARG TYPES
 # -------------------------------------------
-def globfiles(pathname):
-    """:rtype: Iterable[str]"""
-    g = glob.glob(pathname)
-    if not g:
-        raise ArgumentTypeError(
-            'No files found matching pattern "{}".\nCheck that the path is valid and that containing directories exist.'.format(
-                pathname))
-    else:
-        paths = []
-        for path in g:
-            if os.path.isdir(path):
-                paths.extend([os.path.join(path, p) for p in os.listdir(path)])
-            else:
-                paths.append(path)
-        return flatten(paths)
+def globfiles(pathname, manifest=None):
+    """
+    The files matching the glob pattern (searching any
+    directories it matches recursively), or listed in the
+    manifest, found lazily as they are iterated over.
+
+    :rtype: FileList
+    """
+    return file_list(pattern=pathname, manifest=manifest)
 
 def split_words(sent):
     for w_m in re.finditer('\w+', sent, flags=re.UNICODE):
@@ -1433,24 +1943,45 @@ def split_words(sent):
         yield w.replace(':','').replace('#','')
 
 
+def add_training_rows(builder, dd, expander, skip_noisy=False):
+    """
+    Add the lines of a document to the training matrix,
+    leaving out the noisy ones if skip_noisy is set.
+
+    :type builder: SparseMatrixBuilder
+    :type dd: DocData
+    :type expander: ContextExpander
+    """
+    labels = list(dd.labels())
+    keep = [not (label.startswith('*') and skip_noisy) for label in labels]
+    labels = [label.replace('*', '') for label in labels]
+
+    if dd.features is not None:
+        with METRICS.stage(STAGE_CONTEXT):
+            indptr, indices = expander.rows(dd.features)
+        builder.add_rows(indptr, indices, labels=labels, keep=keep)
+    else:
+        for label, feats, k in zip(labels, dd.feats(), keep):
+            if k:
+                builder.add_instance(label, feats)
+
+
 def nfold_traintest(doc_data, test_data, classifier_path=None, **kwargs):
     """
     :type doc_data: list[DocData]
     :type test_data: list[DocData]
     """
-    cw = LogisticRegressionWrapper()
-    training_instances = []
+    cw = SparseLogisticRegressionWrapper()
+    training_instances = SparseMatrixBuilder(index=make_feature_index(kwargs.get('hash_bits')))
+    expander = ContextExpander(training_instances.index, get_settings(kwargs).window)
 
     # When we run the overall nfold feature extraction, we include
     # noisy labels.
     for doc_datum in doc_data:
-        for line_datum in doc_datum.data:
-            if line_datum.label.startswith('*') and kwargs.get('skip_noisy'):
-                continue
-            training_instances.append(line_datum)
+        add_training_rows(training_instances, doc_datum, expander, skip_noisy=kwargs.get('skip_noisy'))
 
     train_classifier(cw, training_instances, classifier_path=classifier_path, **kwargs)
-    return selfeval_docs(test_data, classifier_path=classifier_path, **kwargs)
+    return selfeval_docs(test_data, cw=cw, **kwargs)
 
 
 def true_val(s):
@@ -1468,31 +1999,642 @@ def true_val(s):
 # =============================================================================
 
 def train(args, fl):
+    if args.get('continue_training'):
+        return train_incremental(args, fl)
     if os.path.exists(args.get('classifier_path')) and not args.get('overwrite_model'):
         LOG.critical('Classifier model file "{}" exists, and overwrite not forced. Aborting training.'.format(
             args.get('classifier_path')))
         sys.exit(2)
-    cw = LogisticRegressionWrapper()
+    if args.get('incremental'):
+        return train_incremental(args, fl)
+    cw = SparseLogisticRegressionWrapper()
     doc_data = extract_feats(fl, **args)
 
-    training_data = []
+    # Intern each document's features into the training
+    # matrix as it is extracted, so that only the integer
+    # feature ids are kept around, rather than every
+    # document's feature dicts.
+    training_data = SparseMatrixBuilder(index=make_feature_index(args.get('hash_bits')))
+    expander = ContextExpander(training_data.index, get_settings(args).window)
     for doc_datum in doc_data:
-        for line_datum in doc_datum.data:
-            if line_datum.label.startswith('*') and args.get('skip_noisy'):
-                continue
-            else:
-                line_datum.label = line_datum.label.replace('*', '')
-
-            training_data.append(line_datum)
+        add_training_rows(training_data, doc_datum, expander, skip_noisy=args.get('skip_noisy'))
 
     train_classifier(cw, training_data, **args)
 
+def train_incremental(args, fl):
+    """
+    Train the classifier by minibatch SGD over the lines as
+    they are streamed from extract_feats, so that the training
+    set never needs to be held in memory.
+
+    Unless features are hashed, a new model first makes one
+    pass over the documents to fix its feature space, selecting
+    max_features features if set. With continue_training, the
+    existing model at classifier_path is updated instead,
+    keeping its features and classes.
+    """
+    classifier_path = args.get('classifier_path')
+    batch_size = int(args.get('batch_size') or 1000)
+    epochs = int(args.get('epochs') or 1)
+
+    def training_rows(doc_data, expander):
+        """Yield the label and feature ids of each training line."""
+        for doc_datum in doc_data:
+            rows = SparseMatrixBuilder(index=expander.index)
+            add_training_rows(rows, doc_datum, expander, skip_noisy=args.get('skip_noisy'))
+            X = rows.matrix()
+            for i, label in enumerate(rows.labels):
+                yield label, X.indices[X.indptr[i]:X.indptr[i + 1]]
+
+    if args.get('continue_training'):
+        if not os.path.exists(classifier_path):
+            LOG.critical('Cannot continue training: classifier model file "{}" does not exist.'.format(classifier_path))
+            sys.exit(2)
+        old_cw = load_classifier(classifier_path)
+        if not isinstance(old_cw, SparseClassifierWrapper):
+            LOG.critical('The classifier model "{}" was not trained by igtdetect and cannot be updated.'.format(classifier_path))
+            sys.exit(2)
+        check_window(old_cw, get_settings(args).window, name=classifier_path)
+        cw = SGDLogisticRegressionWrapper.from_model(old_cw)
+        LOG.log(NORM_LEVEL, 'Continuing training of "{}"'.format(classifier_path))
+    else:
+        cw = SGDLogisticRegressionWrapper()
+        feat_index = make_feature_index(args.get('hash_bits'))
+        max_features = int(args.get('max_features') or -1)
+
+        # Hashed features need no vocabulary, so unless features
+        # are being selected, training can start right away.
+        if isinstance(feat_index, FeatureIndex) or max_features > 0:
+            LOG.log(NORM_LEVEL, "Collecting the feature space for incremental training")
+            counts = FeatureCounter(index=feat_index)
+            expander = ContextExpander(counts.index, get_settings(args).window)
+            for label, feat_ids in training_rows(extract_feats(fl, **args), expander):
+                counts.add_row(feat_ids, label)
+            feat_index = counts.select(max_features, method=args.get('feature_selection') or SELECT_CHI2)
+
+            # The features were just written out, so read
+            # them back rather than extracting them again.
+            args = dict(args, overwrite=False)
+
+        cw.init_weights(feat_index)
+
+    LOG.log(NORM_LEVEL, "Beginning incremental training with {} features".format(len(cw.feat_index)))
+    start_time = time.time()
+    known_labels = set(cw.classes()) if args.get('continue_training') else None
+    skipped = 0
+    expander = ContextExpander(cw.feat_index, get_settings(args).window, grow=False)
+    for epoch in range(epochs):
+        batch = SparseMatrixBuilder(index=cw.feat_index)
+        for label, feat_ids in training_rows(extract_feats(fl, **args), expander):
+            if known_labels is not None and label not in known_labels:
+                skipped += 1
+                continue
+            batch.add_row(feat_ids, label)
+            if len(batch) >= batch_size:
+                cw.partial_fit(batch.matrix(), np.asarray(batch.labels))
+                batch = SparseMatrixBuilder(index=cw.feat_index)
+        cw.partial_fit(batch.matrix(), np.asarray(batch.labels))
+        args = dict(args, overwrite=False)
+
+    if skipped:
+        LOG.warning('Skipped {} lines with labels unknown to the model.'.format(skipped))
+    LOG.log(NORM_LEVEL,
+            'Training finished in "{:.2g}" seconds.'.format(time.time() - start_time))
+
+    cw.context_window = get_settings(args).window.spec
+    LOG.log(NORM_LEVEL, 'Writing classifier out to "{}"'.format(classifier_path))
+    cw.save(classifier_path)
+
 def test(args, fl):
     LOG.log(NORM_LEVEL, "Beginning classification...")
-    doc_data = extract_feats(fl, testing=True, **args)
-    classify_docs(doc_data, **args)
+    models = hosted_models(args)
+    if args.get('stdin'):
+        if len(models) > 1:
+            LOG.critical('Only one model can classify a stream; choose one of {} with --models.'.format(
+                ', '.join(models.names)))
+            sys.exit(2)
+        test_stream(args, next(iter(models)))
+        LOG.log(NORM_LEVEL, "Classification complete.")
+        return
+    journal = get_journal(args)
+    all_fl = fl
+    fl = unfinished_files(fl, journal)
+
+    # Each group of models is extracted for in one
+    # pass; the journal is only kept by the last.
+    groups = models.groups()
+    for i, group in enumerate(groups):
+        group_journal = journal if i == len(groups) - 1 else None
+        if len(models) > 1:
+            LOG.log(NORM_LEVEL, 'Classifying with the models: {}'.format(', '.join(group.names)))
+        if int(args.get('extract_processes') or 0) > 0:
+            test_pipeline(args, fl, group, journal=group_journal)
+        else:
+            doc_data = extract_feats(fl, testing=True, prefilter=get_prefilter(args), plan=group.plan,
+                                     **group.kwargs)
+            classify_group(doc_data, group, journal=group_journal)
+    if journal is not None:
+        journal.close()
+    for model in models:
+        write_shard_manifest(model.kwargs, all_fl)
     LOG.log(NORM_LEVEL, "Classification complete.")
 
+def write_shard_manifest(args, fl):
+    """
+    For a sharded run, list the classified outputs of
+    the shard, for the merge subcommand to combine.
+    """
+    shard = args.get('shard')
+    classified_dir = args.get('classified_dir')
+    if shard is None or not classified_dir:
+        return
+    out_paths = [get_classified_path(path, classified_dir) for path in fl]
+    path = manifest_path(classified_dir, shard)
+    LOG.log(NORM_LEVEL, 'Writing the manifest of shard {} to "{}"'.format(shard_str(shard), path))
+    write_manifest(path, shard, [p for p in out_paths if os.path.exists(p)])
+
+def shard_files(fl, shard):
+    """
+    Keep only the files in the shard, if one is given.
+
+    :type fl: FileList|list[str]
+    :rtype: FileList|list[str]
+    """
+    if shard is None:
+        return fl
+    k, n = shard
+    in_shard = lambda path: shard_of(shard_key(path), n) == k
+    if isinstance(fl, FileList):
+        LOG.log(NORM_LEVEL, 'Shard {}: keeping the documents that hash into it.'.format(shard_str(shard)))
+        return fl.filter(in_shard)
+    kept = [path for path in fl if in_shard(path)]
+    LOG.log(NORM_LEVEL, 'Shard {}: {} of {} documents.'.format(shard_str(shard), len(kept), len(fl)))
+    return kept
+
+def test_stream(args, model, instream=None, outstream=None):
+    """
+    Classify the freki documents streamed in on stdin,
+    writing each one to stdout as soon as it is done,
+    either as classified freki or as a line of JSON
+    with its detected spans. Nothing is written to the
+    feature, classified or detected dirs.
+
+    :type model: HostedModel
+    """
+    instream = instream if instream is not None else io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    outstream = outstream if outstream is not None else sys.stdout
+    out_format = args.get('stdout_format') or OUT_FREKI
+
+    prefilter = get_prefilter(args)
+    scratch_dir = make_scratch_dir(args.get('scratch_dir'))
+    kwargs = dict(model.kwargs, testing=True, plan=model.plan, prefilter=prefilter, save_feats=False)
+    try:
+        for doc_id, text in read_freki_stream(instream):
+            doc_path = stream_doc_path(scratch_dir, doc_id, text)
+            try:
+                dd = DocData.load(doc_path, **kwargs)
+            finally:
+                os.unlink(doc_path)
+
+            METRICS.count(COUNT_DOCS)
+            METRICS.count(COUNT_LINES, dd.num_lines)
+            if dd.keep is not None:
+                METRICS.count(COUNT_SKIPPED_LINES, dd.num_skipped)
+            METRICS.progress(LOG, NORM_LEVEL)
+
+            for dd, dists in get_classifications([dd], model.cw, expander=model.expander, **model.kwargs):
+                with METRICS.stage(STAGE_WRITE):
+                    lines = list(dd.doc.lines())
+                    tags = [dist.best_class for dist in dists]
+                    for line, tag in zip(lines, tags):
+                        line.tag = tag
+                    if out_format == OUT_SPANS:
+                        outstream.write(span_record(doc_id, lines, tags) + '\n')
+                    elif not lines:
+                        # A document with no lines goes out as it came
+                        # in, so that every input has its output.
+                        outstream.write(text if text.endswith('\n') else text + '\n')
+                    else:
+                        assign_spans(dd.doc, tags)
+                        doc_str = str(dd.doc)
+                        outstream.write(doc_str if doc_str.endswith('\n') else doc_str + '\n')
+                    outstream.flush()
+    finally:
+        remove_scratch_dir(scratch_dir)
+
+def get_journal(args):
+    """
+    Open the run journal, kept in the journal_path or
+    else in the output directory. With resume set, the
+    documents already finished are kept in it.
+
+    :rtype: RunJournal
+    """
+    journal_path = args.get('journal_path')
+    if not journal_path:
+        out_dir = args.get('classified_dir') or args.get('detected_dir')
+        if not out_dir:
+            return None
+        journal_path = os.path.join(out_dir, JOURNAL_NAME)
+    try:
+        return RunJournal(journal_path, resume=getbool(args, 'resume'))
+    except OSError as oe:
+        LOG.critical('Could not open the run journal "{}": {}'.format(journal_path, oe))
+        sys.exit(2)
+
+def unfinished_files(fl, journal):
+    """
+    Leave out the files of the documents
+    already finished according to the journal.
+
+    :rtype: list[str]
+    """
+    if journal is None or not len(journal):
+        return fl
+    unfinished = lambda path: doc_id(path) not in journal
+    if isinstance(fl, FileList):
+        LOG.log(NORM_LEVEL, 'Resuming: skipping the {} documents already classified.'.format(len(journal)))
+        return fl.filter(unfinished)
+    remaining = [path for path in fl if unfinished(path)]
+    LOG.log(NORM_LEVEL, 'Resuming: skipping {} of {} documents already classified.'.format(
+        len(fl) - len(remaining), len(fl)))
+    return remaining
+
+def get_plan(cw):
+    """
+    Return the extraction plan for the features the
+    classifier can use, or None if they can't be listed.
+
+    :rtype: ExtractionPlan
+    """
+    plan = ExtractionPlan.from_model(cw)
+    if plan is None:
+        LOG.info('The features of a hashed model cannot be listed; extracting every enabled feature.')
+    else:
+        LOG.info('Extracting only the {} line features the model can use.'.format(len(plan)))
+    return plan
+
+def check_window(cw, window, name=DEFAULT_MODEL):
+    """
+    Warn if a model is used with a different context window
+    from the one it was trained with, as then the neighbouring
+    lines' features do not land on the columns it learned.
+
+    :type window: ContextWindow
+    """
+    trained = getattr(cw, 'context_window', None)
+    if trained is not None and parse_context_window(trained) != window:
+        LOG.warning('The model "{}" was trained with the context window "{}", but is being used with "{}".'.format(
+            name, trained, window.spec))
+
+def hosted_model(name, path, kwargs, pool=RESOURCES):
+    """
+    Load a model, through the pool so that a model named
+    twice is only loaded once, along with what is needed
+    to classify with it.
+
+    :type kwargs: dict
+    :rtype: HostedModel
+    """
+    if not path or not os.path.exists(path):
+        LOG.critical('The model "{}" at "{}" does not exist.'.format(name, path))
+        sys.exit(2)
+    cw = pool.get(path, load_classifier)
+    check_window(cw, get_settings(kwargs).window, name=name)
+    expander = None
+    if isinstance(cw, SparseClassifierWrapper):
+        expander = ContextExpander(cw.feat_index, get_settings(kwargs).window, grow=False)
+    return HostedModel(name, path, cw, kwargs, plan=get_plan(cw),
+                       classes=sorted(cw.classes(), key=label_sort), expander=expander)
+
+def hosted_models(args, pool=RESOURCES):
+    """
+    Load the models to classify with: those in the [models]
+    config section and given with --model, or only those
+    chosen with --models, or if there are none, the single
+    model at classifier_path.
+
+    Each named model is used with the options in its
+    [model.NAME] config section over the rest, and writes
+    to a subdirectory of the output directories named for
+    it. Resources named by several models are only loaded
+    once, through the pool.
+
+    :type pool: ResourcePool
+    :rtype: ModelRegistry
+    """
+    specs = OrderedDict(conf.items(MODELS_SECTION)) if conf.has_section(MODELS_SECTION) else OrderedDict()
+    specs.update(args.get('model_specs') or [])
+
+    registry = ModelRegistry()
+    if not specs:
+        registry.add(hosted_model(DEFAULT_MODEL, args.get('classifier_path'), args, pool=pool))
+        return registry
+
+    chosen = args.get('models') or list(specs.keys())
+    for name in chosen:
+        if name not in specs:
+            LOG.critical('No model named "{}"; the models are: {}'.format(name, ', '.join(specs.keys())))
+            sys.exit(2)
+
+    for name in chosen:
+        section = model_section(name)
+        kwargs = dict(args, **dict(conf.items(section))) if conf.has_section(section) else dict(args)
+        for out_dir in ['classified_dir', 'detected_dir']:
+            if args.get(out_dir) and not (conf.has_section(section) and conf.has_option(section, out_dir)):
+                kwargs[out_dir] = os.path.join(args[out_dir], name)
+        load_resources(kwargs, pool=pool)
+        kwargs['settings'] = Settings.compile(kwargs, conf)
+        LOG.log(NORM_LEVEL, 'Loading the model "{}" from "{}"'.format(name, specs[name]))
+        registry.add(hosted_model(name, specs[name], kwargs, pool=pool))
+    LOG.log(NORM_LEVEL, 'Hosting {} models, in {} extraction groups; {} resources loaded.'.format(
+        len(registry), len(registry.groups()), len(pool)))
+    return registry
+
+# -------------------------------------------
+# Pipelined classification
+#
+# With extract_processes set, test runs as a pipeline:
+# reader threads pull the documents off disk, a pool of
+# processes extracts their features, the classifier labels
+# them in batches, and a writer thread writes them out,
+# all at the same time.
+#
+# So that one large document at the end of the run doesn't
+# leave the other workers idle, the largest files are sent
+# first (the largest of the next largest_first_window, so the
+# whole file list need not be read before the first is sent),
+# and any document of more than chunk_lines lines is split
+# into chunks that are extracted by several workers.
+# Each extraction thread takes the next task from the one
+# queue as soon as it is free, so no worker sits idle while
+# there is work left.
+# -------------------------------------------
+_worker_kwargs = None
+_worker_expanders = None
+_worker_scratch = None
+
+def _init_extract_worker(kwargs, worker_args, indexes=None, scratch_dir=None):
+    """
+    Set up the globals of an extraction worker process.
+    With the feature indexes and windows of a group of
+    sparse models, the worker sends back the rows of
+    each document for each model as SharedRows.
+
+    :type indexes: list[tuple[FeatureIndex,ContextWindow]]
+    """
+    global _worker_kwargs, _worker_expanders, _worker_scratch, args
+    args = worker_args
+    _worker_kwargs = dict(kwargs, prefilter=get_prefilter(kwargs))
+    if indexes:
+        _worker_expanders = [ContextExpander(feat_index, window, grow=False) for feat_index, window in indexes]
+        _worker_scratch = scratch_dir
+
+def _extract_doc(path):
+    """
+    Extract the features of a document in a worker
+    process, returning the worker's timings with it.
+
+    :rtype: tuple[DocData|list[SharedRows], Metrics]
+    """
+    METRICS.reset()
+    dd = DocData.load(path, **_worker_kwargs)
+    if _worker_expanders and dd.features is not None:
+        with METRICS.stage(STAGE_CONTEXT):
+            # The pre-filter's mask goes with the first model's rows.
+            return [SharedRows.write(_worker_scratch, expander.matrix(dd.features, local=False), path,
+                                     keep=dd.keep if i == 0 else None)
+                    for i, expander in enumerate(_worker_expanders)], METRICS
+    return dd, METRICS
+
+def _extract_chunk(path, index, count):
+    """
+    Extract the features of one chunk of a document
+    in a worker process.
+
+    :rtype: tuple[DocChunk|list[SharedRows], Metrics]
+    """
+    METRICS.reset()
+    chunk = DocChunk.load(path, index, count, **_worker_kwargs)
+    if _worker_expanders:
+        with METRICS.stage(STAGE_CONTEXT):
+            return [SharedRows.write(_worker_scratch, chunk.matrix(expander), path,
+                                     keep=chunk.keep if i == 0 else None, index=index, count=count)
+                    for i, expander in enumerate(_worker_expanders)], METRICS
+    return chunk, METRICS
+
+def read_ahead(path, chunk_size=1 << 20):
+    """
+    Read a file through once, so that it is in the page
+    cache by the time the extraction worker parses it,
+    and return the number of lines in it.
+
+    :rtype: int
+    """
+    num_lines = 0
+    with (GzipFile(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+        data = f.read(chunk_size)
+        while data:
+            num_lines += data.count(b'\n')
+            data = f.read(chunk_size)
+    return num_lines
+
+def extraction_tasks(path, chunk_lines=0, **kwargs):
+    """
+    Split a document into (path, index, count) chunks
+    of around chunk_lines lines. Documents whose features
+    will be loaded from a feature file are not split.
+
+    :rtype: list[tuple[str,int,int]]
+    """
+    num_lines = read_ahead(path)
+    chunk_lines = int(chunk_lines or 0)
+    if chunk_lines <= 0 or num_lines <= chunk_lines or \
+            (not kwargs.get('overwrite') and os.path.exists(get_feat_path(path, gzip=kwargs.get('gzip', True)))):
+        return [(path, 0, 1)]
+    count = -(-num_lines // chunk_lines)
+    return [(path, i, count) for i in range(count)]
+
+def test_pipeline(args, fl, group, journal=None):
+    """
+    Classify the files with the staged pipeline, and
+    report how busy each stage was.
+
+    :param group: The models to classify with, off one extraction of each document.
+    :type group: ModelGroup
+    :type journal: RunJournal
+    """
+    worker_kwargs = dict(group.kwargs, testing=True, plan=group.plan)
+    window = group.settings.window
+    skipped = [0]
+
+    if getbool(args, 'largest_first'):
+        fl = largest_first(fl, lookahead=int(args.get('largest_first_window') or 1000))
+
+    def extract(task):
+        path, index, count = task
+        if count == 1:
+            return pool.apply(_extract_doc, (path,))
+        return pool.apply(_extract_chunk, task)
+
+    # The chunks of each document, until they have all arrived.
+    partial = {}
+
+    def assemble(result):
+        item, worker_metrics = result
+        METRICS.merge(worker_metrics)
+        if isinstance(item, DocData):
+            return item
+        first = item if isinstance(item, DocChunk) else item[0]
+        if first.count > 1:
+            chunks = partial.setdefault(first.path, [])
+            chunks.append(item)
+            if len(chunks) < first.count:
+                return None
+            del partial[first.path]
+        else:
+            chunks = [item]
+
+        if isinstance(item, DocChunk):
+            return DocChunk.assemble(chunks, window)
+
+        # Map the rows the workers left behind for each model.
+        chunks.sort(key=lambda c: c[0].index)
+        matrices = OrderedDict()
+        keep = None
+        for i, model in enumerate(group):
+            mapped = [c[i].read(len(model.cw.feat_index)) for c in chunks]
+            matrices[model.name] = mapped[0][0] if len(mapped) == 1 else \
+                sparse_vstack([m[0] for m in mapped], format='csr')
+            if i == 0:
+                keep = join_keep([m[1] for m in mapped])
+        return DocData([], None, first.path, keep=keep, matrices=matrices)
+
+    def classify(batch):
+        docs = []
+        for dd in batch:
+            METRICS.count(COUNT_DOCS)
+            METRICS.count(COUNT_LINES, dd.num_lines)
+            if dd.keep is not None:
+                METRICS.count(COUNT_SKIPPED_LINES, dd.num_skipped)
+                skipped[0] += dd.num_skipped
+            docs.append(dd)
+        METRICS.progress(LOG, NORM_LEVEL)
+        results = []
+        for dd in docs:
+            for model in group:
+                results.extend((model, model_dd, dists) for model_dd, dists in get_classifications(
+                    [model_doc(dd, model)], model.cw, expander=model.expander, **model.kwargs))
+        return results
+
+    def write(result):
+        model, dd, dists = result
+        write_classified(dd, dists, model.classes, debug_on=model.kwargs.get('debug_on'),
+                         classified_dir=model.classified_dir, detected_dir=model.detected_dir,
+                         journal=journal if group.is_last(model) else None)
+
+    # When every model of the group is sparse, the workers
+    # build each model's rows themselves, and leave them
+    # in scratch files.
+    indexes, scratch_dir = None, None
+    if all(model.expander is not None for model in group):
+        indexes = [(model.cw.feat_index, model.settings.window) for model in group]
+        scratch_dir = make_scratch_dir(args.get('scratch_dir'))
+
+    num_procs = int(args.get('extract_processes'))
+    pool = Pool(num_procs, initializer=_init_extract_worker,
+                initargs=(worker_kwargs, globals().get('args'), indexes, scratch_dir))
+    try:
+        pipeline = Pipeline([Stage('read', lambda path: extraction_tasks(path, **args),
+                                   workers=int(args.get('readers') or 1), fan_out=True),
+                             Stage('extract', extract, workers=num_procs),
+                             Stage('assemble', assemble),
+                             Stage('classify', classify, batch_size=int(args.get('classify_batch') or 1)),
+                             Stage('write', write)],
+                            queue_size=int(args.get('queue_size') or 16))
+        pipeline.run(fl)
+    finally:
+        pool.terminate()
+        if scratch_dir is not None:
+            remove_scratch_dir(scratch_dir)
+
+    if get_prefilter(args) is not None:
+        lines = METRICS.counters[COUNT_LINES]
+        LOG.log(NORM_LEVEL, 'Pre-filter skipped {} of {} lines ({:.1%}).'.format(
+            skipped[0], lines, skipped[0] / lines if lines else 0))
+    for line in pipeline.report_lines():
+        LOG.log(NORM_LEVEL, line)
+    METRICS.set_pipeline_report(pipeline.report())
+
+def get_prefilter(args):
+    """
+    Return the pre-filter set up in the [prefilter]
+    settings, or None if it is not enabled.
+
+    :rtype: Prefilter
+    """
+    try:
+        return Prefilter.from_kwargs(args)
+    except ValueError as ve:
+        LOG.critical(str(ve))
+        sys.exit(2)
+
+
+def watch(args):
+    """
+    Keep the models loaded, and classify the freki files
+    dropped into the spool directory as they arrive.
+    """
+    spool_dir = args.get('spool_dir')
+    if not spool_dir or not os.path.isdir(spool_dir):
+        LOG.critical('The spool directory "{}" does not exist.'.format(spool_dir))
+        sys.exit(2)
+
+    groups = hosted_models(args).groups()
+    prefilter = get_prefilter(args)
+    watcher = SpoolWatcher(spool_dir, done_dir=args.get('done_dir'), failed_dir=args.get('failed_dir'),
+                           poll_interval=args.get('poll_interval') or 2.,
+                           batch_size=args.get('watch_batch') or 32,
+                           batch_wait=args.get('batch_wait') or 0.,
+                           once=args.get('once'))
+
+    # Finish the batch in hand before stopping.
+    def stop(signum, frame):
+        LOG.log(NORM_LEVEL, 'Stopping after the current batch...')
+        watcher.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def classify_batch(batch):
+        for group in groups:
+            # A file dropped in again under the same name must not
+            # be classified from the features saved for the last one.
+            doc_data = extract_feats(batch, testing=True, prefilter=prefilter, plan=group.plan,
+                                     **dict(group.kwargs, save_feats=False))
+            classify_group(doc_data, group)
+
+    LOG.log(NORM_LEVEL, 'Watching "{}" for new documents...'.format(spool_dir))
+    for batch in watcher.batches():
+        start = time.perf_counter()
+        try:
+            classify_batch(batch)
+            watcher.done(batch)
+        except Exception as e:
+            # Find the files that failed by
+            # classifying them one at a time.
+            LOG.error('Classifying a batch of {} documents failed ({}); retrying them one by one.'.format(len(batch), e))
+            for path in batch:
+                try:
+                    classify_batch([path])
+                    watcher.done([path])
+                except Exception as e:
+                    LOG.error('Could not classify "{}": {}'.format(path, e))
+                    watcher.failed([path])
+        LOG.log(NORM_LEVEL, 'Classified {} documents in {:.2f} seconds.'.format(len(batch), time.perf_counter() - start))
+
+    LOG.log(NORM_LEVEL, 'Stopped watching "{}".'.format(spool_dir))
+
+
 def testdb(args):
     """
     Uses the specified database to
@@ -1544,9 +2686,17 @@ def testdb(args):
                     found_files.append(os.path.join(root_dir, doc_id_m.group(0)))
 
     LOG.log(NORM_LEVEL, "Beginning classification.")
-    docdata = extract_feats(found_files, **args)
+    cw = load_classifier(args.get('classifier_path'))
+    check_window(cw, get_settings(args).window, name=args.get('classifier_path'))
+    found_files = shard_files(found_files, args.get('shard'))
+    journal = get_journal(args)
+    todo_files = unfinished_files(found_files, journal)
+    docdata = extract_feats(todo_files, testing=True, prefilter=get_prefilter(args), plan=get_plan(cw), **args)
 
-    classify_docs(docdata, **args)
+    classify_docs(docdata, cw=cw, journal=journal, **args)
+    if journal is not None:
+        journal.close()
+    write_shard_manifest(args, found_files)
 
 
 
@@ -1570,12 +2720,126 @@ def getinfo(args):
     classifier.
     """
     classifier_path = args.get('classifier_path')
-    cw = ClassifierWrapper.load(classifier_path)
+    cw = load_classifier(classifier_path)
 
     show_weights(cw, args.get('num_feats', 100))
     # for w in show_weights(cw, 100):
     #     print(w)
 
+def export_model(args):
+    """
+    Write the classifier out in the compact,
+    memory-mappable model format.
+    """
+    classifier_path = args.get('classifier_path')
+    out_path = args.get('out_path')
+    if os.path.exists(out_path) and not args.get('overwrite_model'):
+        LOG.critical('Output model "{}" exists, and overwrite not forced. Aborting export.'.format(out_path))
+        sys.exit(2)
+
+    LOG.log(NORM_LEVEL, 'Exporting classifier "{}" to "{}"'.format(classifier_path, out_path))
+    export_compact(load_classifier(classifier_path), out_path)
+
+# -------------------------------------------
+# Feature profiling
+# -------------------------------------------
+CONTEXT_PREFIXES = (PREV_PREFIX, NEXT_PREFIX)
+
+
+def base_feature(feat_name):
+    """
+    Return the name of the feature in T_LIST or F_LIST
+    that produced the named (possibly prev_/next_ prefixed)
+    feature, or None if it wasn't one of them.
+    """
+    known = set(T_LIST) | set(F_LIST)
+    name = feat_name
+    while True:
+        if name in known:
+            return name
+        elif name.startswith('word_'):
+            return T_BASIC
+        elif name.startswith(F_INDENT_BUCKET + '_'):
+            return F_INDENT_BUCKET
+        elif name.startswith(CONTEXT_PREFIXES):
+            name = name[name.index('_') + 1:]
+        else:
+            return None
+
+
+def profile_features(args, fl):
+    """
+    Extract features from the given files, and report the
+    cost of each feature in T_LIST and F_LIST in time per
+    line, alongside how often it fires and its share of the
+    classifier's weights, to help decide which features are
+    worth their cost.
+    """
+    sample_size = args.get('sample_size')
+    if sample_size:
+        fl = islice(fl, sample_size)
+    docs = 0
+
+    METRICS.time_features = True
+    feat_list = list(OrderedDict.fromkeys(T_LIST + F_LIST))
+    feat_set = set(feat_list)
+    fired = Counter()
+    lines = 0
+
+    # Feature files are always rewritten here, so
+    # that the extraction is actually timed.
+    for dd in extract_feats(fl, **dict(args, overwrite=True)):
+        docs += 1
+        for di in dd.data:
+            lines += 1
+            line_fired = set([])
+            for feat, value in di.feats.items():
+                if not value:
+                    continue
+                if feat in feat_set:
+                    line_fired.add(feat)
+                elif not feat.startswith(CONTEXT_PREFIXES):
+                    base = base_feature(feat)
+                    if base is not None:
+                        line_fired.add(base)
+            fired.update(line_fired)
+
+    # -------------------------------------------
+    # Sum the absolute weights in the model for each
+    # feature, including its prev_/next_ copies.
+    # -------------------------------------------
+    weights = Counter()
+    classifier_path = args.get('classifier_path')
+    if classifier_path and os.path.exists(classifier_path):
+        for c, feat, weight in model_weights(load_classifier(classifier_path)):
+            base = base_feature(feat)
+            if base is not None:
+                weights[base] += abs(weight)
+    else:
+        LOG.warning('No classifier found at "{}"; weights will not be reported.'.format(classifier_path))
+    total_weight = sum(weights.values())
+
+    settings = get_settings(args)
+    enabled = settings.text_feats | settings.freki_feats
+    rows = []
+    for feat in feat_list:
+        seconds, calls = METRICS.features.get(feat, (0., 0))
+        rows.append((feat,
+                     feat in enabled,
+                     1e6 * seconds / lines if lines else 0.,
+                     fired[feat] / lines if lines else 0.,
+                     weights[feat] / total_weight if total_weight else 0.))
+    rows.sort(key=lambda row: (row[1], row[2]), reverse=True)
+
+    print('{:<24}{:>8}{:>14}{:>12}{:>12}'.format('feature', 'enabled', 'usec/line', 'fire rate', 'weight'))
+    for feat, is_enabled, usec, fire_rate, weight in rows:
+        print('{:<24}{:>8}{:>14.2f}{:>12.3f}{:>12.3f}'.format(feat, 'yes' if is_enabled else 'no',
+                                                              usec, fire_rate, weight))
+    LOG.log(NORM_LEVEL, 'Profiled {} features over {} lines in {} documents.'.format(
+        len(enabled), lines, docs))
+    return rows
+
+
 def nfold(args, fl):
     ratio = float(args.get('nfold_ratio', 0.9))
     iters = int(args.get('nfold_iters', 10))
@@ -1583,11 +2847,12 @@ def nfold(args, fl):
     dir = args.get('nfold_dir', os.getcwd())
 
     # Set a random seed to shuffle the data
-    r = Random()
-    r.seed(seed)
+    rng = np.random.RandomState(None if seed in (None, '') else int(seed))
 
-    # Next, shuffle the filelist
-    r.shuffle(fl)
+    # Next, shuffle the filelist, or if only a sample
+    # of it is to be used, draw the sample as it is read.
+    sample = int(args.get('nfold_sample') or 0)
+    fl = reservoir_sample(fl, sample, rng) if sample > 0 else shuffled(fl, rng)
 
     # Now, get the train/test windows
     num_docs = len(fl)
@@ -1689,6 +2954,14 @@ def pre_run():
                                default=True)
     common_parser.add_argument('--debug-dir', dest='debug_dir', help="Path for various debug files.")
     common_parser.add_argument('--debug', type=true_val, default=0)
+    common_parser.add_argument('--context-window', type=parse_context_window,
+                               help='Offsets of the neighbouring lines whose features are used, '
+                                    'e.g. --context-window=-2..+1 (with "=", as the value starts with "-").')
+    common_parser.add_argument('--metrics-out', help='Write a JSON report of timings and counts for the run.')
+    common_parser.add_argument('--prometheus-out',
+                               help='Write the run metrics in the Prometheus text format, for the textfile collector.')
+    common_parser.add_argument('--progress-interval', type=float, default=30,
+                               help='Seconds between progress lines while processing documents. [0: off]')
 
     # -------------------------------------------
     # Append extra config file onto args.
@@ -1711,7 +2984,9 @@ def pre_run():
     # the arguments in the parser.
     # -------------------------------------------
     for sec in conf.sections():
-        common_parser.set_defaults(**conf[sec])
+        # The model sections are read per model.
+        if not is_model_section(sec):
+            common_parser.set_defaults(**conf[sec])
 
     # -------------------------------------------
     # Try to add things from the pythonpath
@@ -1728,8 +3003,71 @@ def pre_run():
 # -------------------------------------------
 from freki.serialize import FrekiDoc, FrekiLine, FrekiFont
 
-from riples_classifier.models import ClassifierWrapper, StringInstance, DataInstance, Distribution, \
-    LogisticRegressionWrapper, show_weights
+from riples_classifier.models import StringInstance, DataInstance
+
+
+def read_wordlist(path):
+    """
+    Read a list of words, one per line.
+
+    :rtype: set[str]
+    """
+    grams = set([])
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                grams.add(line.strip())
+    return grams
+
+
+def load_resources(argdict, pool=RESOURCES):
+    """
+    Replace the paths to the gram lists and language
+    names in argdict with their contents. Each file is
+    loaded through the pool, so it is only read once
+    however many models use it, and anything already
+    loaded is left as it is.
+
+    :type argdict: dict
+    :type pool: ResourcePool
+    """
+    # -------------------------------------------
+    # Load Gramlists
+    # -------------------------------------------
+
+    gram_wl = argdict.get('gram_list')
+    gram_cased_wl = argdict.get('gram_list_cased')
+
+    if gram_wl is None:
+        LOG.warning("No gramlist file found.")
+    if gram_cased_wl is None:
+        LOG.warning("No cased gramlist file found.")
+
+    def read_wl(path):
+        if isinstance(path, set):
+            return path
+        if path and os.path.exists(path):
+            return pool.get(path, read_wordlist)
+        return set([])
+
+    gram_list = read_wl(gram_wl)
+    gram_list_cased = read_wl(gram_cased_wl)
+
+    argdict['gram_list'] = gram_list
+    argdict['gram_list_cased'] = gram_list_cased
+
+    if not gram_list:
+        LOG.warning("No grams found.")
+    if not gram_list_cased:
+        LOG.warning("No cased grams found.")
+
+    # -------------------------------------------
+    # Load langnames
+    # -------------------------------------------
+    lang_path = argdict.get(LNG_NAMES)
+    if not isinstance(lang_path, set):
+        argdict[LNG_NAMES] = pool.get(lang_path, read_langnames) if lang_path else read_langnames(lang_path)
+    return argdict
 
 
 def run(main_parser, common_parser):
@@ -1764,21 +3102,47 @@ def run(main_parser, common_parser):
     def get_glob(opt):
         return get_path(opt, fallback='')
 
+    # Whether an option was given on the command line, either
+    # on its own or as "--option=value", making another optional.
+    def given(*opts):
+        return any(arg == opt or arg.startswith(opt + '=') for arg in sys.argv for opt in opts)
+
     # -------------------------------------------
     # Set up a common parser to inherit for the functions
     # that require the classifier to be specified
     # -------------------------------------------
     tt_parser = ArgumentParser(add_help=False)
-    tt_parser.add_argument('--classifier-path', required=requires_path('classifier_path', exists=False),
+    tt_parser.add_argument('--classifier-path',
+                           required=requires_path('classifier_path', exists=False) and
+                                    not (conf.has_section(MODELS_SECTION) or given('--model')),
                            help='Path to the saved classifier model.', default=get_path('classifier_path'))
     tt_parser.add_argument('--overwrite-model', help='Overwrite previously created models', action='store_true')
 
+    # Parser for reading the input files from a manifest.
+    file_list_parser = ArgumentParser(add_help=False)
+    file_list_parser.add_argument('--file-list',
+                                  help='Manifest of the input files, one path per line (may be gzipped), '
+                                       'in place of the glob.')
+
+    # Parser for hosting several models in one process.
+    models_parser = ArgumentParser(add_help=False)
+    models_parser.add_argument('--model', dest='model_specs', action='append', type=parse_model_spec,
+                               metavar='NAME=PATH',
+                               help='Classify with the model at PATH as well, under NAME. May be repeated.')
+    models_parser.add_argument('--models', type=parse_model_names, metavar='NAME[,NAME...]',
+                               help='Only classify with these of the named models. [Default: all of them]')
+
+    # Parser for splitting a run across machines.
+    shard_parser = ArgumentParser(add_help=False)
+    shard_parser.add_argument('--shard', type=parse_shard,
+                              help='Only process the K-th of N shards of the documents, e.g. "2/4".')
+
     # Parser for combining evaluation arguments.
     ev_parser = ArgumentParser(add_help=False)
     ev_parser.add_argument('-o', '--output', dest='out_path', help='Output path to write result. [Default: stdout]')
     ev_parser.add_argument('--csv', help='Format the output as CSV.')
     ev_parser.add_argument('--eval-files', help='Files to evaluate against',
-                           required=requires_glob('eval_files'),
+                           required=requires_glob('eval_files') and not given('--file-list'),
                            default=get_glob('eval_files'))
     ev_parser.add_argument('--gold-dir', default=conf.get('paths', 'gold_dir', fallback=None), required=requires_opt('paths', 'gold_dir'))
 
@@ -1789,8 +3153,14 @@ def run(main_parser, common_parser):
     train_nf_parser.add_argument('--use-bi-labels', type=int, default=conf.get('labels', 'use_bi_labels', fallback=1))
     train_nf_parser.add_argument('--use-prev-tag', dest='prev_tag', type=true_val, default=conf.get('text_features', 'prev_tag'))
     train_nf_parser.add_argument('--max-features', type=int, default=conf.get('featuresets', 'max_features', fallback=-1))
+    train_nf_parser.add_argument('--hash-bits', type=int,
+                                 help='Hash features into 2^HASH_BITS columns rather than keeping a vocabulary. [0: off]',
+                                 default=conf.get('featuresets', 'hash_bits', fallback=0))
+    train_nf_parser.add_argument('--feature-selection', choices=SELECTION_METHODS,
+                                 help='Method used to select the max_features features.',
+                                 default=conf.get('featuresets', 'feature_selection', fallback=SELECT_CHI2))
     train_nf_parser.add_argument('--train-files', help='Path to the files for training the classifier.',
-                                 required=requires_glob('train_files'),
+                                 required=requires_glob('train_files') and not given('--file-list'),
                                  default=get_path('train_files'))
 
     # -------------------------------------------
@@ -1802,26 +3172,73 @@ def run(main_parser, common_parser):
     # -------------------------------------------
     # TRAINING
     # -------------------------------------------
-    train_p = subparsers.add_parser('train', parents=[common_parser, tt_parser, train_nf_parser])
+    train_p = subparsers.add_parser('train', parents=[common_parser, tt_parser, train_nf_parser, file_list_parser])
+    train_p.add_argument('--incremental', action='store_true',
+                         help='Train by minibatch SGD, streaming the training data rather than loading it all.')
+    train_p.add_argument('--continue-training', action='store_true',
+                         help='Update the existing model at the classifier path with the training files.')
+    train_p.add_argument('--batch-size', type=int, help='Minibatch size for incremental training.',
+                         default=conf.get('incremental', 'batch_size', fallback=1000))
+    train_p.add_argument('--epochs', type=int, help='Passes over the training files for incremental training.',
+                         default=conf.get('incremental', 'epochs', fallback=1))
+
+    # -------------------------------------------
+    # Output directories for classifying...
+    # -------------------------------------------
+    output_p = ArgumentParser(add_help=False)
+    output_p.add_argument('--classified-dir', help='Directory to output the classified documents.',
+                          required=requires_path('classified_dir'),
+                          default=get_path('classified_dir'))
+    output_p.add_argument('--detected-dir',
+                          required=requires_path('detected_dir'),
+                          default=get_path('detected_dir'))
 
     # -------------------------------------------
     # Common parser for testing...
     # -------------------------------------------
-    test_common_p = ArgumentParser(add_help=False)
-    test_common_p.add_argument('--classified-dir', help='Directory to output the classified documents.',
-                               required=requires_path('classified_dir'),
-                               default=get_path('classified_dir'))
-    test_common_p.add_argument('--detected-dir',
-                               required=requires_path('detected_dir'),
-                               default=get_path('detected_dir'))
+    test_common_p = ArgumentParser(add_help=False, parents=[shard_parser, output_p])
+    test_common_p.add_argument('--resume', action='store_true',
+                               help='Skip the documents that the run journal shows were already classified.')
+    test_common_p.add_argument('--journal', dest='journal_path',
+                               help='Path to the run journal. [Default: in the classified dir]',
+                               default=conf.get('paths', 'journal_path', fallback=None))
+    test_common_p.add_argument('--extract-processes', type=int,
+                               help='Run as a pipeline, extracting features in this many processes. [0: off]',
+                               default=conf.get('pipeline', 'extract_processes', fallback=0))
+    test_common_p.add_argument('--readers', type=int, help='Threads reading documents for the pipeline.',
+                               default=conf.get('pipeline', 'readers', fallback=2))
+    test_common_p.add_argument('--classify-batch', type=int,
+                               help='Maximum number of documents the pipeline classifies at once.',
+                               default=conf.get('pipeline', 'classify_batch', fallback=8))
+    test_common_p.add_argument('--chunk-lines', type=int,
+                               help='Split documents of more lines than this between the pipeline\'s '
+                                    'extraction processes. [0: off]',
+                               default=conf.get('pipeline', 'chunk_lines', fallback=5000))
+    test_common_p.add_argument('--largest-first', dest='largest_first', action='store_const', const=1,
+                               help='Send the largest files to the pipeline\'s extraction processes first.',
+                               default=conf.get('pipeline', 'largest_first', fallback=1))
+    test_common_p.add_argument('--no-largest-first', dest='largest_first', action='store_const', const=0,
+                               help='Send the files to the extraction processes in the order they are found.')
+    test_common_p.add_argument('--largest-first-window', type=int,
+                               help='Number of files ahead to look for the largest one to send next.',
+                               default=conf.get('pipeline', 'largest_first_window', fallback=1000))
+    test_common_p.add_argument('--queue-size', type=int,
+                               help='Maximum number of documents waiting between stages of the pipeline.',
+                               default=conf.get('pipeline', 'queue_size', fallback=16))
 
     # -------------------------------------------
     # TESTING
     # -------------------------------------------
-    test_p = subparsers.add_parser('test', parents=[common_parser, tt_parser, test_common_p])
+    test_p = subparsers.add_parser('test', parents=[common_parser, tt_parser, test_common_p, file_list_parser,
+                                                    models_parser])
     test_p.add_argument('--test-files', help='Path to the files to be classified.',
-                        required=requires_glob('test_files'),
+                        required=requires_glob('test_files') and not given('--stdin', '--file-list'),
                         default=get_path('test_files'))
+    test_p.add_argument('--stdin', action='store_true',
+                        help='Classify freki documents streamed in on stdin, writing them to stdout.')
+    test_p.add_argument('--stdout-format', choices=STREAM_FORMATS, default=OUT_FREKI,
+                        help='With --stdin, write classified freki, or one line of JSON with the '
+                             'detected spans per document. [Default: freki]')
 
 
     # -------------------------------------------
@@ -1831,10 +3248,46 @@ def run(main_parser, common_parser):
     test_db_p.add_argument('-d', '--db', help='Path to the doc classification database', required=True)
     test_db_p.add_argument('--search-path', help='Path in which to search for the doc_ids', required=True)
 
+    # -------------------------------------------
+    # WATCH
+    # -------------------------------------------
+    watch_p = subparsers.add_parser('watch', parents=[common_parser, tt_parser, output_p, models_parser],
+                                    help='Classify the documents dropped into a spool directory as they arrive.')
+    watch_p.add_argument('--spool-dir', help='Directory to watch for new freki files.',
+                         required=not conf.has_option('watch', 'spool_dir'),
+                         default=conf.get('watch', 'spool_dir', fallback=None))
+    watch_p.add_argument('--done-dir', help='Where to move classified files. [Default: SPOOL_DIR/done]',
+                         default=conf.get('watch', 'done_dir', fallback=None))
+    watch_p.add_argument('--failed-dir', help='Where to move files that could not be classified. '
+                                              '[Default: SPOOL_DIR/failed]',
+                         default=conf.get('watch', 'failed_dir', fallback=None))
+    watch_p.add_argument('--poll-interval', type=float, help='Seconds between scans of an empty spool.',
+                         default=conf.get('watch', 'poll_interval', fallback=2))
+    watch_p.add_argument('--watch-batch', type=int, help='Most documents to classify at once.',
+                         default=conf.get('watch', 'watch_batch', fallback=32))
+    watch_p.add_argument('--batch-wait', type=float,
+                         help='Seconds to wait for a burst of new documents to fill a batch.',
+                         default=conf.get('watch', 'batch_wait', fallback=0.5))
+    watch_p.add_argument('--once', action='store_true',
+                         help='Classify the documents in the spool, then stop.')
+
     # -------------------------------------------
     # EVAL
     # -------------------------------------------
-    eval_p = subparsers.add_parser('eval', parents=[common_parser, ev_parser])
+    eval_p = subparsers.add_parser('eval', parents=[common_parser, ev_parser, shard_parser, file_list_parser])
+    eval_p.add_argument('--state-out', help='Where to write the evaluation state of a shard. '
+                                            '[Default: eval-state-K-of-N.json, beside the output]')
+
+    # -------------------------------------------
+    # MERGE
+    # -------------------------------------------
+    merge_p = subparsers.add_parser('merge', parents=[common_parser],
+                                    help='Combine the manifests and evaluation states of sharded runs.')
+    merge_p.add_argument('shard_files', nargs='+',
+                         help='Shard manifests (manifest-K-of-N.txt) and evaluation states (*.json).')
+    merge_p.add_argument('-o', '--output', dest='out_path', help='Output path to write the evaluation. [Default: stdout]')
+    merge_p.add_argument('--csv', help='Format the evaluation as CSV.')
+    merge_p.add_argument('--manifest-out', help='Where to write the combined manifest. [Default: manifest.txt]')
 
     # -------------------------------------------
     # TESTEVAL
@@ -1850,8 +3303,11 @@ def run(main_parser, common_parser):
     # -------------------------------------------
     # NFOLD
     # -------------------------------------------
-    nfold_p = subparsers.add_parser('nfold', parents=[common_parser, tt_parser, train_nf_parser])
+    nfold_p = subparsers.add_parser('nfold', parents=[common_parser, tt_parser, train_nf_parser, file_list_parser])
     nfold_p.add_argument('--nfold-dir', help="Directory for nfold files")
+    nfold_p.add_argument('--nfold-sample', type=int,
+                         help='Only use a random sample of this many of the training files. [0: all]',
+                         default=conf.get('nfold', 'nfold_sample', fallback=0))
 
     # -------------------------------------------
     # INFO
@@ -1860,6 +3316,23 @@ def run(main_parser, common_parser):
     info_p.add_argument('--classifier-path', help='Path to the classifier')
     info_p.add_argument('--num-feats', help='Number of features to dump out', default=-1, type=int)
 
+    # -------------------------------------------
+    # EXPORT
+    # -------------------------------------------
+    export_p = subparsers.add_parser('export-model', parents=[common_parser, tt_parser])
+    export_p.add_argument('-o', '--output', dest='out_path', required=True,
+                          help='Directory to write the compact model to.')
+
+    # -------------------------------------------
+    # PROFILE FEATURES
+    # -------------------------------------------
+    profile_p = subparsers.add_parser('profile-features', parents=[common_parser, tt_parser, file_list_parser])
+    profile_p.add_argument('--profile-files', help='Files to run the feature extraction over.',
+                           required=requires_glob('train_files') and not given('--file-list'),
+                           default=get_path('train_files'))
+    profile_p.add_argument('--sample-size', type=int, default=0,
+                           help='Only profile the first SAMPLE_SIZE files. [0: all]')
+
     # -------------------------------------------
     # Check for Config
     # -------------------------------------------
@@ -1873,6 +3346,14 @@ def run(main_parser, common_parser):
     global args
     args = main_parser.parse_args()
 
+    # A stream is classified as it arrives, with no
+    # journal to resume from and nothing to shard.
+    if getattr(args, 'stdin', False):
+        for opt in ['--shard', '--resume', '--journal']:
+            if given(opt):
+                LOG.critical('{} cannot be used with --stdin.'.format(opt))
+                sys.exit(2)
+
 
     # -------------------------------------------
     # Construct a common dictionary of options.
@@ -1905,63 +3386,46 @@ def run(main_parser, common_parser):
     met_wl = load_wordlist(argdict, MET_WORDLIST)
 
     # -------------------------------------------
-    # Load Gramlists
+    # Load the gramlists and language names
     # -------------------------------------------
-
-    gram_wl = argdict.get('gram_list')
-    gram_cased_wl = argdict.get('gram_list_cased')
-
-    if gram_wl is None:
-        LOG.warning("No gramlist file found.")
-    if gram_cased_wl is None:
-        LOG.warning("No cased gramlist file found.")
-
-    def read_wl(path):
-        grams = set([])
-        if os.path.exists(path):
-            with open(path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    if line.strip():
-                        grams.add(line.strip())
-        return grams
-
-    gram_list = read_wl(gram_wl)
-    gram_list_cased = read_wl(gram_cased_wl)
-
-    argdict['gram_list'] = gram_list
-    argdict['gram_list_cased'] = gram_list_cased
-
-    if not gram_list:
-        LOG.warning("No grams found.")
-    if not gram_list_cased:
-        LOG.warning("No cased grams found.")
-
+    load_resources(argdict)
 
     # -------------------------------------------
-    # Load langnames
+    # Compile the settings used while extracting
+    # features and handling labels.
     # -------------------------------------------
-    argdict[LNG_NAMES] = parse_langnames(**argdict)
+    argdict['settings'] = Settings.compile(argdict, conf)
 
     # -------------------------------------------
     # Set up the different filelists.
     # -------------------------------------------
-    def globlist(arg):
+    # The --file-list manifest takes the place of
+    # the subcommand's main glob.
+    def globlist(arg, main=True):
         val = argdict.get(arg, [])
-        return globfiles(val)
+        return globfiles(val, manifest=argdict.get('file_list') if main else None)
 
     errors = False
     try:
-        train_filelist = globlist('train_files') if args.subcommand in ['train', 'nfold', 'traintesteval'] else []
+        train_filelist = globlist('train_files', main=args.subcommand != 'traintesteval') \
+            if args.subcommand in ['train', 'nfold', 'traintesteval'] else []
     except ArgumentTypeError as ate:
         LOG.error('Error finding training files: {}'.format(ate))
         errors = True
     try:
-        test_filelist = globlist('test_files') if args.subcommand in ['test', 'testeval'] else []
+        test_filelist = globlist('test_files', main=args.subcommand == 'test') \
+            if args.subcommand in ['test', 'testeval'] and not argdict.get('stdin') else []
     except ArgumentTypeError as ate:
         LOG.error('Error finding testing files: {}'.format(ate))
         errors = True
     try:
-        eval_filelist = globlist('eval_files') if args.subcommand in ['eval', 'testeval', 'traintesteval'] else []
+        profile_filelist = globlist('profile_files') if args.subcommand == 'profile-features' else []
+    except ArgumentTypeError as ate:
+        LOG.error('Error finding files to profile: {}'.format(ate))
+        errors = True
+    try:
+        eval_filelist = globlist('eval_files', main=args.subcommand == 'eval') \
+            if args.subcommand in ['eval', 'testeval', 'traintesteval'] else []
     except ArgumentTypeError as ate:
         LOG.error('Error finding evaluation files: {}'.format(ate))
         errors = True
@@ -1969,6 +3433,14 @@ def run(main_parser, common_parser):
     if errors:
         sys.exit(3)
 
+    # -------------------------------------------
+    # Keep only this machine's shard of the files.
+    # -------------------------------------------
+    if args.subcommand == 'test':
+        test_filelist = shard_files(test_filelist, argdict.get('shard'))
+    elif args.subcommand == 'eval':
+        eval_filelist = shard_files(eval_filelist, argdict.get('shard'))
+
     # -------------------------------------------
 
     # -------------------------------------------
@@ -1984,6 +3456,12 @@ def run(main_parser, common_parser):
     elif verbosity >= 2:
         setloglevel(logging.DEBUG)
 
+    # -------------------------------------------
+    # Set up metrics
+    # -------------------------------------------
+    METRICS.progress_interval = float(argdict.get('progress_interval') or 0)
+    METRICS.time_features = bool(argdict.get('metrics_out') or argdict.get('prometheus_out'))
+    METRICS.reset()
 
     # Switch between the commands
     import cProfile
@@ -2009,8 +3487,26 @@ def run(main_parser, common_parser):
         nfold(argdict, train_filelist)
     elif args.subcommand == 'testdb':
         testdb(argdict)
+    elif args.subcommand == 'watch':
+        watch(argdict)
     elif args.subcommand == 'info':
         getinfo(argdict)
+    elif args.subcommand == 'export-model':
+        export_model(argdict)
+    elif args.subcommand == 'profile-features':
+        profile_features(argdict, profile_filelist)
+    elif args.subcommand == 'merge':
+        merge_shards(argdict)
+
+    # -------------------------------------------
+    # Write out the metrics for the run
+    # -------------------------------------------
+    if METRICS.counters[COUNT_DOCS]:
+        METRICS.progress(LOG, NORM_LEVEL, force=True)
+    if argdict.get('metrics_out'):
+        METRICS.write_json(argdict['metrics_out'])
+    if argdict.get('prometheus_out'):
+        METRICS.write_prometheus(argdict['prometheus_out'])
 
 if __name__ == '__main__':
     main_parser, common_parser = pre_run()
@@ -0,0 +1,136 @@
+import os
+import threading
+
+# =============================================================================
+# Run journal
+#
+# A long classification run that dies partway through should not have to
+# start over. Every output file is written to a temporary file beside its
+# final path and renamed into place only once it is complete, so a file at
+# the final path is never partially written. Once all of a document's
+# outputs are in place, its id is appended to the run journal; a run
+# started with --resume skips the documents already in the journal.
+#
+# Both are synced to disk before they are relied on: a file's contents
+# before it is renamed into place and its directory after, and the journal
+# after each entry, so that a crash of the machine rather than of the run
+# cannot leave an entry for a document whose outputs were lost.
+# =============================================================================
+
+JOURNAL_NAME = '.igtdetect-journal'
+
+
+def fsync_dir(dirname):
+    """
+    Sync a directory, so that files renamed into
+    it are still there after a crash. Not every
+    platform can open a directory; those are skipped.
+    """
+    try:
+        fd = os.open(dirname or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class AtomicFile(object):
+    """
+    A file that is written under a temporary name, and
+    only appears at its path when committed.
+    """
+    def __init__(self, path, mode='w', encoding=None):
+        self.path = path
+        dirname, basename = os.path.split(path)
+        self.tmp_path = os.path.join(dirname, '.{}.{}.tmp'.format(basename, os.getpid()))
+        self.f = open(self.tmp_path, mode, encoding=encoding)
+
+    def write(self, s):
+        return self.f.write(s)
+
+    def flush(self):
+        self.f.flush()
+
+    def commit(self):
+        """
+        Sync the file to disk, close it
+        and move it into place.
+        """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+        fsync_dir(os.path.dirname(self.path))
+
+    def discard(self):
+        """
+        Close the file and remove it, leaving
+        whatever was at the path untouched.
+        """
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+class RunJournal(object):
+    """
+    Append-only record of the documents whose
+    outputs have all been written.
+    """
+    def __init__(self, path, resume=False):
+        """
+        :param path: Where to keep the journal.
+        :param resume: Keep the documents already in the journal, rather than starting a new one.
+        """
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            # A last line with no newline was cut
+            # off mid-write, and is left out.
+            self.done = set(text.split('\n')[:-1])
+            self.done.discard('')
+
+        # Start the journal over with only the complete
+        # entries, so that new ones are never appended
+        # to a partial line.
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with AtomicFile(path, encoding='utf-8') as f:
+            for doc_id in sorted(self.done):
+                f.write(doc_id + '\n')
+        self._f = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, doc_id):
+        return doc_id in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def record(self, doc_id):
+        """
+        Add a finished document to the journal.
+        """
+        with self._lock:
+            self.done.add(doc_id)
+            self._f.write(doc_id + '\n')
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
@@ -0,0 +1,193 @@
+import numpy as np
+
+from .env import getbool, STRIP_FLAGS, USE_BI_LABELS, USE_MULTI_LABELS
+
+# =============================================================================
+# Labels
+#
+# There are only a few dozen distinct raw labels in a corpus, so rather than
+# stripping the flags, noise markers and B/I prefixes off every line's label
+# with handle_label, each distinct raw label is normalized once per set of
+# label settings, in a LabelTable. Normalized labels are also given small
+# integer codes, shared by all the tables in a run, so that evaluation can
+# count whole arrays of labels at once.
+# =============================================================================
+
+# The settings that handle_label depends on.
+LABEL_SETTINGS = ('skip_noisy', STRIP_FLAGS, USE_BI_LABELS, USE_MULTI_LABELS)
+
+
+def handle_label(label, **kwargs):
+    """
+    Given a label, return a label without the multiple
+    flags/etc
+
+    :param label:
+    :param kwargs:
+    :return:
+    """
+    return normalize_label(label, *label_settings(kwargs))
+
+
+def normalize_label(label, skip_noisy, strip_flags, use_bi_labels, use_multi_labels):
+    """
+    handle_label, with the label settings already
+    read out of the config as plain booleans.
+
+    :rtype: str
+    """
+
+    # --1) Start by handling the asterisk-indicated noisy labels.
+    new_label = label
+    if new_label.startswith('*'):
+        if skip_noisy:
+            new_label = 'O'
+        else:
+            new_label = new_label[1:]
+
+    # --2) Next, strip the '+' elements
+    #      off any label if we are not attempting
+    #      to learn flags.
+    if strip_flags and '+' in new_label:
+        new_label = new_label.split('+')[0]
+
+    # --2) Now, if we AREN'T using B/I labels for beginning/inside
+    #      distinctions...
+    if not use_bi_labels and new_label[0:2] in ['B-', 'I-']:
+        new_label = new_label[2:]
+
+    # --3) Finally, are we using multiple hyphenated labels?
+    if not use_multi_labels:
+
+        # ...Don't strip off 'B-', 'I-' tags.
+        if new_label[0:2] in ['B-', 'I-']:
+            new_label = new_label[0:2]+new_label[2:].split('-')[0]
+        else:
+            new_label = new_label.split('-')[0]
+
+    return new_label
+
+
+def eval_label(label):
+    """
+    Labels for classes that aren't evaluated are
+    counted as "O" in the system output.
+    """
+    return label.replace('TB', 'O').replace('V', 'O')
+
+
+class LabelCodes(object):
+    """
+    Small integer codes for normalized labels.
+    """
+    def __init__(self):
+        self.labels = []
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def code(self, label):
+        """:rtype: int"""
+        code = self._codes.get(label)
+        if code is None:
+            code = self._codes[label] = len(self.labels)
+            self.labels.append(label)
+        return code
+
+    def label(self, code):
+        """:rtype: str"""
+        return self.labels[code]
+
+
+LABEL_CODES = LabelCodes()
+
+
+class LabelTable(object):
+    """
+    Lookup table from raw labels to their normalized
+    labels and label codes, for one combination of the
+    label settings.
+    """
+    def __init__(self, settings, transform=None, codes=LABEL_CODES):
+        """
+        :param settings: The values of LABEL_SETTINGS, in order.
+        :type settings: tuple[bool]
+        :param transform: Function to apply to the normalized labels.
+        :type codes: LabelCodes
+        """
+        self.settings = tuple(bool(b) for b in settings)
+        self.transform = transform
+        self.codes = codes
+        self._labels = {}
+        self._codes = {}
+
+    def _add(self, raw_label):
+        label = normalize_label(raw_label, *self.settings)
+        if self.transform is not None:
+            label = self.transform(label)
+        self._labels[raw_label] = label
+        self._codes[raw_label] = self.codes.code(label)
+        return label
+
+    def normalize(self, raw_label):
+        """:rtype: str"""
+        label = self._labels.get(raw_label)
+        return label if label is not None else self._add(raw_label)
+
+    def code(self, raw_label):
+        """:rtype: int"""
+        code = self._codes.get(raw_label)
+        if code is None:
+            self._add(raw_label)
+            code = self._codes[raw_label]
+        return code
+
+    def encode(self, raw_labels):
+        """
+        Return the label codes of the raw labels.
+
+        :type raw_labels: Iterable[str]
+        :rtype: np.ndarray
+        """
+        return np.fromiter((self.code(l) for l in raw_labels), dtype=np.int64)
+
+    def decode(self, codes):
+        """:rtype: list[str]"""
+        labels = self.codes.labels
+        return [labels[c] for c in codes]
+
+
+_label_tables = {}
+
+
+def label_settings(kwargs):
+    """:rtype: tuple[bool]"""
+    return tuple(getbool(kwargs, setting) for setting in LABEL_SETTINGS)
+
+
+def cached_label_table(settings, transform=None):
+    """
+    Return the label table for a combination of the
+    label settings, building it the first time it's
+    needed. Tables are shared by every configuration
+    in the process with the same label settings.
+
+    :param settings: The values of LABEL_SETTINGS, in order.
+    :type settings: tuple[bool]
+    :rtype: LabelTable
+    """
+    key = (settings, transform)
+    table = _label_tables.get(key)
+    if table is None:
+        table = _label_tables[key] = LabelTable(*key)
+    return table
+
+
+def label_table(kwargs, transform=None):
+    """
+    Return the label table for the label settings in kwargs.
+
+    :rtype: LabelTable
+    """
+    return cached_label_table(label_settings(kwargs), transform)
@@ -0,0 +1,258 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# =============================================================================
+# Document layout index
+#
+# The freki features only depend on a handful of per-line layout values:
+# the line's fonts, block, indentation, page and iscore. DocLayout pulls
+# these out of a document's lines in one pass into NumPy arrays, so that
+# each freki feature can be computed for every line of the document at
+# once with array comparisons, rather than with a Python call per line.
+#
+# Freki only gives bounding boxes for blocks, so the vertical position of
+# each line is estimated by dividing its block's height evenly between the
+# block's lines.
+# =============================================================================
+
+
+def block_bbox(block):
+    """
+    Return the (llx, lly, urx, ury) bounding box of a freki
+    block, or one with only the llx known if it has none.
+
+    :rtype: tuple[float,float,float,float]
+    """
+    bbox = getattr(block, 'bbox', None)
+    if isinstance(bbox, str):
+        bbox = bbox.split(',')
+    if bbox is None or len(bbox) != 4:
+        llx = float(block.llx)
+        return llx, 0., llx, 0.
+    return tuple(float(v) for v in bbox)
+
+
+class DocLayout(object):
+    """
+    Per-line layout arrays for a single document.
+
+    The lines are expected in line number order, as
+    FrekiDoc.lines() returns them.
+    """
+    def __init__(self, lines, def_font=None):
+        """
+        :type lines: list[FrekiLine]
+        :param def_font: The most common font in the document.
+        :type def_font: FrekiFont
+        """
+        num_lines = len(lines)
+        self.linenos = np.zeros(num_lines, dtype=np.int64)
+        self.pages = np.zeros(num_lines, dtype=np.int64)
+        self.llxs = np.zeros(num_lines, dtype=np.float64)
+        self.bboxes = np.zeros((num_lines, 4), dtype=np.float64)
+        self.block_ids = np.zeros(num_lines, dtype=np.int64)
+        self.iscores = np.zeros(num_lines, dtype=np.float64)
+
+        # The fonts of each line, as the indptr and
+        # indices of a CSR matrix over the font ids.
+        self.fonts = []
+        font_ids = {}
+        block_ids = {}
+        font_indptr = [0]
+        line_fonts = []
+
+        for i, line in enumerate(lines):
+            block = line.block
+            self.linenos[i] = line.lineno
+            self.pages[i] = block.page
+            self.llxs[i] = float(block.llx)
+            self.bboxes[i] = block_bbox(block)
+            self.block_ids[i] = block_ids.setdefault(block.block_id, len(block_ids))
+            self.iscores[i] = float(line.attrs.get('iscore', 0.0))
+
+            for font in line.fonts:
+                font_id = font_ids.get(font)
+                if font_id is None:
+                    font_id = font_ids[font] = len(self.fonts)
+                    self.fonts.append(font)
+                line_fonts.append(font_id)
+            font_indptr.append(len(line_fonts))
+
+        self.font_indptr = np.array(font_indptr, dtype=np.int64)
+        self.font_ids = np.array(line_fonts, dtype=np.int64)
+        self.font_sizes = np.array([float(f.f_size) for f in self.fonts], dtype=np.float64)
+        self._font_lines = np.repeat(np.arange(num_lines), np.diff(self.font_indptr))
+
+        self.def_font_id = font_ids.get(def_font, -1)
+        self.def_font_size = float(def_font.f_size) if def_font is not None else np.nan
+
+    def __len__(self):
+        return len(self.linenos)
+
+    # -------------------------------------------
+    # Helpers
+    # -------------------------------------------
+    def _any_font(self, font_mask):
+        """
+        Return, for each line, whether font_mask is
+        true for any of the fonts on that line.
+
+        :param font_mask: Boolean array over self.font_ids.
+        """
+        return np.bincount(self._font_lines[font_mask], minlength=len(self)) > 0
+
+    def _neighbour_same_block(self, offset):
+        """
+        Return, for each line, whether the line numbered
+        offset away exists and is in the same block.
+        """
+        if not len(self):
+            return np.zeros(0, dtype=bool)
+        target = self.linenos + offset
+        pos = np.minimum(np.searchsorted(self.linenos, target), len(self) - 1)
+        return (self.linenos[pos] == target) & (self.block_ids[pos] == self.block_ids)
+
+    # -------------------------------------------
+    # Features
+    # -------------------------------------------
+    def is_indented(self, doc_llx):
+        """Whether the line's block is indented further than the document's usual indent."""
+        return self.llxs > doc_llx
+
+    def is_first_page(self):
+        return self.pages == 1
+
+    def prev_line_same_block(self):
+        return self._neighbour_same_block(-1)
+
+    def next_line_same_block(self):
+        return self._neighbour_same_block(1)
+
+    def has_nondefault_font(self):
+        return self._any_font(self.font_ids != self.def_font_id)
+
+    def has_smaller_font(self):
+        return self._any_font(self.font_sizes[self.font_ids] < self.def_font_size)
+
+    def has_larger_font(self):
+        return self._any_font(self.font_sizes[self.font_ids] > self.def_font_size)
+
+    def iscore(self, thresh, gt=True):
+        is_greater = self.iscores >= thresh
+        return is_greater if gt else ~is_greater
+
+    # -------------------------------------------
+    # Geometry
+    # -------------------------------------------
+    def _line_positions(self):
+        """
+        Estimate the top and height of each line from its
+        block's bounding box and its position in the block.
+
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        num_lines = len(self)
+        starts = np.ones(num_lines, dtype=bool)
+        starts[1:] = self.block_ids[1:] != self.block_ids[:-1]
+        run_ids = np.cumsum(starts) - 1
+        run_starts = np.flatnonzero(starts)
+        run_lengths = np.diff(np.append(run_starts, num_lines))
+
+        index_in_block = np.arange(num_lines) - run_starts[run_ids]
+        heights = (self.bboxes[:, 3] - self.bboxes[:, 1]) / run_lengths[run_ids]
+        tops = self.bboxes[:, 3] - index_in_block * heights
+        return tops, heights
+
+    def _page_groups(self):
+        """:rtype: tuple[np.ndarray, int]"""
+        pages, page_index = np.unique(self.pages, return_inverse=True)
+        return page_index, len(pages)
+
+    def indent_buckets(self, doc_llx, step):
+        """
+        Bucket each line's indentation relative to the document's
+        usual indent into steps of the given width: "outdented",
+        "0", "1", "2" or "3+".
+
+        :rtype: dict[str,np.ndarray]
+        """
+        buckets = np.clip(np.floor((self.llxs - doc_llx) / step), -1, 3).astype(np.int64)
+        names = {-1: 'outdented', 0: '0', 1: '1', 2: '2', 3: '3+'}
+        return OrderedDict((names[b], buckets == b) for b in sorted(names))
+
+    def large_vgap(self, thresh):
+        """
+        Whether the gap between the previous line and this one,
+        on the same page, is more than thresh times the document's
+        median line height.
+        """
+        if not len(self):
+            return np.zeros(0, dtype=bool)
+        tops, heights = self._line_positions()
+        positive = heights[heights > 0]
+        if not len(positive):
+            return np.zeros(len(self), dtype=bool)
+
+        gaps = np.zeros(len(self))
+        gaps[1:] = (tops[:-1] - heights[:-1]) - tops[1:]
+        same_page = np.zeros(len(self), dtype=bool)
+        same_page[1:] = self.pages[1:] == self.pages[:-1]
+        return same_page & (gaps > thresh * np.median(positive))
+
+    def _columns(self):
+        """
+        Return, for each line, whether its page has blocks
+        wholly to the left and wholly to the right of the
+        middle of the page's text, and whether its block
+        starts right of the middle.
+
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        if not len(self):
+            return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+        page_index, num_pages = self._page_groups()
+        llxs, urxs = self.bboxes[:, 0], self.bboxes[:, 2]
+        left = np.full(num_pages, np.inf)
+        right = np.full(num_pages, -np.inf)
+        np.minimum.at(left, page_index, llxs)
+        np.maximum.at(right, page_index, urxs)
+        mid = ((left + right) / 2)[page_index]
+
+        # Blocks without a bounding box have no width,
+        # and say nothing about the columns.
+        has_width = urxs > llxs
+        has_left = np.bincount(page_index[has_width & (urxs <= mid)], minlength=num_pages) > 0
+        has_right = np.bincount(page_index[has_width & (llxs >= mid)], minlength=num_pages) > 0
+        multi_column = (has_left & has_right)[page_index]
+        return multi_column, multi_column & (llxs >= mid)
+
+    def right_column(self):
+        """Whether the line's block is in the right column of a multi-column page."""
+        return self._columns()[1]
+
+    def multi_column_page(self):
+        """
+        Whether the line's page has blocks wholly to the
+        left and wholly to the right of the middle of its text.
+        """
+        return self._columns()[0]
+
+    def font_zscores(self):
+        """
+        The z-score of each line's mean font size against
+        the mean font size of the document's lines. Lines
+        without fonts score 0.
+        """
+        counts = np.diff(self.font_indptr)
+        sums = np.bincount(self._font_lines, weights=self.font_sizes[self.font_ids], minlength=len(self))
+        has_fonts = counts > 0
+        sizes = np.zeros(len(self))
+        sizes[has_fonts] = sums[has_fonts] / counts[has_fonts]
+
+        zscores = np.zeros(len(self))
+        if has_fonts.any():
+            std = sizes[has_fonts].std()
+            if std > 0:
+                zscores[has_fonts] = (sizes[has_fonts] - sizes[has_fonts].mean()) / std
+        return zscores
@@ -0,0 +1,271 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# =============================================================================
+# Pipeline metrics
+#
+# Wall time spent in each stage of the pipeline, cumulative time spent in
+# each feature function, and counts of the documents and lines processed.
+# The pipeline reports into the module-level METRICS object, which can be
+# logged as a periodic progress line, and written out at the end of a run
+# as a JSON report or in the Prometheus text exposition format (for the
+# node_exporter textfile collector).
+# =============================================================================
+
+# -------------------------------------------
+# Stage names
+# -------------------------------------------
+STAGE_PARSE = 'parse'
+STAGE_PREFILTER = 'prefilter'
+STAGE_TEXT_FEATS = 'text_feats'
+STAGE_FREKI_FEATS = 'freki_feats'
+STAGE_CONTEXT = 'context'
+STAGE_LOAD_FEATS = 'load_feats'
+STAGE_VECTORIZE = 'vectorize'
+STAGE_TRAIN = 'train'
+STAGE_PREDICT = 'predict'
+STAGE_WRITE = 'write'
+
+# -------------------------------------------
+# Counter names
+# -------------------------------------------
+COUNT_DOCS = 'docs'
+COUNT_LINES = 'lines'
+COUNT_SKIPPED_LINES = 'skipped_lines'
+
+
+class Metrics(object):
+    """
+    Accumulate timings and counters for a run.
+    """
+    def __init__(self, progress_interval=30.):
+        """
+        :param progress_interval: Minimum number of seconds between progress lines.
+        """
+        self.progress_interval = progress_interval
+
+        # Timing each feature function call costs a little,
+        # so it is only done when a report has been asked for.
+        self.time_features = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.stages = OrderedDict()
+        self.features = OrderedDict()
+        self.counters = OrderedDict([(COUNT_DOCS, 0), (COUNT_LINES, 0)])
+        self.caches = OrderedDict()
+        self.pipeline = OrderedDict()
+        self._last_progress = self.start_time
+
+    # -------------------------------------------
+    # Recording
+    # -------------------------------------------
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as part of the named stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            timing = self.stages.get(name)
+            if timing is None:
+                timing = self.stages[name] = [0., 0]
+            timing[0] += seconds
+            timing[1] += calls
+
+    def add_feature_time(self, name, seconds, calls=1):
+        with self._lock:
+            timing = self.features.get(name)
+            if timing is None:
+                timing = self.features[name] = [0., 0]
+            timing[0] += seconds
+            timing[1] += calls
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        """
+        Add the stage and feature timings from another
+        Metrics, such as one sent back by a worker process.
+
+        :type other: Metrics
+        """
+        for name, (seconds, calls) in other.stages.items():
+            self.add_time(name, seconds, calls)
+        for name, (seconds, calls) in other.features.items():
+            self.add_feature_time(name, seconds, calls)
+
+    def set_pipeline_report(self, report):
+        """
+        Record the utilization of each stage of a Pipeline.
+
+        :type report: dict
+        """
+        self.pipeline = report
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def set_cache_stats(self, name, hits, misses, size):
+        """
+        Record the current totals for a cache, which
+        keeps its own running counts.
+        """
+        self.caches[name] = (hits, misses, size)
+
+    # -------------------------------------------
+    # Reporting
+    # -------------------------------------------
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def rate(self, name, seconds=None):
+        """
+        Number of the named counter per second, over the
+        given number of seconds or the whole run.
+        """
+        seconds = self.elapsed() if seconds is None else seconds
+        return self.counters.get(name, 0) / seconds if seconds else 0.
+
+    def progress_line(self):
+        return 'Processed {} docs, {} lines in {:.1f}s ({:.1f} docs/sec, {:.1f} lines/sec)'.format(
+            self.counters[COUNT_DOCS], self.counters[COUNT_LINES], self.elapsed(),
+            self.rate(COUNT_DOCS), self.rate(COUNT_LINES))
+
+    def progress(self, log, level, force=False):
+        """
+        Log a progress line, if at least progress_interval
+        seconds have passed since the last one.
+
+        :type log: logging.Logger
+        """
+        now = time.perf_counter()
+        if force or (self.progress_interval and now - self._last_progress >= self.progress_interval):
+            self._last_progress = now
+            log.log(level, self.progress_line())
+
+    def report(self):
+        """
+        :rtype: dict
+        """
+        elapsed = self.elapsed()
+        lines = self.counters.get(COUNT_LINES, 0)
+
+        stages = OrderedDict()
+        for name, (seconds, calls) in self.stages.items():
+            stages[name] = {'seconds': seconds,
+                            'calls': calls,
+                            'lines_per_sec': lines / seconds if seconds else None}
+
+        features = OrderedDict()
+        for name, (seconds, calls) in sorted(self.features.items(), key=lambda x: x[1][0], reverse=True):
+            features[name] = {'seconds': seconds,
+                              'calls': calls,
+                              'usec_per_call': 1e6 * seconds / calls if calls else None}
+
+        caches = OrderedDict()
+        for name, (hits, misses, size) in self.caches.items():
+            caches[name] = {'hits': hits,
+                            'misses': misses,
+                            'hit_rate': hits / (hits + misses) if hits + misses else None,
+                            'size': size}
+
+        return OrderedDict([('elapsed_seconds', elapsed),
+                            ('counters', OrderedDict(self.counters)),
+                            ('docs_per_sec', self.rate(COUNT_DOCS, elapsed)),
+                            ('lines_per_sec', self.rate(COUNT_LINES, elapsed)),
+                            ('stages', stages),
+                            ('features', features),
+                            ('caches', caches),
+                            ('pipeline', self.pipeline)])
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.report(), indent=2) + '\n')
+
+    def prometheus_text(self, prefix='igtdetect'):
+        """
+        Format the metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        out = []
+
+        def metric(name, mtype, help, samples):
+            out.append('# HELP {}_{} {}'.format(prefix, name, help))
+            out.append('# TYPE {}_{} {}'.format(prefix, name, mtype))
+            for labels, value in samples:
+                label_str = ','.join('{}="{}"'.format(k, _escape_label(v)) for k, v in labels)
+                out.append('{}_{}{} {}'.format(prefix, name, '{' + label_str + '}' if label_str else '', value))
+
+        metric('elapsed_seconds', 'gauge', 'Wall time of the run.', [((), self.elapsed())])
+        for name, value in self.counters.items():
+            metric('{}_total'.format(name), 'counter', 'Number of {} processed.'.format(name), [((), value)])
+        metric('stage_seconds_total', 'counter', 'Wall time spent in each pipeline stage.',
+               [((('stage', name),), seconds) for name, (seconds, calls) in self.stages.items()])
+        metric('stage_calls_total', 'counter', 'Number of times each pipeline stage was timed.',
+               [((('stage', name),), calls) for name, (seconds, calls) in self.stages.items()])
+        if self.features:
+            metric('feature_seconds_total', 'counter', 'Time spent computing each feature.',
+                   [((('feature', name),), seconds) for name, (seconds, calls) in self.features.items()])
+            metric('feature_calls_total', 'counter', 'Number of times each feature was computed.',
+                   [((('feature', name),), calls) for name, (seconds, calls) in self.features.items()])
+        if self.caches:
+            metric('cache_hits_total', 'counter', 'Number of lookups found in each cache.',
+                   [((('cache', name),), hits) for name, (hits, misses, size) in self.caches.items()])
+            metric('cache_misses_total', 'counter', 'Number of lookups missing from each cache.',
+                   [((('cache', name),), misses) for name, (hits, misses, size) in self.caches.items()])
+            metric('cache_size', 'gauge', 'Number of entries in each cache.',
+                   [((('cache', name),), size) for name, (hits, misses, size) in self.caches.items()])
+        if self.pipeline:
+            metric('pipeline_workers', 'gauge', 'Number of workers in each pipeline stage.',
+                   [((('stage', name),), s['workers']) for name, s in self.pipeline.items()])
+            metric('pipeline_utilization', 'gauge', 'Fraction of the time the workers of each pipeline stage were busy.',
+                   [((('stage', name),), s['utilization']) for name, s in self.pipeline.items()])
+            metric('pipeline_starved', 'gauge', 'Fraction of the time the workers of each pipeline stage waited for input.',
+                   [((('stage', name),), s['starved']) for name, s in self.pipeline.items()])
+            metric('pipeline_blocked', 'gauge', 'Fraction of the time the workers of each pipeline stage waited on a full queue.',
+                   [((('stage', name),), s['blocked']) for name, s in self.pipeline.items()])
+        return '\n'.join(out) + '\n'
+
+    def write_prometheus(self, path, prefix='igtdetect'):
+        _write_atomic(path, self.prometheus_text(prefix=prefix))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path, text):
+    """
+    Write to a temporary file and rename it into place,
+    so that the file is never seen half-written.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirname, exist_ok=True)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+METRICS = Metrics()
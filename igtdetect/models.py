@@ -0,0 +1,447 @@
+import os
+import pickle
+from abc import ABC, abstractmethod
+from gzip import GzipFile
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+from .metrics import METRICS, STAGE_PREDICT, STAGE_VECTORIZE
+from .vectorize import FeatureIndex, SparseMatrixBuilder, select_features, SELECT_CHI2
+
+# =============================================================================
+# Classifier models
+#
+# Linear classifiers that are trained directly on the CSR matrices built
+# during feature extraction. They are saved as gzipped pickles, the same
+# as the riples_classifier wrappers, so either kind of model can be loaded
+# with load_classifier().
+# =============================================================================
+
+class Distribution(dict):
+    """
+    Probability distribution over the class labels
+    for a single line.
+    """
+    @property
+    def best_class(self):
+        return max(self, key=self.get)
+
+
+def ovr_proba(scores):
+    """
+    Turn one-vs-rest decision scores into normalized
+    probabilities, the way scikit-learn does for
+    liblinear logistic regression.
+
+    :type scores: np.ndarray
+    :rtype: np.ndarray
+    """
+    probs = 1. / (1. + np.exp(-scores))
+    if probs.shape[1] == 1:
+        return np.hstack([1 - probs, probs])
+    return probs / probs.sum(axis=1, keepdims=True)
+
+
+class SparseClassifierWrapper(ABC):
+    """
+    Wrap a scikit-learn linear model together with the
+    names of the feature columns it was trained on.
+    """
+    # The context window the model was trained with, as
+    # its spec, e.g. "-2..+1". Models saved before the
+    # window was recorded have none.
+    context_window = None
+
+    def __init__(self):
+        self.feat_index = FeatureIndex()
+        self.classes_ = None
+        self.coef_ = None
+        self.intercept_ = None
+        self.context_window = None
+
+    @property
+    def feat_names(self):
+        """:rtype: list[str]"""
+        return self.feat_index.names()
+
+    @abstractmethod
+    def fit(self, X, y):
+        """
+        Fit the model weights, setting classes_, coef_
+        and intercept_.
+        """
+
+    # -------------------------------------------
+    # Training
+    # -------------------------------------------
+    def train_matrix(self, X, labels, feat_index, num_feats=-1, selection=SELECT_CHI2):
+        """
+        Train on a CSR matrix whose columns are the ids in
+        feat_index, keeping only the num_feats best columns
+        if num_feats is positive.
+
+        :type X: csr_matrix
+        :type labels: list[str]
+        :type feat_index: FeatureIndex
+        """
+        selected = select_features(X, labels, num_feats, method=selection)
+        if len(selected) < X.shape[1]:
+            X = X[:, selected]
+            feat_index = feat_index.subset(selected)
+        self.feat_index = feat_index
+        self.fit(X, np.asarray(labels))
+
+    def train(self, data, num_feats=-1, selection=SELECT_CHI2, feat_index=None):
+        """
+        :type data: list[DataInstance]
+        """
+        builder = SparseMatrixBuilder(index=feat_index)
+        for di in data:
+            builder.add_instance(di.label, di.feats)
+        self.train_matrix(builder.matrix(), builder.labels, builder.index,
+                          num_feats=num_feats, selection=selection)
+
+    # -------------------------------------------
+    # Testing
+    # -------------------------------------------
+    def vectorize(self, feat_dicts, feat_filter=None):
+        """
+        Turn feature dicts into a CSR matrix over the model's
+        columns, dropping any feature the model doesn't know.
+
+        :type feat_dicts: Iterable[dict]
+        :rtype: csr_matrix
+        """
+        builder = SparseMatrixBuilder(index=self.feat_index)
+        for feats in feat_dicts:
+            if feat_filter is not None:
+                feats = {f: v for f, v in feats.items() if feat_filter(f)}
+            builder.add_instance(None, feats, grow=False)
+        return builder.matrix()
+
+    def decision_scores(self, X):
+        """:rtype: np.ndarray"""
+        scores = X @ self.coef().T + self.intercept()
+        return np.asarray(scores)
+
+    def test(self, data, prev_label_func=None, feat_filter=None):
+        """
+        Classify each of the instances in data, in order.
+
+        If prev_label_func is given, it maps the label predicted
+        for the previous line to the name of a feature that is
+        added to the current line, so the lines must be
+        classified sequentially.
+
+        :type data: list[DataInstance]
+        :rtype: list[Distribution]
+        """
+        with METRICS.stage(STAGE_VECTORIZE):
+            X = self.vectorize((di.feats for di in data), feat_filter=feat_filter)
+        return self.test_matrix(X, prev_label_func=prev_label_func)
+
+    def test_matrix(self, X, prev_label_func=None):
+        """
+        Classify each row of a CSR matrix over the
+        model's columns, in order, as test() does.
+
+        :type X: csr_matrix
+        :rtype: list[Distribution]
+        """
+        with METRICS.stage(STAGE_PREDICT):
+            return self._predict(X, prev_label_func)
+
+    def _predict(self, X, prev_label_func=None):
+        """:rtype: list[Distribution]"""
+        scores = self.decision_scores(X)
+        classes = list(self.classes())
+
+        if prev_label_func is None:
+            return [Distribution(zip(classes, p)) for p in ovr_proba(scores)]
+
+        # The contribution of each possible previous label
+        # is just a column of the weight matrix, so add it
+        # to the precomputed scores line by line.
+        coef = self.coef()
+        prev_weights = {}
+        for c in classes + ['O']:
+            col = self.feat_index.get(prev_label_func(c))
+            prev_weights[c] = coef[:, col] if col is not None else 0.
+
+        dists = []
+        prev_label = 'O'
+        for row_scores in scores:
+            probs = ovr_proba((row_scores + prev_weights[prev_label]).reshape(1, -1))[0]
+            dist = Distribution(zip(classes, probs))
+            prev_label = dist.best_class
+            dists.append(dist)
+        return dists
+
+    # -------------------------------------------
+    # Model information
+    # -------------------------------------------
+    def classes(self):
+        return self.classes_
+
+    def coef(self):
+        """:rtype: np.ndarray"""
+        return self.coef_
+
+    def intercept(self):
+        """:rtype: np.ndarray"""
+        return self.intercept_
+
+    def weights(self):
+        """
+        Return a list of (class, feature, weight) triples
+        for every nonzero weight in the model.
+
+        :rtype: list[tuple[str,str,float]]
+        """
+        coef = self.coef()
+        classes = list(self.classes())
+
+        # Binary models only have weights for
+        # the positive class.
+        if coef.shape[0] == 1:
+            classes = classes[1:]
+
+        weights = []
+        for class_i, c in enumerate(classes):
+            for feat_i in np.flatnonzero(coef[class_i]):
+                weights.append((c, self.feat_index.name(feat_i), float(coef[class_i, feat_i])))
+        return weights
+
+    # -------------------------------------------
+    # Saving and loading
+    # -------------------------------------------
+    def save(self, path):
+        with GzipFile(path, 'w') as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path):
+        return load_classifier(path)
+
+
+class SparseLogisticRegressionWrapper(SparseClassifierWrapper):
+    """
+    One-vs-rest logistic regression, trained with liblinear
+    one class at a time, as the riples_classifier models are.
+    """
+    def __init__(self, C=1.0):
+        super().__init__()
+        self.C = C
+
+    def fit(self, X, y):
+        self.classes_ = np.unique(y)
+
+        # Two classes only need a single
+        # binary model.
+        targets = self.classes_[1:] if len(self.classes_) == 2 else self.classes_
+
+        coefs = []
+        intercepts = []
+        for c in targets:
+            lr = LogisticRegression(solver='liblinear', C=self.C)
+            lr.fit(X, y == c)
+            coefs.append(lr.coef_[0])
+            intercepts.append(lr.intercept_[0])
+
+        self.coef_ = np.vstack(coefs)
+        self.intercept_ = np.array(intercepts)
+
+
+class SGDLogisticRegressionWrapper(SparseClassifierWrapper):
+    """
+    One-vs-rest logistic regression trained by minibatch
+    stochastic gradient descent, so that it can be trained
+    incrementally over data that doesn't fit in memory.
+
+    The feature space must be fixed with init_weights() (or
+    taken from an existing model with from_model()) before
+    calling partial_fit(). New labels are added as they
+    are seen.
+
+    The L2 penalty shrinks every weight on every step. Rather
+    than pass over the whole weight matrix each time, the
+    weights are kept as coef_ times a scalar wscale_, and only
+    the columns that fire in a minibatch are touched, as
+    scikit-learn's SGDClassifier does.
+    """
+    # Models saved before the scale was kept have none.
+    wscale_ = 1.
+
+    def __init__(self, alpha=1e-4, eta0=0.5, power_t=0.5):
+        """
+        :param alpha: Strength of the L2 penalty.
+        :param eta0: Initial learning rate.
+        :param power_t: Exponent of the inverse scaling learning rate.
+        """
+        super().__init__()
+        self.alpha = alpha
+        self.eta0 = eta0
+        self.power_t = power_t
+        self.t_ = 0
+        self.wscale_ = 1.
+
+    def init_weights(self, feat_index, classes=()):
+        """
+        :type feat_index: FeatureIndex
+        """
+        self.feat_index = feat_index
+        self.classes_ = np.array(sorted(classes), dtype=object)
+        self.coef_ = np.zeros((len(self.classes_), len(self.feat_index)))
+        self.intercept_ = np.zeros(len(self.classes_))
+        self.wscale_ = 1.
+
+    def add_classes(self, classes):
+        """
+        Add weights for labels that haven't been seen before.
+        """
+        new_classes = sorted(set(classes) - set(self.classes_))
+        if new_classes:
+            self.classes_ = np.append(self.classes_, np.array(new_classes, dtype=object))
+            self.coef_ = np.vstack([self.coef_, np.zeros((len(new_classes), self.coef_.shape[1]))])
+            self.intercept_ = np.append(self.intercept_, np.zeros(len(new_classes)))
+
+    @classmethod
+    def from_model(cls, cw, **kwargs):
+        """
+        Start from the feature space, classes and weights
+        of a previously trained model.
+
+        :type cw: SparseClassifierWrapper
+        """
+        sgd = cls(**kwargs)
+        sgd.feat_index = cw.feat_index
+        sgd.classes_ = np.array(cw.classes(), dtype=object)
+        sgd.coef_ = np.array(cw.coef(), dtype=np.float64)
+        sgd.intercept_ = np.array(cw.intercept(), dtype=np.float64)
+        sgd.t_ = getattr(cw, 't_', 0)
+        sgd.context_window = cw.context_window
+
+        # Binary models only have weights for the second
+        # class; the first class is their negation.
+        if len(sgd.classes_) == 2 and sgd.coef_.shape[0] == 1:
+            sgd.coef_ = np.vstack([-sgd.coef_, sgd.coef_])
+            sgd.intercept_ = np.hstack([-sgd.intercept_, sgd.intercept_])
+        return sgd
+
+    def partial_fit(self, X, y):
+        """
+        Take a single gradient step on the minibatch X, y.
+
+        :type X: csr_matrix
+        :type y: np.ndarray
+        """
+        if not X.shape[0]:
+            return
+        self.add_classes(set(y))
+        self.t_ += 1
+        eta = self.eta0 / (self.t_ ** self.power_t)
+
+        targets = (np.asarray(y)[:, None] == self.classes_[None, :]).astype(np.float64)
+        grad = 1. / (1. + np.exp(-self.decision_scores(X))) - targets
+
+        # Only the columns that fire in this batch
+        # receive a gradient from the loss.
+        cols = np.unique(X.indices)
+        feat_grad = np.asarray((X[:, cols].T @ grad).T) / X.shape[0]
+
+        # Shrink all the weights at once through the scale,
+        # and step the stored weights of those columns by
+        # the gradient over it.
+        self.wscale_ *= (1. - eta * self.alpha)
+        self.coef_[:, cols] -= (eta / self.wscale_) * feat_grad
+        self.intercept_ -= eta * grad.mean(axis=0)
+
+        # Fold a tiny scale into the weights before
+        # they lose precision.
+        if self.wscale_ < 1e-9:
+            self.fold_scale()
+
+    def fold_scale(self):
+        """
+        Multiply the scale into the stored weights.
+        """
+        if self.wscale_ != 1.:
+            self.coef_ *= self.wscale_
+            self.wscale_ = 1.
+
+    def coef(self):
+        """:rtype: np.ndarray"""
+        return self.coef_ * self.wscale_ if self.wscale_ != 1. else self.coef_
+
+    def decision_scores(self, X):
+        """:rtype: np.ndarray"""
+        return np.asarray(X @ self.coef_.T) * self.wscale_ + self.intercept_
+
+    def fit(self, X, y, epochs=5, batch_size=1000):
+        if self.coef_ is None:
+            self.init_weights(self.feat_index, np.unique(y))
+        for epoch in range(epochs):
+            for start in range(0, X.shape[0], batch_size):
+                self.partial_fit(X[start:start + batch_size], y[start:start + batch_size])
+        self.fold_scale()
+
+    def save(self, path):
+        self.fold_scale()
+        super().save(path)
+
+
+# -------------------------------------------
+# Load either one of the above models, a model
+# saved by riples_classifier, or a compact model.
+# -------------------------------------------
+def load_classifier(path):
+    if os.path.isdir(path):
+        from .compact import CompactClassifier
+        return CompactClassifier.load(path)
+    with GzipFile(path, 'r') as f:
+        return pickle.load(f)
+
+
+def model_weights(cw):
+    """
+    Return (class, feature, weight) triples for every nonzero
+    weight in either one of the above models, or a model saved
+    by riples_classifier.
+
+    :rtype: list[tuple[str,str,float]]
+    """
+    if isinstance(cw, SparseClassifierWrapper):
+        return cw.weights()
+
+    from .compact import riples_weights
+    names, classes, coef, intercept = riples_weights(cw)
+    classes = list(classes)
+    if coef.shape[0] == 1:
+        classes = classes[1:]
+
+    weights = []
+    for class_i, c in enumerate(classes):
+        for feat_i in np.flatnonzero(coef[class_i]):
+            weights.append((c, names[feat_i], float(coef[class_i, feat_i])))
+    return weights
+
+
+def show_weights(cw, num_feats=100):
+    """
+    Print the highest-weighted features for each class.
+    """
+    if not isinstance(cw, SparseClassifierWrapper):
+        from riples_classifier.models import show_weights as riples_show_weights
+        return riples_show_weights(cw, num_feats)
+
+    by_class = {}
+    for c, feat, weight in cw.weights():
+        by_class.setdefault(c, []).append((feat, weight))
+
+    for c in sorted(by_class):
+        weights = sorted(by_class[c], key=lambda x: x[1], reverse=True)
+        if num_feats is not None and num_feats >= 0:
+            weights = weights[:num_feats]
+        for feat, weight in weights:
+            print('{}\t{}\t{:.4f}'.format(c, feat, weight))
@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import OrderedDict
+from queue import Queue
+
+# =============================================================================
+# Staged pipeline
+#
+# A Pipeline runs items through a sequence of stages, each with its own
+# pool of worker threads, connected by bounded queues. When a stage falls
+# behind, the queue in front of it fills up and the stages before it block,
+# so no stage can run far ahead of the others and fill up memory.
+#
+# A stage that needs more than one thread's worth of CPU hands its work to
+# a process pool from each of its threads; the threads just wait on the
+# results. A batched stage takes as many items as are waiting, up to its
+# batch size, at once.
+#
+# Each stage records how long its workers spent working, waiting for input
+# and blocked on a full output queue, so that the bottleneck stage (the one
+# whose workers are always busy while the others wait) can be found, and
+# the pools sized to match.
+# =============================================================================
+
+_END = object()
+
+
+class Stage(object):
+    """
+    A step of the pipeline. The function is called on
+    each item (or, if batch_size is set, on each list of
+    items) and returns the item to pass on (or a list of
+    them), or None to pass nothing on. With fan_out set,
+    the function returns a list of items for each item.
+    """
+    def __init__(self, name, func, workers=1, batch_size=None, fan_out=False):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.batch_size = batch_size
+        self.fan_out = fan_out
+
+        self.items = 0
+        self.busy = 0.
+        self.starved = 0.
+        self.blocked = 0.
+        self._finished = 0
+        self._lock = threading.Lock()
+
+    def record(self, items=0, busy=0., starved=0., blocked=0.):
+        with self._lock:
+            self.items += items
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+
+    def utilization(self, elapsed):
+        """
+        The fraction of its workers' time that
+        the stage spent working.
+        """
+        return self.busy / (elapsed * self.workers) if elapsed else 0.
+
+
+class Pipeline(object):
+    """
+    Run items through a sequence of stages.
+    """
+    def __init__(self, stages, queue_size=16):
+        """
+        :type stages: list[Stage]
+        :param queue_size: Maximum number of items waiting in front of each stage.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.elapsed = 0.
+        self.error = None
+
+    def run(self, items):
+        """
+        Feed the items through every stage, and wait
+        for the last stage to finish with them.
+
+        :type items: Iterable
+        """
+        start = time.perf_counter()
+        queues = [Queue(maxsize=self.queue_size) for s in self.stages]
+        queues.append(None)
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for w in range(stage.workers):
+                t = threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1], i),
+                                     name='{}-{}'.format(stage.name, w), daemon=True)
+                t.start()
+                threads.append(t)
+
+        try:
+            for item in items:
+                if self.error is not None:
+                    break
+                queues[0].put(item)
+        finally:
+            for w in range(self.stages[0].workers):
+                queues[0].put(_END)
+            for t in threads:
+                t.join()
+            self.elapsed = time.perf_counter() - start
+
+        if self.error is not None:
+            raise self.error
+
+    def _work(self, stage, in_q, out_q, stage_i):
+        """
+        The loop of a single worker thread of a stage.
+        """
+        ended = False
+        while not ended:
+            wait_start = time.perf_counter()
+            item = in_q.get()
+            if item is _END:
+                break
+            batch = [item]
+            if stage.batch_size:
+                while len(batch) < stage.batch_size and not in_q.empty():
+                    item = in_q.get()
+                    if item is _END:
+                        ended = True
+                        break
+                    batch.append(item)
+
+            work_start = time.perf_counter()
+            results = []
+            if self.error is None:
+                try:
+                    if stage.batch_size or stage.fan_out:
+                        results = stage.func(batch if stage.batch_size else batch[0]) or []
+                    else:
+                        result = stage.func(batch[0])
+                        results = [result] if result is not None else []
+                except Exception as e:
+                    self.error = e
+                    results = []
+
+            put_start = time.perf_counter()
+            if out_q is not None:
+                for result in results:
+                    out_q.put(result)
+            stage.record(items=len(batch), starved=work_start - wait_start,
+                         busy=put_start - work_start, blocked=time.perf_counter() - put_start)
+
+        # The last worker of the stage to finish
+        # ends the next stage.
+        with stage._lock:
+            stage._finished += 1
+            last = stage._finished == stage.workers
+        if last and out_q is not None:
+            for w in range(self.stages[stage_i + 1].workers):
+                out_q.put(_END)
+
+    # -------------------------------------------
+    # Reporting
+    # -------------------------------------------
+    def report(self):
+        """
+        :rtype: dict
+        """
+        stages = OrderedDict()
+        for stage in self.stages:
+            worker_time = self.elapsed * stage.workers
+            stages[stage.name] = {'workers': stage.workers,
+                                  'items': stage.items,
+                                  'busy_seconds': stage.busy,
+                                  'utilization': stage.utilization(self.elapsed),
+                                  'starved': stage.starved / worker_time if worker_time else 0.,
+                                  'blocked': stage.blocked / worker_time if worker_time else 0.}
+        return stages
+
+    def report_lines(self):
+        """
+        :rtype: list[str]
+        """
+        lines = ['{:<12}{:>8}{:>8}{:>8}{:>9}{:>9}'.format('stage', 'workers', 'items', 'busy', 'starved', 'blocked')]
+        for name, s in self.report().items():
+            lines.append('{:<12}{:>8}{:>8}{:>8.0%}{:>9.0%}{:>9.0%}'.format(
+                name, s['workers'], s['items'], s['utilization'], s['starved'], s['blocked']))
+        return lines
@@ -0,0 +1,102 @@
+from .context import PREV_PREFIX, NEXT_PREFIX
+from .models import model_weights
+from .vectorize import HashingFeatureIndex
+
+# =============================================================================
+# Extraction plans
+#
+# A model only has nonzero weights for some of the features that can be
+# extracted: with max_features set, most of the word_ features are dropped,
+# and any feature the model never saw can't affect its predictions. An
+# ExtractionPlan holds the names of the line features that a model can use,
+# either directly or through one of their prev_/next_ copies, so that the
+# rest are never computed at test time.
+# =============================================================================
+
+
+def unprefixed(feat_name):
+    """
+    Yield the feature name, and the name with each
+    successive prev_/next_ prefix removed. Since some
+    features start with "prev_" themselves, all of
+    them are candidates for the line's own feature.
+
+    :type feat_name: str
+    :rtype: Iterable[str]
+    """
+    yield feat_name
+    while feat_name.startswith((PREV_PREFIX, NEXT_PREFIX)):
+        feat_name = feat_name[feat_name.index('_') + 1:]
+        yield feat_name
+
+
+class ExtractionPlan(object):
+    """
+    The line features a model can use.
+    """
+    def __init__(self, feats):
+        """
+        :type feats: Iterable[str]
+        """
+        self.feats = frozenset(feats)
+        self._prefixes = {}
+
+    def __contains__(self, feat_name):
+        return feat_name in self.feats
+
+    def __len__(self):
+        return len(self.feats)
+
+    def has_prefix(self, prefix):
+        """
+        Whether the model can use any feature
+        starting with the prefix.
+
+        :rtype: bool
+        """
+        found = self._prefixes.get(prefix)
+        if found is None:
+            found = self._prefixes[prefix] = any(f.startswith(prefix) for f in self.feats)
+        return found
+
+    @classmethod
+    def from_model(cls, cw):
+        """
+        Build the plan from the features with nonzero weights
+        in the model, or return None if the model's features
+        can't be listed (as with a hashed feature index).
+
+        :rtype: ExtractionPlan
+        """
+        if isinstance(getattr(cw, 'feat_index', None), HashingFeatureIndex):
+            return None
+        feats = set()
+        for c, feat_name, weight in model_weights(cw):
+            feats.update(unprefixed(feat_name))
+        return cls(feats)
+
+    @classmethod
+    def union(cls, plans):
+        """
+        The plan for extracting the features of several
+        models at once, or None if any of them has none.
+
+        :type plans: list[ExtractionPlan]
+        :rtype: ExtractionPlan
+        """
+        if any(plan is None for plan in plans):
+            return None
+        if len(plans) == 1:
+            return plans[0]
+        return cls(frozenset().union(*[plan.feats for plan in plans]))
+
+
+def wants(plan, feat_name):
+    """
+    Whether the feature needs to be computed
+    under the plan, or under no plan at all.
+
+    :type plan: ExtractionPlan
+    :rtype: bool
+    """
+    return plan is None or feat_name in plan
@@ -0,0 +1,146 @@
+import re
+
+import numpy as np
+
+from .env import getbool
+from .tokens import TOK_GRAM, TOK_LANGNAME, TokenCache, token_cache
+
+# =============================================================================
+# Pre-filter
+#
+# Most of the pages in a corpus contain no IGT at all. Before the full text
+# features are extracted, each block (or page) of a document is scored with
+# a few cheap signals that IGT lines almost always show: a gram from the
+# gram lists, an example number, a language name, or a high iscore from
+# freki. Blocks with too few signals, and that are not within the margin of
+# a block that has them, are labeled "O" without being classified.
+#
+# The pre-filter is only used for classification, never for training.
+# =============================================================================
+
+PREFILTER_BLOCK = 'block'
+PREFILTER_PAGE = 'page'
+PREFILTER_UNITS = [PREFILTER_BLOCK, PREFILTER_PAGE]
+
+# -------------------------------------------
+# Signals, as bits so that the signals seen
+# in a block can be combined with a bitwise or.
+# -------------------------------------------
+SIG_GRAMS = 1
+SIG_NUMBERING = 2
+SIG_LANGNAME = 4
+SIG_ISCORE = 8
+SIGNALS = [SIG_GRAMS, SIG_NUMBERING, SIG_LANGNAME, SIG_ISCORE]
+
+# The iscore at or above which a line
+# counts as showing the iscore signal.
+DEFAULT_PREFILTER_ISCORE = 0.5
+
+numbering_re = re.compile(r'^\s*\(?[0-9a-z]+[\)\.]')
+
+
+class Prefilter(object):
+    """
+    Decide which lines of a document are worth classifying.
+    """
+    def __init__(self, min_score=1, margin=1, unit=PREFILTER_BLOCK, iscore_thresh=DEFAULT_PREFILTER_ISCORE,
+                 tokens=None):
+        """
+        :param min_score: Number of distinct signals a block needs to be kept.
+        :param margin: Number of blocks either side of a kept block to also keep.
+        :param unit: Whether to score each "block" or each "page".
+        :param iscore_thresh: The iscore at or above which a line counts as a signal.
+        :param tokens: The token cache, which knows the grams and language names.
+        :type tokens: TokenCache
+        """
+        if unit not in PREFILTER_UNITS:
+            raise ValueError('Pre-filter unit must be one of {}, not "{}"'.format(PREFILTER_UNITS, unit))
+        self.min_score = int(min_score)
+        self.margin = int(margin)
+        self.unit = unit
+        self.iscore_thresh = float(iscore_thresh)
+        self.tokens = tokens if tokens is not None else TokenCache()
+
+    @classmethod
+    def from_kwargs(cls, kwargs):
+        """
+        Build the pre-filter from the settings, or
+        return None if it is not enabled.
+
+        :rtype: Prefilter
+        """
+        if not getbool(kwargs, 'prefilter_enabled'):
+            return None
+        return cls(min_score=kwargs.get('prefilter_min_score', 1),
+                   margin=kwargs.get('prefilter_margin', 1),
+                   unit=kwargs.get('prefilter_unit', PREFILTER_BLOCK),
+                   iscore_thresh=kwargs.get('prefilter_iscore') or DEFAULT_PREFILTER_ISCORE,
+                   tokens=token_cache(kwargs))
+
+    def line_signals(self, line):
+        """
+        Return the signals seen on a line, as a bitmask.
+
+        :type line: FrekiLine
+        :rtype: int
+        """
+        signals = 0
+        token_bits = 0
+        for token in self.tokens.line_tokens(line):
+            token_bits |= token.bits
+        if token_bits & TOK_GRAM:
+            signals |= SIG_GRAMS
+        if numbering_re.match(line):
+            signals |= SIG_NUMBERING
+        if token_bits & TOK_LANGNAME:
+            signals |= SIG_LANGNAME
+        if float(line.attrs.get('iscore', 0.0)) >= self.iscore_thresh:
+            signals |= SIG_ISCORE
+        return signals
+
+    def _unit_key(self, line):
+        return line.block.page if self.unit == PREFILTER_PAGE else line.block.block_id
+
+    def keep_mask(self, lines):
+        """
+        Return, for each line, whether it should be classified.
+
+        :type lines: list[FrekiLine]
+        :rtype: np.ndarray
+        """
+        if not lines:
+            return np.zeros(0, dtype=bool)
+
+        # Number the units in the order they appear,
+        # and combine the signals of their lines.
+        unit_ids = {}
+        line_units = np.fromiter((unit_ids.setdefault(self._unit_key(l), len(unit_ids)) for l in lines),
+                                 dtype=np.int64, count=len(lines))
+        line_signals = np.fromiter((self.line_signals(l) for l in lines), dtype=np.int64, count=len(lines))
+        unit_signals = np.zeros(len(unit_ids), dtype=np.int64)
+        np.bitwise_or.at(unit_signals, line_units, line_signals)
+
+        scores = sum(((unit_signals & s) > 0).astype(np.int64) for s in SIGNALS)
+        keep_units = scores >= self.min_score
+
+        # Keep the units around each kept unit too, so that
+        # the lines at the edges of an instance are not lost.
+        if self.margin > 0 and keep_units.any():
+            kept = np.flatnonzero(keep_units)
+            offsets = np.arange(-self.margin, self.margin + 1)
+            near = np.clip((kept[:, None] + offsets[None, :]).ravel(), 0, len(keep_units) - 1)
+            keep_units[near] = True
+
+        return keep_units[line_units]
+
+
+def kept_runs(keep):
+    """
+    Return the (start, stop) ranges of the
+    consecutive kept lines.
+
+    :type keep: np.ndarray
+    :rtype: list[tuple[int,int]]
+    """
+    edges = np.diff(np.concatenate([[0], keep.astype(np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
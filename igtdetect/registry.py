@@ -0,0 +1,252 @@
+import os
+import re
+import threading
+from argparse import ArgumentTypeError
+from collections import OrderedDict
+
+from .env import LNG_NAMES
+from .plan import ExtractionPlan
+from .settings import Settings
+
+# =============================================================================
+# Hosting several models
+#
+# One process can classify with several models side by side, e.g. the
+# bundled model, a BIO-label model and models for particular language
+# families. The word lists, language names and gram lists they use are
+# loaded through the process's ResourcePool, which reads each file only
+# once however many models name it, and the models are held by name in a
+# ModelRegistry, each with its own settings (context window, previous tag,
+# label settings and resources) and output directories.
+#
+# Models whose features come out the same (the same thresholds and the same
+# resources) are put in one ModelGroup, and each document is extracted once
+# for the whole group, with every feature any of them uses over the widest of
+# their context windows. Each model then builds its own rows from the shared
+# line features.
+# =============================================================================
+
+MODELS_SECTION = 'models'
+MODEL_SECTION_PREFIX = 'model.'
+DEFAULT_MODEL = 'default'
+
+model_name_re = re.compile(r'^[\w.\-]+$')
+
+
+def model_section(name):
+    """
+    The config section with the settings
+    particular to a model, e.g. "model.bio".
+
+    :rtype: str
+    """
+    return MODEL_SECTION_PREFIX + name
+
+
+def is_model_section(section):
+    """:rtype: bool"""
+    return section == MODELS_SECTION or section.startswith(MODEL_SECTION_PREFIX)
+
+
+def parse_model_name(name):
+    """
+    Check that a model name can be used as the
+    name of its output directories.
+
+    :rtype: str
+    """
+    name = name.strip()
+    if not model_name_re.match(name):
+        raise ArgumentTypeError('Invalid model name "{}"; use letters, digits, ".", "-" and "_".'.format(name))
+    return name
+
+
+def parse_model_spec(spec):
+    """
+    Parse a "NAME=PATH" model given on the command line.
+
+    :rtype: tuple[str,str]
+    """
+    name, sep, path = spec.partition('=')
+    if not sep or not path.strip():
+        raise ArgumentTypeError('Invalid model "{}"; expected NAME=PATH.'.format(spec))
+    return parse_model_name(name), path.strip()
+
+
+def parse_model_names(names):
+    """
+    Parse a comma-separated list of model names.
+
+    :rtype: list[str]
+    """
+    return [parse_model_name(name) for name in names.split(',') if name.strip()]
+
+
+class ResourcePool(object):
+    """
+    Resources loaded from files, each loaded only once
+    per process, and shared by everything that uses it.
+    """
+    def __init__(self):
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, loader):
+        """
+        Return the resource at path, loading it with
+        loader the first time it is asked for. The same
+        file loaded with different loaders is kept apart.
+
+        :type path: str
+        :param loader: Function from the path to the resource.
+        """
+        key = (os.path.abspath(path), loader)
+        with self._lock:
+            if key not in self._resources:
+                self._resources[key] = loader(path)
+            return self._resources[key]
+
+    def __len__(self):
+        return len(self._resources)
+
+    def clear(self):
+        with self._lock:
+            self._resources.clear()
+
+
+RESOURCES = ResourcePool()
+
+
+class HostedModel(object):
+    """
+    A classifier, under its name, with the
+    settings and resources it is used with.
+    """
+    def __init__(self, name, path, cw, kwargs, plan=None, classes=None, expander=None):
+        """
+        :param kwargs: The options to use the model with, including its compiled settings.
+        :type kwargs: dict
+        :param plan: The features the model can use.
+        :type plan: ExtractionPlan
+        :param classes: The model's classes, in the order to write them out.
+        :param expander: For a sparse model, builds its rows from a document's features.
+        :type expander: ContextExpander
+        """
+        self.name = name
+        self.path = path
+        self.cw = cw
+        self.kwargs = kwargs
+        self.plan = plan
+        self.classes = classes
+        self.expander = expander
+
+    @property
+    def settings(self):
+        """:rtype: Settings"""
+        return self.kwargs['settings']
+
+    @property
+    def classified_dir(self):
+        return self.kwargs.get('classified_dir')
+
+    @property
+    def detected_dir(self):
+        return self.kwargs.get('detected_dir')
+
+    def resources(self):
+        """
+        The loaded resources the model's features depend on,
+        which are the same objects for models that name the
+        same files.
+
+        :rtype: tuple
+        """
+        return tuple(id(self.kwargs.get(key)) for key in ['gram_list', 'gram_list_cased', LNG_NAMES])
+
+    def __repr__(self):
+        return 'HostedModel({!r}, {!r})'.format(self.name, self.path)
+
+
+class ModelGroup(object):
+    """
+    Hosted models whose features are
+    extracted together, in one pass.
+    """
+    def __init__(self, models):
+        """:type models: list[HostedModel]"""
+        self.models = list(models)
+        self.settings = Settings.merge([m.settings for m in self.models])
+        self.plan = ExtractionPlan.union([m.plan for m in self.models])
+
+        # The options to extract with are those of the
+        # first model, with the merged settings.
+        self.kwargs = dict(self.models[0].kwargs, settings=self.settings)
+
+    @property
+    def names(self):
+        """:rtype: list[str]"""
+        return [m.name for m in self.models]
+
+    def is_last(self, model):
+        """Whether the model is the last of the group to classify each document."""
+        return model is self.models[-1]
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __len__(self):
+        return len(self.models)
+
+
+class ModelRegistry(object):
+    """
+    The models hosted by the process, by name.
+    """
+    def __init__(self, models=()):
+        self._models = OrderedDict()
+        for model in models:
+            self.add(model)
+
+    def add(self, model):
+        """:type model: HostedModel"""
+        if model.name in self._models:
+            raise ValueError('A model named "{}" is already loaded.'.format(model.name))
+        self._models[model.name] = model
+
+    def get(self, name):
+        """
+        Route a request to the model of the given name.
+
+        :rtype: HostedModel
+        """
+        model = self._models.get(name)
+        if model is None:
+            raise KeyError('No model named "{}"; the models are: {}'.format(name, ', '.join(self.names)))
+        return model
+
+    @property
+    def names(self):
+        """:rtype: list[str]"""
+        return list(self._models.keys())
+
+    def groups(self):
+        """
+        Split the models into the groups that can share
+        an extraction pass, in the order they were added.
+
+        :rtype: list[ModelGroup]
+        """
+        grouped = OrderedDict()
+        for model in self._models.values():
+            key = (model.settings.extraction_key(), model.resources())
+            grouped.setdefault(key, []).append(model)
+        return [ModelGroup(models) for models in grouped.values()]
+
+    def __contains__(self, name):
+        return name in self._models
+
+    def __iter__(self):
+        return iter(self._models.values())
+
+    def __len__(self):
+        return len(self._models)
@@ -0,0 +1,169 @@
+from .context import ContextWindow, context_window
+from .env import getbool, ENABLED_FREKI_FEATS, ENABLED_TEXT_FEATS, T_PREV_TAG, HIGH_OOV_THRESH, MED_OOV_THRESH, \
+    HIGH_ISCORE_THRESH, MED_ISCORE_THRESH, LOW_ISCORE_THRESH, INDENT_STEP, LARGE_VGAP_THRESH, FONT_ZSCORE_THRESH
+from .labels import cached_label_table, label_settings
+
+# =============================================================================
+# Compiled settings
+#
+# The config file and command line options arrive as one dict of strings.
+# Rather than have the feature extraction look its settings up in that dict
+# (and in the config) for every line, turning "1" or "on" into a boolean each
+# time, the settings are compiled once when a run starts, into a read-only
+# Settings object of plain booleans, floats and sets of enabled features,
+# which is passed down to the code that uses them. Nothing is cached in
+# module globals, so several configurations can be used side by side in one
+# process, each with its own Settings.
+# =============================================================================
+
+
+class Settings(object):
+    """
+    Read-only, compiled settings for feature
+    extraction and label handling.
+    """
+    __slots__ = ('text_feats_enabled', 'freki_feats_enabled', 'prev_tag',
+                 'text_feats', 'freki_feats', 'window', 'label_settings',
+                 'word_overlap', 'high_overlap', 'med_overlap',
+                 'high_oov', 'med_oov', 'high_iscore', 'med_iscore', 'low_iscore',
+                 'indent_step', 'large_vgap_ratio', 'font_zscore')
+
+    def __init__(self, **values):
+        """
+        :param text_feats_enabled: Whether the text features are extracted at all.
+        :param freki_feats_enabled: Whether the freki features are extracted at all.
+        :param prev_tag: Whether to add the previous line's tag as a feature.
+        :param text_feats: The enabled text features.
+        :type text_feats: frozenset[str]
+        :param freki_feats: The enabled freki features.
+        :type freki_feats: frozenset[str]
+        :type window: ContextWindow
+        :param label_settings: The values of LABEL_SETTINGS, in order.
+        :type label_settings: tuple[bool]
+
+        The rest are floats, or None for a threshold that is not set.
+        """
+        missing = [name for name in self.__slots__ if name not in values]
+        if missing:
+            raise TypeError('Missing settings: {}'.format(', '.join(missing)))
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.pop(name))
+        if values:
+            raise TypeError('Unknown settings: {}'.format(', '.join(sorted(values))))
+
+    @classmethod
+    def compile(cls, kwargs, config):
+        """
+        Compile the settings from the dict of options and the
+        config file they were read from. The enabled features
+        and thresholds in the options, such as those from a
+        model's [model.NAME] section, take precedence over the
+        [text_features], [freki_features] and [thresholds]
+        sections of the config.
+
+        :type kwargs: dict
+        :type config: ConfigParser
+        :rtype: Settings
+        """
+        return cls(text_feats_enabled=getbool(kwargs, 'text_feats_enabled'),
+                   freki_feats_enabled=getbool(kwargs, 'freki_feats_enabled'),
+                   prev_tag=getbool(kwargs, T_PREV_TAG),
+                   text_feats=frozenset(ENABLED_TEXT_FEATS(config, kwargs)),
+                   freki_feats=frozenset(ENABLED_FREKI_FEATS(config, kwargs)),
+                   window=context_window(kwargs),
+                   label_settings=label_settings(kwargs),
+                   word_overlap=bool(kwargs.get('word_overlap')),
+                   high_overlap=float(kwargs.get('high_overlap', 0.25)),
+                   med_overlap=float(kwargs.get('med_overlap', 0.1)),
+                   high_oov=HIGH_OOV_THRESH(config, kwargs),
+                   med_oov=MED_OOV_THRESH(config, kwargs),
+                   high_iscore=HIGH_ISCORE_THRESH(config, kwargs),
+                   med_iscore=MED_ISCORE_THRESH(config, kwargs),
+                   low_iscore=LOW_ISCORE_THRESH(config, kwargs),
+                   indent_step=INDENT_STEP(config, kwargs),
+                   large_vgap_ratio=LARGE_VGAP_THRESH(config, kwargs),
+                   font_zscore=FONT_ZSCORE_THRESH(config, kwargs))
+
+    @classmethod
+    def merge(cls, settings_list):
+        """
+        Settings for extracting the features of several models
+        in one pass: every feature that any of them uses, over
+        a window reaching as far as any of theirs. The label
+        settings are those of the first. Their extraction_keys
+        must be the same.
+
+        :type settings_list: list[Settings]
+        :rtype: Settings
+        """
+        first = settings_list[0]
+        if len(settings_list) == 1:
+            return first
+        return first.replace(
+            text_feats_enabled=any(s.text_feats_enabled for s in settings_list),
+            freki_feats_enabled=any(s.freki_feats_enabled for s in settings_list),
+            prev_tag=any(s.prev_tag for s in settings_list),
+            text_feats=frozenset().union(*[s.text_feats for s in settings_list]),
+            freki_feats=frozenset().union(*[s.freki_feats for s in settings_list]),
+            window=ContextWindow(o for s in settings_list for o in s.window.offsets))
+
+    def extraction_key(self):
+        """
+        The settings that change the value of a feature,
+        rather than whether it is extracted at all. Models
+        can only share an extraction pass if these match.
+
+        :rtype: tuple
+        """
+        return (self.word_overlap, self.high_overlap, self.med_overlap,
+                self.high_oov, self.med_oov, self.high_iscore, self.med_iscore, self.low_iscore,
+                self.indent_step, self.large_vgap_ratio, self.font_zscore)
+
+    def values(self):
+        """:rtype: dict"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def replace(self, **changes):
+        """
+        A copy of the settings, with some of them changed.
+
+        :rtype: Settings
+        """
+        values = self.values()
+        values.update(changes)
+        return Settings(**values)
+
+    def label_table(self, transform=None):
+        """
+        The label table for these label settings.
+
+        :rtype: LabelTable
+        """
+        return cached_label_table(self.label_settings, transform)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are read-only; use replace() to change them.')
+
+    def __delattr__(self, name):
+        raise AttributeError('Settings are read-only; use replace() to change them.')
+
+    def _key(self):
+        return tuple(tuple(self.window.offsets) if name == 'window' else getattr(self, name)
+                     for name in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, Settings) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __reduce__(self):
+        return _settings, (self.values(),)
+
+    def __repr__(self):
+        return 'Settings({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name))
+                                               for name in self.__slots__ if name != 'window'))
+
+
+def _settings(values):
+    return Settings(**values)
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+from argparse import ArgumentTypeError
+
+from .journal import AtomicFile
+
+# =============================================================================
+# Sharding
+#
+# To split a run across several machines, each is given the same file list
+# (or database) and a --shard K/N, and keeps only the documents whose ids
+# hash into its shard. The hash depends only on the document id, so every
+# node agrees on the partition without talking to the others, and a
+# document lands in the same shard for test and eval.
+#
+# Each sharded test run writes a manifest of its outputs, and each sharded
+# eval run writes its evaluation counts; the "merge" subcommand combines
+# them into a single manifest and a single evaluation report.
+# =============================================================================
+
+MANIFEST_HEADER = '# shard'
+
+
+def parse_shard(s):
+    """
+    Parse a shard given as "K/N", for the K-th of
+    N shards, counting from 1.
+
+    :rtype: tuple[int,int]
+    """
+    try:
+        k, n = [int(x) for x in s.split('/')]
+    except ValueError:
+        raise ArgumentTypeError('Shard must be given as K/N, not "{}".'.format(s))
+    if not 1 <= k <= n:
+        raise ArgumentTypeError('Shard "{}" must have 1 <= K <= N.'.format(s))
+    return k, n
+
+
+def shard_str(shard):
+    return '{}/{}'.format(*shard)
+
+
+def shard_of(key, num_shards):
+    """
+    The shard (counting from 1) that a document id hashes
+    into. The builtin hash() of a string changes between
+    processes, so md5 is used instead.
+
+    :rtype: int
+    """
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards + 1
+
+
+def select_shard(paths, shard, key):
+    """
+    Keep only the paths whose keys hash into the shard.
+
+    :type shard: tuple[int,int]
+    :param key: Function giving the document id of a path.
+    :rtype: list[str]
+    """
+    k, n = shard
+    return [path for path in paths if shard_of(key(path), n) == k]
+
+
+# -------------------------------------------
+# Manifests
+# -------------------------------------------
+def write_manifest(path, shard, out_paths):
+    """
+    Write the list of output files of a shard.
+    """
+    with AtomicFile(path, encoding='utf-8') as f:
+        f.write('{} {}\n'.format(MANIFEST_HEADER, shard_str(shard)))
+        for out_path in out_paths:
+            f.write(out_path + '\n')
+
+
+def read_manifest(path):
+    """
+    :rtype: tuple[tuple[int,int], list[str]]
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    if not lines or not lines[0].startswith(MANIFEST_HEADER):
+        raise ValueError('"{}" is not a shard manifest.'.format(path))
+    shard = parse_shard(lines[0][len(MANIFEST_HEADER):].strip())
+    return shard, [l for l in lines[1:] if l]
+
+
+def manifest_path(out_dir, shard):
+    return os.path.join(out_dir, 'manifest-{}-of-{}.txt'.format(*shard))
+
+
+# -------------------------------------------
+# Evaluation state
+# -------------------------------------------
+def write_eval_state(path, shard, state):
+    """
+    Write the evaluation counts of a shard.
+
+    :type state: dict
+    """
+    with AtomicFile(path, encoding='utf-8') as f:
+        json.dump(dict(state, shard=list(shard)), f, indent=1)
+
+
+def read_eval_state(path):
+    """
+    :rtype: tuple[tuple[int,int], dict]
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    return tuple(state.pop('shard')), state
+
+
+def eval_state_path(shard, out_path=None):
+    out_dir = os.path.dirname(out_path) if out_path else ''
+    return os.path.join(out_dir, 'eval-state-{}-of-{}.json'.format(*shard))
+
+
+def missing_shards(shards):
+    """
+    Return the shards of an N-way split that are not
+    among those given, and any given more than once.
+
+    :type shards: list[tuple[int,int]]
+    :rtype: tuple[list[int], list[int]]
+    """
+    n = max(s[1] for s in shards)
+    seen = [s[0] for s in shards]
+    missing = [k for k in range(1, n + 1) if k not in seen]
+    repeated = sorted(set(k for k in seen if seen.count(k) > 1))
+    return missing, repeated
@@ -0,0 +1,87 @@
+import json
+import os
+import re
+import tempfile
+
+import numpy as np
+
+from .prefilter import kept_runs
+
+# =============================================================================
+# Streaming
+#
+# "test --stdin" reads a stream of freki documents, one after another, from
+# stdin, and writes each one out to stdout as soon as it is classified, so
+# that it can sit in a Unix pipeline. Documents are told apart by the
+# doc_id in their block headers: a block with a new doc_id starts a new
+# document. Only one document is held in memory at a time.
+#
+# FrekiDoc only parses from a path, so each document is passed to it through
+# a scratch file in memory (on /dev/shm where there is one), which is removed
+# as soon as it is parsed.
+# =============================================================================
+
+OUT_FREKI = 'freki'
+OUT_SPANS = 'spans'
+STREAM_FORMATS = [OUT_FREKI, OUT_SPANS]
+
+header_re = re.compile(r'^doc_id=(\S+)\s')
+
+
+def read_freki_stream(stream):
+    """
+    Split a stream of freki documents into the
+    (doc_id, text) of each document.
+
+    :type stream: Iterable[str]
+    :rtype: Iterable[tuple[str,str]]
+    """
+    doc_id = None
+    lines = []
+    for line in stream:
+        # Files joined with cat can have a byte
+        # order mark at the start of each one.
+        line = line.lstrip('\ufeff')
+        header_m = header_re.match(line)
+        if header_m and header_m.group(1) != doc_id:
+            if doc_id is not None:
+                yield doc_id, ''.join(lines)
+            doc_id = header_m.group(1)
+            lines = []
+        if doc_id is not None:
+            lines.append(line)
+    if doc_id is not None:
+        yield doc_id, ''.join(lines)
+
+
+def stream_doc_path(scratch_dir, doc_id, text):
+    """
+    Write the text of a document to a scratch file,
+    named for the document, for FrekiDoc to read.
+
+    :rtype: str
+    """
+    safe_id = re.sub(r'[^\w\-]', '_', doc_id)
+    fd, path = tempfile.mkstemp(prefix=safe_id + '.', suffix='.freki', dir=scratch_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+def span_record(doc_id, lines, tags):
+    """
+    The detected IGT spans of a document, as a line
+    of JSON: each run of consecutive non-"O" lines,
+    with their line numbers, tags and text.
+
+    :type lines: list[FrekiLine]
+    :type tags: list[str]
+    :rtype: str
+    """
+    spans = []
+    for start, stop in kept_runs(np.array([tag != 'O' for tag in tags], dtype=bool)):
+        spans.append({'start_line': lines[start].lineno,
+                      'stop_line': lines[stop - 1].lineno,
+                      'tags': tags[start:stop],
+                      'lines': [str(line) for line in lines[start:stop]]})
+    return json.dumps({'doc_id': doc_id, 'spans': spans}, ensure_ascii=False)
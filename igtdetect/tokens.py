@@ -0,0 +1,133 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from .env import LNG_NAMES
+
+# =============================================================================
+# Token cache
+#
+# The same few thousand tokens ("the", "of", numbers...) make up most of the
+# words in a corpus. Rather than normalizing each token, building its
+# "word_" feature name and checking it against the language names and gram
+# lists on every line, the answers for each raw token are computed once and
+# kept in a bounded LRU cache. There is one cache per process for each set
+# of language names and gram lists in use, so each worker in a pool has its
+# own.
+# =============================================================================
+
+DEFAULT_CACHE_SIZE = 100000
+
+# -------------------------------------------
+# Membership bits
+# -------------------------------------------
+TOK_LANGNAME = 1
+TOK_GRAM = 2
+
+token_re = re.compile(r'\w+', flags=re.UNICODE)
+
+TokenInfo = namedtuple('TokenInfo', ['word', 'feat', 'bits'])
+
+
+def normalize_token(token):
+    """
+    :type token: str
+    :rtype: str
+    """
+    # The '#' and ':' characters are reserved in SVMlite format
+    return token.lower().replace(':', '').replace('#', '')
+
+
+def has_bits(tokens, bits):
+    """
+    Whether any of the tokens has any of the given bits.
+
+    :type tokens: list[TokenInfo]
+    :rtype: bool
+    """
+    for token in tokens:
+        if token.bits & bits:
+            return True
+    return False
+
+
+class TokenCache(object):
+    """
+    LRU cache from raw tokens to their TokenInfo: the
+    normalized word, its "word_" feature, and a bitmask
+    of the lists it appears in.
+    """
+    def __init__(self, langnames=None, gram_list=None, gram_list_cased=None, maxsize=DEFAULT_CACHE_SIZE):
+        """
+        :type langnames: set[str]
+        :param gram_list: Grams matched regardless of case.
+        :type gram_list: set[str]
+        :param gram_list_cased: Grams matched exactly.
+        :type gram_list_cased: set[str]
+        :param maxsize: Number of tokens to keep, or None for no limit.
+        """
+        self.langnames = langnames if langnames is not None else set()
+        self.grams = set(g.lower() for g in gram_list or [])
+        self.grams_cased = set(gram_list_cased or [])
+        self.maxsize = maxsize
+        self.lookup = lru_cache(maxsize=maxsize)(self._token_info)
+
+    def _token_info(self, token):
+        word = normalize_token(token)
+        bits = 0
+        if word in self.langnames:
+            bits |= TOK_LANGNAME
+        if word in self.grams or token in self.grams_cased:
+            bits |= TOK_GRAM
+        return TokenInfo(word, 'word_{}'.format(word), bits)
+
+    def line_tokens(self, line):
+        """
+        :type line: str
+        :rtype: list[TokenInfo]
+        """
+        lookup = self.lookup
+        return [lookup(token) for token in token_re.findall(line)]
+
+    def stats(self):
+        """
+        :return: The hits, misses, and current size of the cache.
+        :rtype: tuple[int,int,int]
+        """
+        info = self.lookup.cache_info()
+        return info.hits, info.misses, info.currsize
+
+
+# The caches of this process, by the identities of the
+# resources they were built from, along with the resources,
+# so that their ids are not reused while the cache is kept.
+_token_caches = {}
+
+
+def token_cache(kwargs):
+    """
+    Return this process's token cache for the language
+    names and gram lists in kwargs (and the token_cache_size
+    setting), building it the first time they are seen.
+    Models with different resources each keep their own
+    cache, so taking turns does not throw either away.
+
+    :rtype: TokenCache
+    """
+    langnames = kwargs.get(LNG_NAMES)
+    gram_list = kwargs.get('gram_list')
+    gram_list_cased = kwargs.get('gram_list_cased')
+    maxsize = int(kwargs.get('token_cache_size') or DEFAULT_CACHE_SIZE)
+
+    # The lists are loaded once for a run, so they are
+    # told apart by identity rather than by their contents.
+    key = (id(langnames), id(gram_list), id(gram_list_cased), maxsize)
+    entry = _token_caches.get(key)
+    if entry is None:
+        # Until the resources are loaded, the language
+        # names setting is the path to the file.
+        langs = langnames if isinstance(langnames, set) else None
+        entry = ((langnames, gram_list, gram_list_cased),
+                 TokenCache(langs, gram_list, gram_list_cased, maxsize=maxsize))
+        _token_caches[key] = entry
+    return entry[1]
@@ -0,0 +1,129 @@
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# =============================================================================
+# Worker result transfer
+#
+# Sending a whole DocData back from an extraction process means pickling
+# its FrekiDoc and a dict of features for every line, and unpickling them
+# again in the parent, which can take as long as the extraction itself.
+# For the sparse models, the worker instead builds the document's rows as
+# a CSR matrix over the model's columns (one for each model, when several
+# share the extraction), and leaves its arrays in a scratch file that the
+# parent memory-maps. Only a small SharedRows handle is
+# pickled; the FrekiDoc is parsed again in the parent when the output is
+# written.
+#
+# The scratch files are kept on /dev/shm where there is one, so that they
+# never touch the disk, and each is unlinked as soon as it is mapped. Where
+# there is none, they go in the temp dir, with a warning.
+# =============================================================================
+
+SHM_DIR = '/dev/shm'
+
+LOG = logging.getLogger()
+
+
+def make_scratch_dir(base=None):
+    """
+    Create a directory for the scratch files of a run.
+
+    :param base: Where to create it, if not in /dev/shm or the temp dir.
+    :rtype: str
+    """
+    if not base:
+        if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+            base = SHM_DIR
+        else:
+            LOG.warning('{} is not available, so scratch files will be written to "{}", '
+                        'which may be on disk; set scratch_dir to choose another place.'.format(
+                            SHM_DIR, tempfile.gettempdir()))
+    return tempfile.mkdtemp(prefix='igtdetect-', dir=base)
+
+
+def remove_scratch_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class SharedRows(object):
+    """
+    Handle on the rows of a document (or of a chunk of
+    one) left in a scratch file by a worker process.
+
+    The file holds the indptr and indices arrays of the
+    CSR matrix, as int32, followed by the pre-filter's
+    keep mask, if there is one, as one byte per line.
+    """
+    def __init__(self, scratch_path, num_lines, nnz, has_keep, doc_path, index=0, count=1):
+        self.scratch_path = scratch_path
+        self.num_lines = num_lines
+        self.nnz = nnz
+        self.has_keep = has_keep
+        self.path = doc_path
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def write(cls, scratch_dir, X, doc_path, keep=None, index=0, count=1):
+        """
+        Write out the rows, in the worker.
+
+        :type X: csr_matrix
+        :type keep: np.ndarray
+        :rtype: SharedRows
+        """
+        num_lines, nnz = X.shape[0], X.nnz
+        fd, scratch_path = tempfile.mkstemp(suffix='.rows', dir=scratch_dir)
+        os.close(fd)
+        size = 4 * (num_lines + 1 + nnz) + (num_lines if keep is not None else 0)
+        mm = np.memmap(scratch_path, dtype=np.uint8, mode='w+', shape=(size,))
+        indptr_end = 4 * (num_lines + 1)
+        indices_end = indptr_end + 4 * nnz
+        mm[:indptr_end].view(np.int32)[:] = X.indptr
+        mm[indptr_end:indices_end].view(np.int32)[:] = X.indices
+        if keep is not None:
+            mm[indices_end:] = keep
+        mm.flush()
+        del mm
+        return cls(scratch_path, num_lines, nnz, keep is not None, doc_path, index=index, count=count)
+
+    def read(self, num_cols):
+        """
+        Map the rows, in the parent, and remove the
+        scratch file, which stays readable while mapped.
+
+        :param num_cols: Number of columns in the model.
+        :rtype: tuple[csr_matrix, np.ndarray]
+        """
+        num_lines, nnz = self.num_lines, self.nnz
+        indptr_end = 4 * (num_lines + 1)
+        indices_end = indptr_end + 4 * nnz
+        try:
+            mm = np.memmap(self.scratch_path, dtype=np.uint8, mode='r')
+            indptr = mm[:indptr_end].view(np.int32)
+            indices = mm[indptr_end:indices_end].view(np.int32)
+            keep = mm[indices_end:].view(bool) if self.has_keep else None
+        finally:
+            os.unlink(self.scratch_path)
+        X = csr_matrix((np.ones(nnz), indices, indptr), shape=(num_lines, num_cols), copy=False)
+        return X, keep
+
+
+def join_keep(masks):
+    """
+    Join the pre-filter masks of the chunks of a
+    document, in order, into the document's mask.
+
+    :type masks: list[np.ndarray]
+    :rtype: np.ndarray
+    """
+    if all(mask is None for mask in masks):
+        return None
+    if len(masks) == 1:
+        return masks[0]
+    return np.concatenate([np.asarray(mask, dtype=bool) for mask in masks])
@@ -0,0 +1,395 @@
+from array import array
+from zlib import crc32
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# =============================================================================
+# Feature vectorization
+#
+# Rather than handing lists of feature dicts to the classifier and having
+# them vectorized after the fact, features are interned into integer ids
+# as each document is extracted, and the rows are accumulated directly
+# into the arrays that back a CSR matrix.
+# =============================================================================
+
+# -------------------------------------------
+# Feature selection methods usable with
+# the max_features setting.
+# -------------------------------------------
+SELECT_CHI2 = 'chi2'
+SELECT_DOC_FREQ = 'df'
+SELECTION_METHODS = [SELECT_CHI2, SELECT_DOC_FREQ]
+
+
+class FeatureIndex(object):
+    """
+    Map feature names to contiguous integer ids,
+    assigning new ids the first time a name is seen.
+    """
+    def __init__(self, names=None):
+        self._ids = {}
+        self._names = []
+        for name in names or []:
+            self.intern(name)
+
+    def intern(self, name):
+        """:rtype: int"""
+        feat_id = self._ids.get(name)
+        if feat_id is None:
+            feat_id = len(self._names)
+            self._ids[name] = feat_id
+            self._names.append(name)
+        return feat_id
+
+    def get(self, name, default=None):
+        return self._ids.get(name, default)
+
+    def ids(self, feats, grow=True):
+        """
+        Return the ids for the true-valued features
+        in the feature dict. If grow is false, features
+        that have not been seen before are dropped.
+
+        :type feats: dict
+        :rtype: list[int]
+        """
+        if grow:
+            return [self.intern(f) for f, v in feats.items() if v]
+        else:
+            return [i for i in (self._ids.get(f) for f, v in feats.items() if v) if i is not None]
+
+    def name(self, feat_id):
+        return self._names[feat_id]
+
+    def names(self):
+        """:rtype: list[str]"""
+        return self._names
+
+    def subset(self, selected):
+        """
+        Return a new index containing only the selected
+        ids, renumbered in the order given.
+
+        :rtype: FeatureIndex
+        """
+        return FeatureIndex([self._names[i] for i in selected])
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __len__(self):
+        return len(self._names)
+
+    # Only the names need to be saved;
+    # the ids are rebuilt on load.
+    def __getstate__(self):
+        return {'_names': self._names}
+
+    def __setstate__(self, state):
+        self._names = state['_names']
+        self._ids = {name: i for i, name in enumerate(self._names)}
+
+
+class HashingFeatureIndex(object):
+    """
+    Map feature names to ids by hashing them into a fixed
+    number of buckets, so that no vocabulary needs to be kept
+    and the feature space does not grow with the corpus.
+
+    If buckets is given, only those buckets are kept, and
+    they are numbered in the order given; features that hash
+    anywhere else are dropped.
+    """
+    def __init__(self, hash_bits=18, buckets=None):
+        self.hash_bits = int(hash_bits)
+        self.buckets = None if buckets is None else np.asarray(buckets, dtype=np.int64)
+        self._init_columns()
+
+    def _init_columns(self):
+        self._mask = (1 << self.hash_bits) - 1
+        self._columns = None
+        if self.buckets is not None:
+            self._columns = np.full(1 << self.hash_bits, -1, dtype=np.int32)
+            self._columns[self.buckets] = np.arange(len(self.buckets))
+
+    def _hash(self, name):
+        return crc32(name.encode('utf-8')) & self._mask
+
+    def intern(self, name):
+        """:rtype: int"""
+        return self.get(name)
+
+    def get(self, name, default=None):
+        bucket = self._hash(name)
+        if self._columns is None:
+            return bucket
+        col = self._columns[bucket]
+        return int(col) if col >= 0 else default
+
+    def ids(self, feats, grow=True):
+        """
+        :type feats: dict
+        :rtype: list[int]
+        """
+        if self._columns is None:
+            mask = self._mask
+            return [crc32(f.encode('utf-8')) & mask for f, v in feats.items() if v]
+        else:
+            return [i for i in (self.get(f) for f, v in feats.items() if v) if i is not None]
+
+    def name(self, feat_id):
+        bucket = feat_id if self.buckets is None else self.buckets[feat_id]
+        return 'hash_{}'.format(bucket)
+
+    def names(self):
+        """:rtype: list[str]"""
+        return [self.name(i) for i in range(len(self))]
+
+    def subset(self, selected):
+        """:rtype: HashingFeatureIndex"""
+        buckets = selected if self.buckets is None else self.buckets[selected]
+        return HashingFeatureIndex(self.hash_bits, buckets=buckets)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        return (1 << self.hash_bits) if self.buckets is None else len(self.buckets)
+
+    def __getstate__(self):
+        return {'hash_bits': self.hash_bits, 'buckets': self.buckets}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_columns()
+
+
+def make_feature_index(hash_bits=None):
+    """
+    Return a hashed feature index if hash_bits is set
+    to a positive number, otherwise a growing vocabulary.
+    """
+    if hash_bits and int(hash_bits) > 0:
+        return HashingFeatureIndex(int(hash_bits))
+    return FeatureIndex()
+
+
+class SparseMatrixBuilder(object):
+    """
+    Accumulate binary feature rows and their labels
+    in compact arrays, to be turned into a single
+    CSR matrix for training.
+    """
+    def __init__(self, index=None):
+        """:type index: FeatureIndex"""
+        self.index = index if index is not None else FeatureIndex()
+        self.labels = []
+        self._indices = array('i')
+        self._indptr = array('q', [0])
+
+    def add_row(self, feat_ids, label):
+        """:type feat_ids: Iterable[int]"""
+        self._indices.extend(feat_ids)
+        self._indptr.append(len(self._indices))
+        self.labels.append(label)
+
+    def add_instance(self, label, feats, grow=True):
+        """:type feats: dict"""
+        self.add_row(self.index.ids(feats, grow=grow), label)
+
+    def add_rows(self, indptr, indices, labels, keep=None):
+        """
+        Add a block of rows given as the indptr and indices
+        arrays of a CSR matrix.
+
+        :param keep: Boolean mask of the rows to add, or None for all of them.
+        :type labels: list[str]
+        """
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int32)
+        if keep is not None:
+            keep = np.asarray(keep, dtype=bool)
+            lengths = np.diff(indptr)
+            indices = indices[np.repeat(keep, lengths)]
+            indptr = np.concatenate([[0], np.cumsum(lengths[keep])])
+            labels = [label for label, k in zip(labels, keep) if k]
+
+        self._indices.frombytes(indices.tobytes())
+        self._indptr.frombytes((indptr[1:] + self._indptr[-1]).tobytes())
+        self.labels.extend(labels)
+
+    def matrix(self, num_cols=None):
+        """
+        :param num_cols: Number of columns, if not the size of the index.
+        :rtype: csr_matrix
+        """
+        if num_cols is None:
+            num_cols = len(self.index)
+        indices = np.frombuffer(self._indices, dtype=np.int32) if self._indices else np.zeros(0, dtype=np.int32)
+        indptr = np.frombuffer(self._indptr, dtype=np.int64)
+        data = np.ones(len(indices), dtype=np.float64)
+        X = csr_matrix((data, indices.copy(), indptr.copy()),
+                       shape=(len(self.labels), num_cols))
+
+        # Feature ids may be repeated on a row by the
+        # caller; keep the matrix binary.
+        X.sum_duplicates()
+        X.data[:] = 1
+        return X
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class FeatureCounter(object):
+    """
+    Count, for each class, the number of lines on which
+    each feature fires, without keeping the lines themselves.
+    This is enough to select features for training on data
+    that is streamed rather than held in memory.
+    """
+    def __init__(self, index=None, flush_size=1000000):
+        """:type index: FeatureIndex"""
+        self.index = index if index is not None else FeatureIndex()
+        self.flush_size = flush_size
+        self.class_counts = {}
+        self._counts = {}
+        self._pending = {}
+
+    def add_row(self, feat_ids, label):
+        pending = self._pending.get(label)
+        if pending is None:
+            pending = self._pending[label] = array('i')
+            self.class_counts[label] = 0
+        pending.extend(feat_ids)
+        self.class_counts[label] += 1
+        if len(pending) >= self.flush_size:
+            self._flush(label)
+
+    def add_instance(self, label, feats):
+        """:type feats: dict"""
+        self.add_row(self.index.ids(feats), label)
+
+    def _flush(self, label):
+        pending = self._pending[label]
+        counts = np.bincount(np.frombuffer(pending, dtype=np.int32), minlength=len(self.index)) \
+            if pending else np.zeros(len(self.index), dtype=np.int64)
+        old = self._counts.get(label)
+        if old is not None:
+            counts[:len(old)] += old
+        self._counts[label] = counts
+        self._pending[label] = array('i')
+
+    def classes(self):
+        """:rtype: list[str]"""
+        return sorted(self.class_counts)
+
+    def observed(self):
+        """
+        Return the class-by-feature matrix of counts,
+        with the classes in sorted order.
+
+        :rtype: np.ndarray
+        """
+        observed = np.zeros((len(self.class_counts), len(self.index)))
+        for class_i, label in enumerate(self.classes()):
+            self._flush(label)
+            counts = self._counts[label]
+            observed[class_i, :len(counts)] = counts
+        return observed
+
+    def select(self, k, method=SELECT_CHI2):
+        """
+        Return an index of the k best features.
+
+        :rtype: FeatureIndex
+        """
+        observed = self.observed()
+        if k is None or k <= 0 or k >= observed.shape[1]:
+            selected = np.arange(observed.shape[1])
+        else:
+            if method == SELECT_CHI2:
+                class_counts = np.array([self.class_counts[c] for c in self.classes()], dtype=np.float64)
+                scores = chi2_from_counts(observed, class_counts)
+            elif method == SELECT_DOC_FREQ:
+                scores = observed.sum(axis=0)
+            else:
+                raise ValueError('Unknown feature selection method "{}"'.format(method))
+            selected = np.sort(np.argpartition(-scores, k - 1)[:k])
+
+        return self.index.subset(selected)
+
+
+# =============================================================================
+# Feature selection
+# =============================================================================
+def chi2_scores(X, labels):
+    """
+    Compute the chi-squared statistic of each column of the
+    binary matrix X against the class labels, in the same
+    way as scikit-learn's chi2, but without densifying X.
+
+    :type X: csr_matrix
+    :rtype: np.ndarray
+    """
+    classes, y = np.unique(np.asarray(labels), return_inverse=True)
+    Y = csr_matrix((np.ones(len(y)), (np.arange(len(y)), y)),
+                   shape=(len(y), len(classes)))
+
+    observed = np.asarray((Y.T @ X).todense())
+    return chi2_from_counts(observed, np.bincount(y).astype(np.float64))
+
+
+def chi2_from_counts(observed, class_counts):
+    """
+    Compute the chi-squared statistic of each feature from
+    the class-by-feature matrix of observed counts, and
+    the number of lines in each class.
+
+    :type observed: np.ndarray
+    :type class_counts: np.ndarray
+    :rtype: np.ndarray
+    """
+    feature_count = observed.sum(axis=0)
+    class_prob = class_counts / class_counts.sum()
+    expected = np.outer(class_prob, feature_count)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = (observed - expected) ** 2 / expected
+    terms[~np.isfinite(terms)] = 0
+    return terms.sum(axis=0)
+
+
+def doc_freq_scores(X, labels=None):
+    """
+    Number of rows on which each column fires.
+
+    :type X: csr_matrix
+    :rtype: np.ndarray
+    """
+    return np.bincount(X.indices, minlength=X.shape[1]).astype(np.float64)
+
+
+def select_features(X, labels, k, method=SELECT_CHI2):
+    """
+    Return the sorted column ids of the k best scoring
+    features, or every column if k is not positive or
+    there are no more than k columns.
+
+    :type X: csr_matrix
+    :rtype: np.ndarray
+    """
+    num_cols = X.shape[1]
+    if k is None or k <= 0 or k >= num_cols:
+        return np.arange(num_cols)
+
+    if method == SELECT_CHI2:
+        scores = chi2_scores(X, labels)
+    elif method == SELECT_DOC_FREQ:
+        scores = doc_freq_scores(X)
+    else:
+        raise ValueError('Unknown feature selection method "{}"'.format(method))
+
+    top_k = np.argpartition(-scores, k - 1)[:k]
+    return np.sort(top_k)
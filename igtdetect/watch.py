@@ -0,0 +1,128 @@
+import os
+import re
+import time
+
+# =============================================================================
+# Spool directory watching
+#
+# The "watch" subcommand loads the model and word lists once, then polls a
+# spool directory for new freki files and classifies them as they arrive.
+# A file is only picked up once its size and modification time have stayed
+# the same between two scans, so that files still being written are left
+# alone. Files that arrive together are classified together, in batches of
+# up to batch_size, waiting up to batch_wait seconds for a batch to fill.
+# Classified files are moved into the done directory, and files that could
+# not be classified into the failed directory, so each scan only sees the
+# files that are new.
+# =============================================================================
+
+spool_file_re = re.compile(r'^[^.].*\.freki(?:\.gz)?$')
+
+
+class SpoolWatcher(object):
+    """
+    Find the new files in a spool directory,
+    and move them out once they are processed.
+    """
+    def __init__(self, spool_dir, done_dir=None, failed_dir=None, poll_interval=2.,
+                 batch_size=32, batch_wait=0.5, once=False):
+        """
+        :param done_dir: Where to move classified files. [Default: SPOOL_DIR/done]
+        :param failed_dir: Where to move files that failed. [Default: SPOOL_DIR/failed]
+        :param poll_interval: Seconds between scans when the spool is empty.
+        :param batch_size: Most files to hand out at once.
+        :param batch_wait: Seconds to wait for more files once some have arrived.
+        :param once: Take the files already in the spool, without waiting for them to
+                     settle, and stop when it is empty.
+        """
+        self.spool_dir = spool_dir
+        self.done_dir = done_dir or os.path.join(spool_dir, 'done')
+        self.failed_dir = failed_dir or os.path.join(spool_dir, 'failed')
+        self.poll_interval = float(poll_interval)
+        self.batch_size = max(1, int(batch_size))
+        self.batch_wait = float(batch_wait)
+        self.once = once
+        self.stopped = False
+
+        # The (size, mtime) of each file at the last scan,
+        # and the files handed out but not yet moved.
+        self._seen = {}
+        self._handed_out = set()
+
+        os.makedirs(self.done_dir, exist_ok=True)
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def scan(self):
+        """
+        Return the files in the spool that have not
+        changed since the last scan, oldest first.
+
+        :rtype: list[str]
+        """
+        seen = {}
+        ready = []
+        with os.scandir(self.spool_dir) as entries:
+            for entry in entries:
+                if not spool_file_re.match(entry.name) or entry.path in self._handed_out or \
+                        not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                seen[entry.path] = (st.st_size, st.st_mtime)
+                if self.once or self._seen.get(entry.path) == seen[entry.path]:
+                    ready.append((st.st_mtime, entry.path))
+        self._seen = seen
+        return [path for mtime, path in sorted(ready)]
+
+    def batches(self):
+        """
+        Yield batches of ready files until stopped.
+
+        :rtype: Iterable[list[str]]
+        """
+        while not self.stopped:
+            ready = self.scan()
+            if not ready:
+                if self.once:
+                    return
+                self._sleep(self.poll_interval)
+                continue
+
+            # Give a burst of files a moment to finish
+            # arriving, so they go out in one batch.
+            if len(ready) < self.batch_size and self.batch_wait > 0 and not self.once:
+                self._sleep(self.batch_wait)
+                # Files can vanish while we wait, so
+                # only what is still there goes out.
+                ready = self.scan()
+                if not ready:
+                    continue
+
+            for i in range(0, len(ready), self.batch_size):
+                if self.stopped:
+                    break
+                batch = ready[i:i + self.batch_size]
+                self._handed_out.update(batch)
+                yield batch
+
+    def _sleep(self, seconds):
+        end = time.monotonic() + seconds
+        while not self.stopped and time.monotonic() < end:
+            time.sleep(min(0.1, seconds))
+
+    def stop(self):
+        self.stopped = True
+
+    def _move(self, paths, out_dir):
+        for path in paths:
+            self._seen.pop(path, None)
+            os.replace(path, os.path.join(out_dir, os.path.basename(path)))
+            self._handed_out.discard(path)
+
+    def done(self, paths):
+        self._move(paths, self.done_dir)
+
+    def failed(self, paths):
+        self._move(paths, self.failed_dir)
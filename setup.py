@@ -14,6 +14,7 @@ setup(name='igtdetect',
 	      'setuptools>=53',
           'scikit-learn>=0.18.1',
           'numpy',
+          'scipy',
           'freki@https://github.com/xigt/freki/archive/v0.3.0.tar.gz',
           'riples-classifier@https://github.com/xigt/riples-classifier/archive/0.1.0.tar.gz',
       ]
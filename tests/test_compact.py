@@ -0,0 +1,85 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from igtdetect.compact import export_compact, CompactClassifier
+from igtdetect.models import SparseLogisticRegressionWrapper, load_classifier
+from igtdetect.vectorize import FeatureIndex, HashingFeatureIndex
+
+
+def train_model(feat_index, num_feats=6):
+    rng = np.random.RandomState(0)
+    X = csr_matrix((rng.rand(40, num_feats) < 0.4).astype(float))
+    labels = ['L' if X[i, 0] or X[i, 1] else ('G' if X[i, 2] else 'O') for i in range(X.shape[0])]
+    cw = SparseLogisticRegressionWrapper()
+    cw.train_matrix(X, labels, feat_index)
+    cw.context_window = '-2..+1'
+    return cw, X
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.model_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.model_dir, 'compact')
+
+    def tearDown(self):
+        shutil.rmtree(self.model_dir, ignore_errors=True)
+
+    def assertSameModel(self, cw, loaded, X):
+        """
+        Check the loaded model against the one exported, whose
+        columns of X may be in a different order.
+        """
+        self.assertEqual([str(c) for c in cw.classes()], list(loaded.classes()))
+        cols = [cw.feat_index.get(loaded.feat_index.name(j)) for j in range(len(loaded.feat_index))]
+        self.assertTrue(np.allclose(cw.coef()[:, cols], loaded.coef(), atol=1e-6))
+        self.assertTrue(np.allclose(cw.intercept(), loaded.intercept(), atol=1e-6))
+        self.assertEqual(loaded.context_window, cw.context_window)
+        for d1, d2 in zip(cw.test_matrix(X), loaded.test_matrix(X[:, cols])):
+            self.assertEqual(d1.best_class, d2.best_class)
+
+    def test_round_trip(self):
+        # Names out of order, since the exported
+        # vocabulary is sorted for binary search.
+        names = ['zeta', 'alpha', 'mu', 'beta', 'omega', 'gamma']
+        cw, X = train_model(FeatureIndex(names))
+        export_compact(cw, self.path)
+        loaded = load_classifier(self.path)
+        self.assertIsInstance(loaded, CompactClassifier)
+        self.assertSameModel(cw, loaded, X)
+        for name in names:
+            self.assertEqual(loaded.feat_index.name(loaded.feat_index.get(name)), name)
+        self.assertIsNone(loaded.feat_index.get('missing'))
+
+    def test_hashed_round_trip(self):
+        cw, X = train_model(HashingFeatureIndex(hash_bits=3), num_feats=8)
+        export_compact(cw, self.path)
+        loaded = load_classifier(self.path)
+        self.assertIsInstance(loaded.feat_index, HashingFeatureIndex)
+        self.assertEqual(loaded.feat_index.get('feat'), cw.feat_index.get('feat'))
+        self.assertEqual(loaded.context_window, cw.context_window)
+        self.assertTrue(np.allclose(cw.coef(), loaded.coef(), atol=1e-6))
+        for d1, d2 in zip(cw.test_matrix(X), loaded.test_matrix(X)):
+            self.assertEqual(d1.best_class, d2.best_class)
+
+    def test_pickled_by_path(self):
+        cw, X = train_model(FeatureIndex(['a', 'b', 'c', 'd', 'e', 'f']))
+        export_compact(cw, self.path)
+        loaded = pickle.loads(pickle.dumps(load_classifier(self.path)))
+        self.assertEqual(loaded.path, self.path)
+        self.assertSameModel(cw, loaded, X)
+
+    def test_read_only(self):
+        cw, X = train_model(FeatureIndex(['a', 'b', 'c', 'd', 'e', 'f']))
+        export_compact(cw, self.path)
+        with self.assertRaises(TypeError):
+            load_classifier(self.path).fit(X, ['O'] * X.shape[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
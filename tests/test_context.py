@@ -0,0 +1,100 @@
+import unittest
+
+import numpy as np
+
+from igtdetect.context import ContextWindow, DocFeatures, ContextExpander
+from igtdetect.vectorize import FeatureIndex
+
+
+def random_doc(rng, window, num_lines=12, vocab=8, local=True):
+    """
+    A document whose lines each have a few of the
+    features f0..f{vocab-1}, some of them false.
+    """
+    line_feats = []
+    for i in range(num_lines):
+        names = rng.choice(vocab, size=rng.randint(0, 4), replace=False)
+        line_feats.append({'f{}'.format(n): bool(rng.randint(0, 4)) for n in names})
+    local_feats = [{'prev_tag_{}'.format(rng.randint(0, 2)): True} if local else {}
+                   for i in range(num_lines)]
+    return DocFeatures(line_feats, window, local_feats)
+
+
+def expanded_rows(doc, index):
+    """
+    The rows of the document built from the windowed dicts,
+    as sets of the column ids of their true features.
+    """
+    rows = []
+    for i in range(len(doc)):
+        feats = doc.expand(i)
+        rows.append(set(index.get(f) for f, v in feats.items()
+                        if v and index.get(f) is not None))
+    return rows
+
+
+def matrix_rows(X):
+    return [set(X.indices[X.indptr[i]:X.indptr[i + 1]].tolist()) for i in range(X.shape[0])]
+
+
+class ContextExpanderTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.window = ContextWindow([-2, -1, 1])
+
+    def test_matches_expand(self):
+        index = FeatureIndex()
+        expander = ContextExpander(index, self.window)
+        for trial in range(5):
+            doc = random_doc(self.rng, self.window)
+            X = expander.matrix(doc)
+            self.assertEqual(X.shape, (len(doc), len(index)))
+            self.assertEqual(matrix_rows(X), expanded_rows(doc, index))
+            self.assertTrue((X.data == 1).all())
+
+    def test_without_local(self):
+        index = FeatureIndex()
+        expander = ContextExpander(index, self.window)
+        doc = random_doc(self.rng, self.window)
+        X = expander.matrix(doc, local=False)
+        nonlocal_doc = DocFeatures(doc.line_feats, self.window)
+        self.assertEqual(matrix_rows(X), expanded_rows(nonlocal_doc, index))
+        self.assertFalse(any(name.startswith('prev_tag_') for name in index.names()))
+
+    def test_matches_window_expand(self):
+        index = FeatureIndex()
+        expander = ContextExpander(index, self.window)
+        doc = random_doc(self.rng, self.window, local=False)
+        X = expander.matrix(doc)
+        self.assertEqual(matrix_rows(X),
+                         [set(index.get(f) for f, v in self.window.expand(doc.line_feats, i).items() if v)
+                          for i in range(len(doc))])
+
+    def test_no_grow(self):
+        index = FeatureIndex(['f0', 'prev_f1', 'next_f2', 'prev_tag_1'])
+        expander = ContextExpander(index, self.window, grow=False)
+        for trial in range(5):
+            doc = random_doc(self.rng, self.window, vocab=12)
+            X = expander.matrix(doc)
+            self.assertEqual(len(index), 4)
+            self.assertEqual(X.shape, (len(doc), 4))
+            self.assertEqual(matrix_rows(X), expanded_rows(doc, index))
+        # Only the line features with a column at
+        # some offset are kept in the base index.
+        self.assertLessEqual(set(expander.base.names()), {'f0', 'f1', 'f2'})
+
+    def test_no_grow_resets_base(self):
+        index = FeatureIndex(['f{}'.format(n) for n in range(8)])
+        expander = ContextExpander(index, self.window, grow=False, max_base=2)
+        for trial in range(5):
+            doc = random_doc(self.rng, self.window)
+            X = expander.matrix(doc)
+            self.assertEqual(matrix_rows(X), expanded_rows(doc, index))
+            # The base is started afresh once it is over max_base,
+            # so it holds at most those and this document's features.
+            doc_feats = set(f for feats in doc.line_feats for f, v in feats.items() if v)
+            self.assertLessEqual(len(expander.base), 2 + len(doc_feats))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from igtdetect.filelist import FileList, reservoir_sample, largest_first, iter_manifest
+
+
+class FileListTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.paths = []
+        for name in ['b.freki', 'a.freki', 'sub/c.freki', 'sub/d.txt']:
+            path = os.path.join(self.data_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('x' * len(self.paths))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def test_reiterate(self):
+        fl = FileList(patterns=[self.data_dir])
+        first = list(fl)
+        self.assertEqual(first, [os.path.join(self.data_dir, n)
+                                 for n in ['a.freki', 'b.freki', 'sub/c.freki', 'sub/d.txt']])
+        self.assertEqual(list(fl), first)
+
+    def test_filter(self):
+        fl = FileList(patterns=[self.data_dir]).filter(lambda p: p.endswith('.freki'))
+        fl = fl.filter(lambda p: 'sub' not in p)
+        self.assertEqual(sorted(fl), sorted(self.paths[:2]))
+        self.assertTrue(fl.filter(lambda p: False).is_empty())
+
+    def write_manifest(self, name, opener=open):
+        path = os.path.join(self.data_dir, name)
+        with opener(path, 'wt') as f:
+            f.write('# inputs\n\nb.freki\n  sub/c.freki  \n{}\n'.format(self.paths[1]))
+        return path
+
+    def test_manifest(self):
+        expected = [self.paths[0], self.paths[2], self.paths[1]]
+        for manifest in [self.write_manifest('list.txt'),
+                         self.write_manifest('list.txt.gz', opener=gzip.open)]:
+            paths = list(iter_manifest(manifest))
+            self.assertEqual([os.path.normpath(p) for p in paths], expected)
+            self.assertEqual(list(FileList(manifests=[manifest])), paths)
+
+    def test_reservoir_sample(self):
+        items = ['p{}'.format(i) for i in range(50)]
+        sample = reservoir_sample(iter(items), 10, np.random.RandomState(1))
+        self.assertEqual(len(sample), 10)
+        self.assertEqual(len(set(sample)), 10)
+        self.assertTrue(set(sample) <= set(items))
+        self.assertEqual(sample, reservoir_sample(items, 10, np.random.RandomState(1)))
+        self.assertEqual(sorted(reservoir_sample(items[:5], 10, np.random.RandomState(1))), items[:5])
+
+    def test_largest_first(self):
+        # self.paths were written in increasing size.
+        self.assertEqual(list(largest_first(self.paths)), self.paths[::-1])
+        self.assertEqual(list(largest_first(self.paths, lookahead=2)),
+                         [self.paths[1], self.paths[2], self.paths[3], self.paths[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
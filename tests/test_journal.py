@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from igtdetect.journal import AtomicFile, RunJournal
+
+
+class RunJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.out_dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+
+    def read(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def test_truncated_tail(self):
+        # The last entry was cut off mid-write.
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('doc1\ndoc2\ndo')
+        journal = RunJournal(self.path, resume=True)
+        self.assertEqual(journal.done, {'doc1', 'doc2'})
+        self.assertNotIn('do', journal)
+        self.assertEqual(self.read(), 'doc1\ndoc2\n')
+
+        journal.record('doc3')
+        journal.close()
+        self.assertEqual(self.read(), 'doc1\ndoc2\ndoc3\n')
+        self.assertEqual(len(RunJournal(self.path, resume=True)), 3)
+
+    def test_no_resume(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('doc1\n')
+        journal = RunJournal(self.path)
+        journal.close()
+        self.assertEqual(len(journal), 0)
+        self.assertEqual(self.read(), '')
+
+
+class AtomicFileTest(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.out_dir, 'out.txt')
+        with open(self.path, 'w') as f:
+            f.write('old')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+
+    def test_commit(self):
+        with AtomicFile(self.path) as f:
+            f.write('new')
+            with open(self.path) as old:
+                self.assertEqual(old.read(), 'old')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.listdir(self.out_dir), ['out.txt'])
+
+    def test_discard_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with AtomicFile(self.path) as f:
+                f.write('new')
+                raise RuntimeError()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(os.listdir(self.out_dir), ['out.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import ArgumentTypeError
+
+from igtdetect.shard import parse_shard, shard_of, select_shard, missing_shards, \
+    write_manifest, read_manifest, manifest_path
+
+
+class ShardTest(unittest.TestCase):
+    def test_shard_of_stable(self):
+        # Fixed values, so that a run split over machines
+        # or Python versions always agrees on the shards.
+        self.assertEqual([shard_of(key, 4) for key in ['doc1', 'doc2', 'abc', 'x']], [2, 2, 1, 1])
+
+    def test_select_shard(self):
+        keys = ['doc{}'.format(i) for i in range(100)]
+        shards = [select_shard(keys, (k, 3), key=lambda p: p) for k in range(1, 4)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(keys))
+        for k, keys_k in enumerate(shards, start=1):
+            self.assertTrue(all(shard_of(key, 3) == k for key in keys_k))
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/5'), (2, 5))
+        for s in ['0/5', '6/5', '2', 'a/b']:
+            with self.assertRaises(ArgumentTypeError):
+                parse_shard(s)
+
+    def test_missing_shards(self):
+        self.assertEqual(missing_shards([(1, 4), (3, 4), (3, 4)]), ([2, 4], [3]))
+        self.assertEqual(missing_shards([(2, 2), (1, 2)]), ([], []))
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        path = manifest_path(self.out_dir, (2, 3))
+        write_manifest(path, (2, 3), ['a.txt', 'sub/b.txt'])
+        self.assertEqual(read_manifest(path), ((2, 3), ['a.txt', 'sub/b.txt']))
+
+    def test_not_a_manifest(self):
+        path = os.path.join(self.out_dir, 'list.txt')
+        with open(path, 'w') as f:
+            f.write('a.txt\n')
+        with self.assertRaises(ValueError):
+            read_manifest(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+from igtdetect.transfer import SharedRows, join_keep
+
+
+class SharedRowsTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        X = csr_matrix(np.array([[1, 0, 1], [0, 0, 0], [0, 1, 0]]))
+        keep = np.array([True, False, True])
+        rows = SharedRows.write(self.scratch_dir, X, 'doc.freki', keep=keep)
+        Y, kept = rows.read(3)
+        self.assertEqual((Y != X).nnz, 0)
+        self.assertEqual(kept.tolist(), keep.tolist())
+        self.assertFalse(os.path.exists(rows.scratch_path))
+
+    def test_chunks_with_mask(self):
+        # A 9-line document in three chunks, each
+        # sending the mask over its own lines.
+        X = csr_matrix(np.eye(9, 4))
+        keep = np.array([True, False, True, True, True, False, False, True, True])
+        chunks = [SharedRows.write(self.scratch_dir, X[start:start + 3], 'doc.freki',
+                                   keep=keep[start:start + 3], index=i, count=3)
+                  for i, start in enumerate(range(0, 9, 3))]
+        mapped = [c.read(4) for c in chunks]
+        Y = vstack([m[0] for m in mapped], format='csr')
+        self.assertEqual((Y != X).nnz, 0)
+        self.assertEqual(join_keep([m[1] for m in mapped]).tolist(), keep.tolist())
+
+    def test_join_keep_without_mask(self):
+        self.assertIsNone(join_keep([None, None]))
+
+
+if __name__ == '__main__':
+    unittest.main()